@@ -0,0 +1,287 @@
+# arena.py
+#
+# A flat, arena-backed form of the data model for very large programs.
+#
+# Instead of one Python object per node, every node is a row in a set
+# of parallel typed arrays and is referred to by its row number (a
+# "handle").  Each row has a kind (an index into node_classes), up to
+# four integer fields, and a position.  What the fields hold depends on
+# the kind:
+#
+#     Integer, Float, Boolean,      a: literal
+#     Character, Name
+#     BinOp                         a: op (literal)  b: left  c: right
+#     UnaryOp                       a: op (literal)  b: operand
+#     Grouping                      a: expression
+#     CompoundExpression            a: statements
+#     Statements                    a/b: start/count in children
+#     PrintStatement                a: value
+#     ExpressionAsStatement         a: expression
+#     ConstDeclaration,             a: name (literal)  b: type (literal)  c: value
+#     VarDeclaration
+#     Assignment                    a: location  b: value
+#     IfStatement                   a: test  b: consequence  c: alternative
+#     WhileStatement                a: test  b: body
+#     BreakStatement,
+#     ContinueStatement
+#     FunctionDeclaration           a: name (literal)  b: return type (literal)
+#                                   c/d: start/count in children (body, then parameters)
+#     FunctionApplication           a: func  b/c: start/count in children (arguments)
+#     ReturnStatement               a: value
+#     Parameter                     a: name (literal)  b: type (literal)
+#
+# A "literal" is an index into the literal pool, a list of the distinct
+# strings in the program (values, names, operators and type names).
+# Missing optional fields are NONE (-1).  Variable-length lists of
+# children are stored contiguously in the children array.  The arrays
+# pickle as raw bytes, so an Arena is also cheap to send to another
+# process.
+#
+# typecheck.check_arena() and wasm.generate_arena() walk an Arena
+# directly.  to_arena() and from_arena() convert to and from the
+# class-based model.
+
+from .model import *
+from .parse import lineno, column
+from .trampoline import trampoline
+
+from array import array
+
+__all__ = [
+    'Arena', 'to_arena', 'from_arena', 'node_classes', 'NONE',
+    'INTEGER', 'FLOAT', 'BOOLEAN', 'CHARACTER', 'NAME', 'BINOP', 'UNARYOP',
+    'GROUPING', 'COMPOUND', 'STATEMENTS', 'PRINT', 'EXPRSTMT', 'CONST', 'VAR',
+    'ASSIGNMENT', 'IF', 'WHILE', 'BREAK', 'CONTINUE', 'FUNCDECL', 'FUNCAPP',
+    'RETURN', 'PARAMETER',
+    ]
+
+node_classes = (
+    Integer, Float, Boolean, Character, Name, BinOp, UnaryOp,
+    Grouping, CompoundExpression, Statements, PrintStatement, ExpressionAsStatement, ConstDeclaration, VarDeclaration,
+    Assignment, IfStatement, WhileStatement, BreakStatement, ContinueStatement, FunctionDeclaration, FunctionApplication,
+    ReturnStatement, Parameter,
+    )
+
+(INTEGER, FLOAT, BOOLEAN, CHARACTER, NAME, BINOP, UNARYOP,
+ GROUPING, COMPOUND, STATEMENTS, PRINT, EXPRSTMT, CONST, VAR,
+ ASSIGNMENT, IF, WHILE, BREAK, CONTINUE, FUNCDECL, FUNCAPP,
+ RETURN, PARAMETER) = range(len(node_classes))
+
+_kinds = { cls: n for n, cls in enumerate(node_classes) }
+
+NONE = -1
+
+class Arena:
+    def __init__(self):
+        self.kinds = array('B')
+        self.a = array('i')
+        self.b = array('i')
+        self.c = array('i')
+        self.d = array('i')
+        self.linenos = array('i')      # 0 if unknown
+        self.cols = array('i')         # 0 if unknown
+        self.children = array('i')
+        self.literals = [ ]
+        self._literal_index = { }
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_literal_index']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._literal_index = { value: n for n, value in enumerate(self.literals) }
+
+    def literal(self, value):
+        '''
+        Return the pool index of a literal string, adding it if needed.
+        '''
+        if value is None:
+            return NONE
+        index = self._literal_index.get(value)
+        if index is None:
+            index = self._literal_index[value] = len(self.literals)
+            self.literals.append(value)
+        return index
+
+    def add(self, kind, a=NONE, b=NONE, c=NONE, d=NONE, lineno=0, col=0):
+        self.kinds.append(kind)
+        self.a.append(a)
+        self.b.append(b)
+        self.c.append(c)
+        self.d.append(d)
+        self.linenos.append(lineno or 0)
+        self.cols.append(col or 0)
+        return len(self.kinds) - 1
+
+    def add_children(self, handles):
+        start = len(self.children)
+        self.children.extend(handles)
+        return start, len(handles)
+
+    # Accessors
+    def kind(self, h):
+        return self.kinds[h]
+
+    def value(self, h):
+        '''
+        The literal in field a (value of a literal/Name, name of a declaration)
+        '''
+        return self.literals[self.a[h]]
+
+    def lineno(self, h):
+        return self.linenos[h] or ''
+
+    def column(self, h):
+        return self.cols[h] or None
+
+    def statements(self, h):
+        return self.children[self.a[h]:self.a[h] + self.b[h]]
+
+    def arguments(self, h):
+        return self.children[self.b[h]:self.b[h] + self.c[h]]
+
+    def parameters(self, h):
+        start = self.c[h] + 1
+        return self.children[start:start + self.d[h] - 1]
+
+    def body(self, h):
+        return self.children[self.c[h]]
+
+def to_arena(node, arena=None):
+    '''
+    Convert a class-based model into an Arena.  Returns (arena, handle).
+    '''
+    if arena is None:
+        arena = Arena()
+    return arena, trampoline(_add(node, arena))
+
+# _add() and _build() are generators run by trampoline() (see
+# trampoline.py), so deeply nested models convert without recursion.
+def _add(node, arena):
+    kind = _kinds[type(node)]
+    lit = arena.literal
+    pos = { 'lineno': lineno(node), 'col': column(node) }
+    if kind in (INTEGER, FLOAT, BOOLEAN, CHARACTER, NAME):
+        return arena.add(kind, lit(node.value), **pos)
+    elif kind == BINOP:
+        left = yield _add(node.left, arena)
+        right = yield _add(node.right, arena)
+        return arena.add(kind, lit(node.op), left, right, **pos)
+    elif kind == UNARYOP:
+        operand = yield _add(node.operand, arena)
+        return arena.add(kind, lit(node.op), operand, **pos)
+    elif kind == GROUPING or kind == EXPRSTMT:
+        expression = yield _add(node.expression, arena)
+        return arena.add(kind, expression, **pos)
+    elif kind == COMPOUND:
+        statements = yield _add(node.statements, arena)
+        return arena.add(kind, statements, **pos)
+    elif kind == STATEMENTS:
+        statements = [ ]
+        for stmt in node.statements:
+            statements.append((yield _add(stmt, arena)))
+        start, count = arena.add_children(statements)
+        return arena.add(kind, start, count, **pos)
+    elif kind == PRINT or kind == RETURN:
+        value = yield _add(node.value, arena)
+        return arena.add(kind, value, **pos)
+    elif kind == CONST or kind == VAR:
+        value = (yield _add(node.value, arena)) if node.value else NONE
+        return arena.add(kind, lit(node.name), lit(node.type), value, **pos)
+    elif kind == ASSIGNMENT:
+        location = yield _add(node.location, arena)
+        value = yield _add(node.value, arena)
+        return arena.add(kind, location, value, **pos)
+    elif kind == IF:
+        test = yield _add(node.test, arena)
+        consequence = yield _add(node.consequence, arena)
+        alternative = (yield _add(node.alternative, arena)) if node.alternative else NONE
+        return arena.add(kind, test, consequence, alternative, **pos)
+    elif kind == WHILE:
+        test = yield _add(node.test, arena)
+        body = yield _add(node.body, arena)
+        return arena.add(kind, test, body, **pos)
+    elif kind == BREAK or kind == CONTINUE:
+        return arena.add(kind, **pos)
+    elif kind == FUNCDECL:
+        children = [ (yield _add(node.body, arena)) ]
+        for parm in node.parameters:
+            children.append((yield _add(parm, arena)))
+        start, count = arena.add_children(children)
+        return arena.add(kind, lit(node.name), lit(node.return_type), start, count, **pos)
+    elif kind == FUNCAPP:
+        func = yield _add(node.func, arena)
+        arguments = [ ]
+        for arg in node.arguments:
+            arguments.append((yield _add(arg, arena)))
+        start, count = arena.add_children(arguments)
+        return arena.add(kind, func, start, count, **pos)
+    elif kind == PARAMETER:
+        return arena.add(kind, lit(node.name), lit(node.type), **pos)
+
+def from_arena(arena, h):
+    '''
+    Rebuild the class-based model for the node with handle h.
+    '''
+    return trampoline(_build(arena, h))
+
+def _build(arena, h):
+    kind = arena.kinds[h]
+    a, b, c = arena.a[h], arena.b[h], arena.c[h]
+    lits = arena.literals
+    if kind in (INTEGER, FLOAT, BOOLEAN, CHARACTER, NAME):
+        node = node_classes[kind](lits[a])
+    elif kind == BINOP:
+        left = yield _build(arena, b)
+        right = yield _build(arena, c)
+        node = BinOp(lits[a], left, right)
+    elif kind == UNARYOP:
+        node = UnaryOp(lits[a], (yield _build(arena, b)))
+    elif kind == GROUPING or kind == EXPRSTMT or kind == COMPOUND or kind == PRINT or kind == RETURN:
+        node = node_classes[kind]((yield _build(arena, a)))
+    elif kind == STATEMENTS:
+        statements = [ ]
+        for child in arena.statements(h):
+            statements.append((yield _build(arena, child)))
+        node = Statements(statements)
+    elif kind == CONST or kind == VAR:
+        value = (yield _build(arena, c)) if c != NONE else None
+        node = node_classes[kind](lits[a], lits[b] if b != NONE else None, value)
+    elif kind == ASSIGNMENT:
+        location = yield _build(arena, a)
+        value = yield _build(arena, b)
+        node = Assignment(location, value)
+    elif kind == IF:
+        test = yield _build(arena, a)
+        consequence = yield _build(arena, b)
+        alternative = (yield _build(arena, c)) if c != NONE else None
+        node = IfStatement(test, consequence, alternative)
+    elif kind == WHILE:
+        test = yield _build(arena, a)
+        body = yield _build(arena, b)
+        node = WhileStatement(test, body)
+    elif kind == BREAK or kind == CONTINUE:
+        node = node_classes[kind]()
+    elif kind == FUNCDECL:
+        parameters = [ ]
+        for parm in arena.parameters(h):
+            parameters.append((yield _build(arena, parm)))
+        body = yield _build(arena, arena.body(h))
+        node = FunctionDeclaration(lits[a], parameters, lits[b], body)
+    elif kind == FUNCAPP:
+        func = yield _build(arena, a)
+        arguments = [ ]
+        for arg in arena.arguments(h):
+            arguments.append((yield _build(arena, arg)))
+        node = FunctionApplication(func, arguments)
+    elif kind == PARAMETER:
+        node = Parameter(lits[a], lits[b])
+    if arena.linenos[h]:
+        node.lineno = arena.linenos[h]
+        node.col = arena.cols[h] or None
+    return node
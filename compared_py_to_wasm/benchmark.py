@@ -0,0 +1,401 @@
+# benchmark.py
+#
+# Benchmarks for the compiler, phase by phase.  The programs are made
+# up by the generators below.  Each one is deterministic (the same
+# shape, size and seed always give the same program) and stresses one
+# thing:
+#
+#    functions     many small functions calling each other
+#    nesting       if/while statements nested size deep
+#    expressions   a few very long arithmetic expressions
+#    loops         loops with large bodies
+#
+# Every program is run through each phase on its own, timing just that
+# phase (the best of -repeat runs):
+#
+#    tokenize      tokenize_array()
+#    parse         parse_source() (which includes tokenizing)
+#    check         check_program()
+#    transform     transform()
+#    generate      generate_program()
+#
+# Each shape is run at several sizes (base size times 1, 2, 4, 8) and
+# the times are reported as throughput: tokens per second for
+# tokenize, and model nodes per second (nodes in the parsed program)
+# for the rest.  The "growth" of a phase is the exponent fitted to its
+# times across the sizes: about 1 means linear, about 2 means it's
+# quadratic somewhere.
+#
+#    python3 -m compared_py_to_wasm.benchmark                   # everything
+#    python3 -m compared_py_to_wasm.benchmark -quick loops      # just loops, two sizes
+#    python3 -m compared_py_to_wasm.benchmark -o results.json
+#    python3 -m compared_py_to_wasm.benchmark -baseline results.json
+#    python3 -m compared_py_to_wasm.benchmark -compare old.json new.json
+#    python3 -m compared_py_to_wasm.benchmark -dump nesting 10  # show a program
+#
+# -o writes the results as JSON.  With -baseline, the results are
+# compared against ones saved earlier, and any phase that got more than
+# -threshold (default 0.10, i.e. 10%) slower, or whose growth went up by
+# more than growth_threshold, is reported as a regression.  The exit
+# status is then 1, so it can be used in a build.  Times only compare
+# on the same machine, so make the baseline where it's used.
+
+import gc
+import json
+import math
+import platform
+import random
+import sys
+import time
+
+# Programs
+
+_generators = { }
+
+def generator(shape, base_size):
+    def register(func):
+        _generators[shape] = (func, base_size)
+        return func
+    return register
+
+def generate(shape, size, seed=0):
+    '''
+    Return the source of a program of the given shape and size.
+    '''
+    func, _ = _generators[shape]
+    return func(size, random.Random(seed))
+
+def shapes():
+    return list(_generators)
+
+def _leaf(rng, names):
+    if rng.random() < 0.5:
+        return rng.choice(names)
+    return str(rng.randint(0, 99))
+
+def _expression(rng, terms, names):
+    # A left-leaning chain of terms with some grouping along the way
+    expr = _leaf(rng, names)
+    for _ in range(terms - 1):
+        op = rng.choice('+-*/')
+        term = str(rng.randint(1, 9)) if op == '/' else _leaf(rng, names)
+        if rng.random() < 0.2:
+            expr = f'({expr} {op} {term})'
+        else:
+            expr = f'{expr} {op} {term}'
+    return expr
+
+@generator('functions', 200)
+def many_functions(size, rng):
+    lines = [ ]
+    for n in range(size):
+        lines.append(f'func f{n}(a int, b int) int {{')
+        lines.append(f'    var t int = {_expression(rng, 4, ["a", "b"])};')
+        lines.append(f'    if t > {rng.randint(0, 99)} {{')
+        lines.append(f'        t = t - b;')
+        lines.append(f'    }} else {{')
+        lines.append(f'        t = t + 1;')
+        lines.append(f'    }}')
+        if n:
+            lines.append(f'    t = t + f{rng.randrange(n)}(b, t / {rng.randint(1, 9)});')
+        lines.append(f'    return t;')
+        lines.append(f'}}')
+    lines.append(f'print f{size - 1}(1, 2);')
+    return '\n'.join(lines) + '\n'
+
+@generator('nesting', 200)
+def deep_nesting(size, rng):
+    # Not indented, which would make the source grow as size squared
+    lines = [ 'var x int = 0;' ]
+    for depth in range(size):
+        if depth % 2:
+            lines.append(f'while x < {depth + rng.randint(1, 9)} {{')
+            lines.append(f'x = x + 1;')
+        else:
+            lines.append(f'if x != {rng.randint(0, 99)} {{')
+        lines.append(f'var v{depth} int = x * {rng.randint(1, 9)};')
+    lines.append('print x;')
+    lines.extend('}' * size)
+    return '\n'.join(lines) + '\n'
+
+@generator('expressions', 500)
+def long_expressions(size, rng):
+    lines = [ 'var x int = 3;', 'var y int = 5;' ]
+    for n in range(4):
+        lines.append(f'var e{n} int = {_expression(rng, size, ["x", "y"])};')
+        lines.append(f'print e{n};')
+    return '\n'.join(lines) + '\n'
+
+@generator('loops', 400)
+def large_loops(size, rng):
+    lines = [ 'var total int = 0;', 'var i int = 0;', 'while i < 100 {' ]
+    for n in range(size):
+        if n % 8 == 7:
+            lines.append(f'    if total > {rng.randint(0, 999)} {{')
+            lines.append(f'        total = total / {rng.randint(2, 9)};')
+            lines.append(f'    }}')
+        else:
+            lines.append(f'    total = {_expression(rng, 3, ["total", "i"])};')
+    lines.append('    i = i + 1;')
+    lines.append('}')
+    lines.append('print total;')
+    return '\n'.join(lines) + '\n'
+
+# Phases.  Each is (setup, run): setup(source) makes the input for the
+# phase (untimed) and run(input) is what gets timed.
+
+def _parsed(source):
+    from .parse import parse_source
+    return parse_source(source)
+
+def _checked(source):
+    from .typecheck import check_program
+    model = _parsed(source)
+    if not check_program(model):
+        raise RuntimeError('Benchmark program has errors')
+    return model
+
+def _transformed(source):
+    from .transform import transform
+    return transform(_checked(source))
+
+def _tokenize(source):
+    from .tokenize import tokenize_array
+    return tokenize_array(source)
+
+def _check(model):
+    from .typecheck import check_program
+    return check_program(model)
+
+def _transform(model):
+    from .transform import transform
+    return transform(model)
+
+def _generate(model):
+    from .wasm import generate_program
+    return generate_program(model)
+
+phases = {
+    'tokenize': (str, _tokenize),
+    'parse': (str, _parsed),
+    'check': (_parsed, _check),
+    'transform': (_checked, _transform),
+    'generate': (_transformed, _generate),
+    }
+
+def count_nodes(model):
+    from .incremental import node_fields
+    from .model import Node
+    count = 0
+    stack = [ model ]
+    while stack:
+        node = stack.pop()
+        count += 1
+        for name in node_fields(type(node)):
+            value = getattr(node, name, None)
+            if isinstance(value, Node):
+                stack.append(value)
+            elif isinstance(value, list):
+                stack.extend(item for item in value if isinstance(item, Node))
+    return count
+
+def measure(setup, run, source, repeat):
+    '''
+    Best time (in seconds) of repeat runs of one phase.
+    '''
+    best = None
+    for _ in range(repeat):
+        data = setup(source)
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            run(data)
+            elapsed = time.perf_counter() - start
+        finally:
+            gc.enable()
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def growth(sizes, times):
+    '''
+    Least squares slope of log(time) against log(size).
+    '''
+    points = [ (math.log(size), math.log(t)) for size, t in zip(sizes, times) if t > 0 ]
+    if len(points) < 2:
+        return None
+    mx = sum(x for x, _ in points) / len(points)
+    my = sum(y for _, y in points) / len(points)
+    sxx = sum((x - mx) ** 2 for x, _ in points)
+    sxy = sum((x - mx) * (y - my) for x, y in points)
+    return round(sxy / sxx, 3)
+
+def run_shape(shape, scales=(1, 2, 4, 8), repeat=5, seed=0):
+    _, base_size = _generators[shape]
+    runs = [ ]
+    for scale in scales:
+        size = base_size * scale
+        source = generate(shape, size, seed)
+        counts = { 'tokens': len(_tokenize(source)), 'nodes': count_nodes(_parsed(source)) }
+        results = { }
+        for phase, (setup, run) in phases.items():
+            seconds = measure(setup, run, source, repeat)
+            unit = 'tokens' if phase == 'tokenize' else 'nodes'
+            results[phase] = {
+                'seconds': seconds,
+                'rate': counts[unit] / seconds if seconds else None,
+                'unit': f'{unit}/s',
+                }
+        runs.append({ 'size': size, 'bytes': len(source), **counts, 'phases': results })
+    sizes = [ run['size'] for run in runs ]
+    return {
+        'runs': runs,
+        'growth': { phase: growth(sizes, [ run['phases'][phase]['seconds'] for run in runs ])
+                    for phase in phases },
+        }
+
+def run_benchmarks(names=None, scales=(1, 2, 4, 8), repeat=5, seed=0, progress=None):
+    results = { }
+    for shape in names or shapes():
+        if progress:
+            progress(shape)
+        results[shape] = run_shape(shape, scales, repeat, seed)
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'repeat': repeat,
+        'seed': seed,
+        'shapes': results,
+        }
+
+# Comparing against a baseline
+
+default_threshold = 0.10
+growth_threshold = 0.25
+
+def compare(results, baseline, threshold=default_threshold):
+    '''
+    Compare results against baseline results.  Returns a list of
+    regressions as (shape, size, phase, old, new), where size is None
+    for a change in growth (old and new are then the growth exponents,
+    otherwise the times).  Runs that aren't in both are skipped.
+    '''
+    regressions = [ ]
+    for shape, result in results['shapes'].items():
+        base = baseline['shapes'].get(shape)
+        if base is None:
+            continue
+        base_runs = { run['size']: run for run in base['runs'] }
+        for run in result['runs']:
+            base_run = base_runs.get(run['size'])
+            if base_run is None:
+                continue
+            for phase, timing in run['phases'].items():
+                old = base_run['phases'].get(phase)
+                if old is not None and timing['seconds'] > old['seconds'] * (1 + threshold):
+                    regressions.append((shape, run['size'], phase, old['seconds'], timing['seconds']))
+        # Growth only means the same thing over the same sizes
+        if [ run['size'] for run in result['runs'] ] == [ run['size'] for run in base['runs'] ]:
+            for phase, new in result['growth'].items():
+                old = base['growth'].get(phase)
+                if old is not None and new is not None and new > old + growth_threshold:
+                    regressions.append((shape, None, phase, old, new))
+    return regressions
+
+def report(results, out=sys.stdout):
+    for shape, result in results['shapes'].items():
+        print(f"{shape:<12} {'size':>6} {'tokens':>8} {'nodes':>8}" +
+              ''.join(f' {phase:>11}' for phase in phases), file=out)
+        for run in result['runs']:
+            print(f"{'':<12} {run['size']:>6} {run['tokens']:>8} {run['nodes']:>8}" +
+                  ''.join(f" {run['phases'][phase]['seconds'] * 1000:>9.2f}ms" for phase in phases),
+                  file=out)
+        print(f"{'':<12} {'rate':>24}" +
+              ''.join(f" {_rate(result['runs'][-1]['phases'][phase]['rate']):>11}" for phase in phases),
+              file=out)
+        print(f"{'':<12} {'growth':>24}" +
+              ''.join(f" {_growth(result['growth'][phase]):>11}" for phase in phases), file=out)
+
+def _rate(rate):
+    if rate is None:
+        return '-'
+    return f'{rate / 1000:.0f}k/s' if rate < 1e6 else f'{rate / 1e6:.2f}M/s'
+
+def _growth(value):
+    return '-' if value is None else f'n^{value:.2f}'
+
+def report_regressions(regressions, threshold, out=sys.stdout):
+    if not regressions:
+        print(f'No regressions (threshold {threshold:.0%})', file=out)
+        return
+    for shape, size, phase, old, new in regressions:
+        if size is None:
+            print(f'REGRESSION {shape} {phase}: growth n^{old:.2f} -> n^{new:.2f}', file=out)
+        else:
+            print(f'REGRESSION {shape}/{size} {phase}: {old * 1000:.2f}ms -> {new * 1000:.2f}ms '
+                  f'({new / old - 1:+.0%})', file=out)
+
+def main(argv):
+    usage = ('Usage: python3 -m compared_py_to_wasm.benchmark [-quick] [-repeat N] [-o results.json]\n'
+             '           [-baseline baseline.json] [-threshold 0.1] [shape ...]\n'
+             '       python3 -m compared_py_to_wasm.benchmark -compare baseline.json results.json\n'
+             '       python3 -m compared_py_to_wasm.benchmark -dump shape size')
+    options = { '-o': None, '-baseline': None, '-threshold': default_threshold, '-repeat': 5 }
+    scales = (1, 2, 4, 8)
+    args = [ ]
+    argv = list(argv)
+    while argv:
+        arg = argv.pop(0)
+        if arg in options:
+            if not argv:
+                raise SystemExit(usage)
+            options[arg] = argv.pop(0)
+        elif arg == '-quick':
+            scales = (1, 2)
+        else:
+            args.append(arg)
+    try:
+        threshold = float(options['-threshold'])
+        repeat = int(options['-repeat'])
+    except ValueError:
+        raise SystemExit(usage)
+
+    if args[:1] == ['-dump']:
+        if len(args) != 3 or args[1] not in _generators or not args[2].isdigit():
+            raise SystemExit(usage)
+        print(generate(args[1], int(args[2])), end='')
+        return
+
+    if args[:1] == ['-compare']:
+        if len(args) != 3:
+            raise SystemExit(usage)
+        with open(args[1]) as file:
+            baseline = json.load(file)
+        with open(args[2]) as file:
+            results = json.load(file)
+    else:
+        unknown = [ arg for arg in args if arg not in _generators ]
+        if unknown or repeat < 1:
+            raise SystemExit(usage)
+        baseline = None
+        if options['-baseline']:
+            with open(options['-baseline']) as file:
+                baseline = json.load(file)
+        results = run_benchmarks(args, scales, repeat,
+                                 progress=lambda shape: print(f'Running {shape}...', file=sys.stderr))
+        report(results)
+        if options['-o']:
+            with open(options['-o'], 'w') as file:
+                json.dump(results, file, indent=2)
+            print(f"Wrote {options['-o']}")
+
+    if baseline is not None:
+        regressions = compare(results, baseline, threshold)
+        report_regressions(regressions, threshold)
+        if regressions:
+            raise SystemExit(1)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,290 @@
+# binary.py
+#
+# Encoder for the binary WebAssembly format.  This takes the module
+# built by wasm.generate_module() and turns it directly into the bytes
+# of a .wasm file, so no external assembler (wat2wasm, etc.) is needed.
+#
+# The instructions are the same ones that get written out as WAT text.
+# Each instruction is an (opcode, operand) tuple such as ('i32.const', 42)
+# or ('br', 'label3').  Names are resolved to indices here:
+# locals/params, globals, functions and branch labels.
+#
+# Reference: https://webassembly.github.io/spec/core/binary/index.html
+
+import struct
+
+_valtypes = {
+    'i32': 0x7f,
+    'i64': 0x7e,
+    'f32': 0x7d,
+    'f64': 0x7c,
+    }
+
+# Instructions without immediate operands
+_opcodes = {
+    'unreachable': 0x00,
+    'nop': 0x01,
+    'else': 0x05,
+    'end': 0x0b,
+    'return': 0x0f,
+    'drop': 0x1a,
+    'select': 0x1b,
+
+    'i32.eqz': 0x45,
+    'i32.eq': 0x46,
+    'i32.ne': 0x47,
+    'i32.lt_s': 0x48,
+    'i32.lt_u': 0x49,
+    'i32.gt_s': 0x4a,
+    'i32.gt_u': 0x4b,
+    'i32.le_s': 0x4c,
+    'i32.le_u': 0x4d,
+    'i32.ge_s': 0x4e,
+    'i32.ge_u': 0x4f,
+
+    'f64.eq': 0x61,
+    'f64.ne': 0x62,
+    'f64.lt': 0x63,
+    'f64.gt': 0x64,
+    'f64.le': 0x65,
+    'f64.ge': 0x66,
+
+    'i32.clz': 0x67,
+    'i32.ctz': 0x68,
+    'i32.popcnt': 0x69,
+    'i32.add': 0x6a,
+    'i32.sub': 0x6b,
+    'i32.mul': 0x6c,
+    'i32.div_s': 0x6d,
+    'i32.div_u': 0x6e,
+    'i32.rem_s': 0x6f,
+    'i32.rem_u': 0x70,
+    'i32.and': 0x71,
+    'i32.or': 0x72,
+    'i32.xor': 0x73,
+    'i32.shl': 0x74,
+    'i32.shr_s': 0x75,
+    'i32.shr_u': 0x76,
+
+    'f64.abs': 0x99,
+    'f64.neg': 0x9a,
+    'f64.ceil': 0x9b,
+    'f64.floor': 0x9c,
+    'f64.trunc': 0x9d,
+    'f64.nearest': 0x9e,
+    'f64.sqrt': 0x9f,
+    'f64.add': 0xa0,
+    'f64.sub': 0xa1,
+    'f64.mul': 0xa2,
+    'f64.div': 0xa3,
+    'f64.min': 0xa4,
+    'f64.max': 0xa5,
+
+    'i32.trunc_f64_s': 0xaa,
+    'i32.trunc_s/f64': 0xaa,
+    'f64.convert_i32_s': 0xb7,
+    'f64.convert_s/i32': 0xb7,
+    }
+
+# Structured control instructions.  All blocks generated by the compiler
+# are empty-typed (no parameters and no results).
+_blocks = {
+    'block': 0x02,
+    'loop': 0x03,
+    'if': 0x04,
+    }
+_EMPTY_BLOCK = 0x40
+
+_branches = {
+    'br': 0x0c,
+    'br_if': 0x0d,
+    }
+
+_variables = {
+    'local.get': 0x20,
+    'local.set': 0x21,
+    'local.tee': 0x22,
+    'global.get': 0x23,
+    'global.set': 0x24,
+    }
+
+# LEB128 encoding of integers
+def encode_unsigned(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+def encode_signed(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if (value == 0 and not byte & 0x40) or (value == -1 and byte & 0x40):
+            out.append(byte)
+            return bytes(out)
+        out.append(byte | 0x80)
+
+def encode_f64(value):
+    return struct.pack('<d', value)
+
+def encode_name(name):
+    data = name.encode('utf-8')
+    return encode_unsigned(len(data)) + data
+
+def encode_vector(items):
+    return encode_unsigned(len(items)) + b''.join(items)
+
+def encode_section(sectid, items):
+    content = encode_vector(items)
+    return bytes([sectid]) + encode_unsigned(len(content)) + content
+
+def encode_functype(params, results):
+    return (b'\x60'
+            + encode_vector([bytes([_valtypes[t]]) for t in params])
+            + encode_vector([bytes([_valtypes[t]]) for t in results]))
+
+def wrap_i32(value):
+    # i32 constants are stored signed.  Wrap anything outside that range
+    # (e.g. 4294967295) the same way a text assembler would.  wasm.py
+    # wraps int literals with this when it generates them.
+    return ((value + 0x80000000) & 0xffffffff) - 0x80000000
+
+def _index(symbols, operand, kind):
+    if operand in symbols:
+        return symbols[operand]
+    if type(operand) is int:
+        return operand
+    raise RuntimeError(f'Unknown {kind} {operand}')
+
+def encode_code(code, localnames, globalnames, funcnames):
+    '''
+    Encode a list of instructions into a binary expression.
+    The implicit function block is not included in code, so the
+    trailing 'end' is added here.
+    '''
+    out = bytearray()
+    labels = [ ]            # Open blocks, innermost last
+    positions = { }         # label -> positions in labels
+    for op, operand in code:
+        if op in _opcodes:
+            out.append(_opcodes[op])
+            if op == 'end':
+                label = labels.pop()
+                if label is not None:
+                    positions[label].pop()
+        elif op == 'i32.const':
+            out.append(0x41)
+            out += encode_signed(operand)
+        elif op == 'f64.const':
+            out.append(0x44)
+            out += encode_f64(operand)
+        elif op in _variables:
+            out.append(_variables[op])
+            symbols = localnames if op.startswith('local') else globalnames
+            out += encode_unsigned(_index(symbols, operand, op.split('.')[0]))
+        elif op in _blocks:
+            out.append(_blocks[op])
+            out.append(_EMPTY_BLOCK)
+            if operand is not None:
+                positions.setdefault(operand, []).append(len(labels))
+            labels.append(operand)
+        elif op in _branches:
+            out.append(_branches[op])
+            if type(operand) is int:
+                depth = operand
+            elif positions.get(operand):
+                depth = len(labels) - 1 - positions[operand][-1]
+            else:
+                raise RuntimeError(f'Unknown label {operand}')
+            out += encode_unsigned(depth)
+        elif op == 'call':
+            out.append(0x10)
+            out += encode_unsigned(_index(funcnames, operand, 'function'))
+        else:
+            raise RuntimeError(f"Can't encode instruction {op} {operand!r}")
+    out.append(0x0b)
+    return bytes(out)
+
+def encode_locals(localtypes):
+    # Locals are stored as runs of (count, type)
+    runs = [ ]
+    for ltype in localtypes:
+        if runs and runs[-1][1] == ltype:
+            runs[-1][0] += 1
+        else:
+            runs.append([1, ltype])
+    return encode_vector([encode_unsigned(count) + bytes([_valtypes[ltype]])
+                          for count, ltype in runs])
+
+def encode_function_body(func, globalnames, funcnames):
+    from .wasm import _typemap
+    localnames = { }
+    for parm in func.parameters:
+        localnames[parm.name] = len(localnames)
+    localtypes = [ ]
+    if func.ret_type and func.wrapped:
+        localtypes.append(_typemap[func.ret_type])
+        localnames['return'] = len(localnames)
+    for name, ltype in func.locals:
+        localtypes.append(ltype)
+        localnames[name] = len(localnames)
+
+    # Same layout as the text output in WasmFunction.__str__
+    code = func.code
+    if func.wrapped:
+        code = [('block', 'return'), *code, ('end', None)]
+        if func.ret_type:
+            code.append(('local.get', 'return'))
+    body = encode_locals(localtypes) + encode_code(code, localnames, globalnames, funcnames)
+    return encode_unsigned(len(body)) + body
+
+def encode_module(mod):
+    from .wasm import _typemap
+    types = [ ]
+    def typeidx(params, results):
+        sig = encode_functype(params, results)
+        if sig not in types:
+            types.append(sig)
+        return types.index(sig)
+
+    funcnames = { }
+    imports = [ ]
+    for name, ptype in mod.imports:
+        funcnames[name] = len(funcnames)
+        imports.append(encode_name('env') + encode_name(name)
+                       + b'\x00' + encode_unsigned(typeidx([ptype], [])))
+
+    functions = [ ]
+    exports = [ ]
+    for func in mod.functions:
+        funcnames[func.name] = len(funcnames)
+        params = [_typemap[p.type] for p in func.parameters]
+        results = [_typemap[func.ret_type]] if func.ret_type else []
+        functions.append(encode_unsigned(typeidx(params, results)))
+        exports.append(encode_name(func.name) + b'\x00' + encode_unsigned(funcnames[func.name]))
+
+    globalnames = { }
+    globals_ = [ ]
+    for name, gtype in mod.globals:
+        globalnames[name] = len(globalnames)
+        if gtype == 'f64':
+            init = b'\x44' + encode_f64(0.0)
+        else:
+            init = b'\x41' + encode_signed(0)
+        globals_.append(bytes([_valtypes[gtype], 0x01]) + init + b'\x0b')
+
+    codes = [encode_function_body(func, globalnames, funcnames) for func in mod.functions]
+
+    return (b'\x00asm' + b'\x01\x00\x00\x00'
+            + encode_section(1, types)
+            + encode_section(2, imports)
+            + encode_section(3, functions)
+            + encode_section(6, globals_)
+            + encode_section(7, exports)
+            + encode_section(10, codes))
@@ -0,0 +1,258 @@
+# cache.py
+#
+# On-disk cache of compiled programs.  Each result is stored under a
+# key that is a hash of everything it depends on: the source text, the
+# settings it was compiled with (backend, optimize ...) and the
+# compiler itself.  The same source compiled the same way always gets
+# the same key, so a build that recompiles mostly unchanged files is
+# mostly hashing and reading files from the cache.
+#
+#     cache = Cache('.wabbit-cache')
+#     key = cache.key(source, backend='wasm', optimize=True)
+#     data = cache.get(key)
+#     if data is None:
+#         data = ...
+#         cache.put(key, data)
+#
+# Entries are files named by their key, in subdirectories named by the
+# first two characters of the key (so no one directory gets too big).
+# A file is written to a temporary name and then renamed, so a reader
+# (another process sharing the cache) never sees half an entry.
+#
+# The cache is bounded in size.  When it grows past max_size bytes, the
+# least recently used entries are removed until it is back under
+# low_water of the limit.  Reading an entry updates its modification
+# time, which is what "recently used" goes by.
+#
+# MemoryCache has the same interface but keeps the entries in memory,
+# for a long-running program that compiles the same code many times.
+# It can be shared between threads.
+
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+default_directory = '.wabbit-cache'
+default_max_size = 256 * 1024 * 1024
+low_water = 0.9
+
+_fingerprint = None
+
+def compiler_fingerprint():
+    '''
+    Hash of the compiler's own source files.  It goes into every key so
+    that a changed compiler never gets results from an old one.
+    '''
+    global _fingerprint
+    if _fingerprint is None:
+        digest = hashlib.sha256()
+        package = os.path.dirname(os.path.abspath(__file__))
+        for name in sorted(os.listdir(package)):
+            if name.endswith('.py'):
+                digest.update(name.encode('utf-8') + b'\0')
+                with open(os.path.join(package, name), 'rb') as file:
+                    digest.update(file.read())
+        _fingerprint = digest.hexdigest()
+    return _fingerprint
+
+def source_key(source, **settings):
+    '''
+    Key for source (str or bytes) compiled with the given settings.
+    '''
+    if isinstance(source, str):
+        source = source.encode('utf-8')
+    digest = hashlib.sha256()
+    digest.update(compiler_fingerprint().encode('ascii'))
+    for name in sorted(settings):
+        digest.update(f'\0{name}={settings[name]!r}'.encode('utf-8'))
+    digest.update(b'\0\0')
+    digest.update(source)
+    return digest.hexdigest()
+
+class Cache:
+    def __init__(self, directory=default_directory, max_size=default_max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.size = None            # Bytes in the cache (found on first put)
+
+    def key(self, source, **settings):
+        return source_key(source, **settings)
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        '''
+        Return the data stored under key, or None if it's not in the cache.
+        '''
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass                    # Evicted by someone else in the meantime
+        return data
+
+    def put(self, key, data):
+        '''
+        Store data (bytes or str) under key, evicting old entries if the
+        cache gets too big.
+        '''
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # A temporary file of its own (other threads or processes might
+        # be storing the same key)
+        fd, temp = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(data)
+            try:
+                old_size = os.path.getsize(path)
+            except OSError:
+                old_size = 0
+            os.replace(temp, path)
+        except BaseException:
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+            raise
+        if self.size is None:
+            self.size = sum(size for _, size, _ in self.entries())
+        else:
+            self.size += len(data) - old_size
+        if self.size > self.max_size:
+            self.evict()
+
+    def entries(self):
+        '''
+        List the entries in the cache as (mtime, size, path).
+        '''
+        entries = [ ]
+        if not os.path.isdir(self.directory):
+            return entries
+        for sub in os.scandir(self.directory):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def evict(self):
+        '''
+        Remove the least recently used entries until the cache is under
+        low_water of max_size.
+        '''
+        entries = self.entries()
+        entries.sort()
+        size = sum(size for _, size, _ in entries)
+        target = self.max_size * low_water
+        for mtime, entry_size, path in entries:
+            if size <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+        self.size = size
+
+    def clear(self):
+        for _, _, path in self.entries():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.size = 0
+
+class MemoryCache:
+    '''
+    In-memory LRU cache, bounded by the number of entries and by their
+    total size in bytes (the length of the str or bytes stored).  Keeps
+    counts of hits, misses and evictions.
+    '''
+    def __init__(self, max_entries=1024, max_size=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.table = OrderedDict()      # key -> data, least recently used first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def key(self, source, **settings):
+        return source_key(source, **settings)
+
+    def get(self, key):
+        with self.lock:
+            data = self.table.get(key)
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.table.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        size = len(data)
+        if size > self.max_size:
+            return                      # Would push everything else out
+        with self.lock:
+            old = self.table.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.table[key] = data
+            self.size += size
+            while len(self.table) > self.max_entries or self.size > self.max_size:
+                _, evicted = self.table.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.table.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.table),
+                'size': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                }
+
+    def __len__(self):
+        return len(self.table)
+
+# Main program: show what's in a cache (or clear it)
+def main(argv):
+    clear = '-clear' in argv
+    args = [arg for arg in argv if arg != '-clear']
+    if len(args) > 1:
+        raise SystemExit('Usage: python3 -m wabbit.cache [-clear] [directory]')
+    cache = Cache(args[0] if args else default_directory)
+    if clear:
+        cache.clear()
+    entries = cache.entries()
+    print(f'{cache.directory}: {len(entries)} entries, {sum(size for _, size, _ in entries)} bytes')
+
+if __name__ == '__main__':
+    import sys
+    main(sys.argv[1:])
@@ -1,7 +1,245 @@
 # compile.py
 #
-# Make a nice top-level 'compile' command for your project here.
-# For example:
+# Top-level 'compile' command.  Runs a Wabbit program through the
+# front end (parse, typecheck and the optimizations in transform.py)
+# and then hands it to one of the backends:
 #
-#    python3 -m wabbit.compile -wasm prog.py
+#    python3 -m compared_py_to_wasm.compile -wat prog.wb     # writes out.wat
+#    python3 -m compared_py_to_wasm.compile -wasm prog.wb    # writes out.wasm
+#    python3 -m compared_py_to_wasm.compile -interp prog.wb  # runs the closure interpreter
+#    python3 -m compared_py_to_wasm.compile -vm prog.wb      # runs the bytecode VM
+#
+# Give -O0 as well to turn the optimizations off, and -cache to keep
+# the WAT/wasm output in an on-disk cache (see cache.py) so that
+# compiling an unchanged file again just reads the result back.
+#
+# Given more than one file, or a directory (searched for .wb files), it
+# compiles them all in a pool of worker processes, writing prog.wat or
+# prog.wasm next to each prog.wb:
+#
+#    python3 -m compared_py_to_wasm.compile -wasm -j8 progs/ more.wb
+#
+# -jN sets the number of workers (the default is one per CPU).  A file
+# with errors is reported and the rest of the batch goes on.
+
+import os
+
+backends = ('wat', 'wasm', 'interp', 'vm')
+
+def compile_model(model, backend='wat', optimize=True):
+    '''
+    Run a parsed program through the type checker and optimizer, and
+    generate the WAT text (str) or binary module (bytes) for it.
+    Returns None if the program has errors.
+    '''
+    from .typecheck import check_program
+    if not check_program(model):
+        return None
+    if optimize:
+        from .transform import transform
+        model = transform(model)
+    if backend == 'wat':
+        from .wasm import generate_program
+        return generate_program(model, optimize)
+    elif backend == 'wasm':
+        from .wasm import generate_binary
+        return generate_binary(model, optimize)
+    raise ValueError(f'Unknown backend {backend!r}')
+
+def compile_source(source, backend='wat', optimize=True, cache=None):
+    '''
+    Compile source (str or bytes) to WAT text or a binary module.  If a
+    cache is given (a cache.Cache on disk or a cache.MemoryCache), the
+    result is looked up there first, keyed on the source and the
+    settings, and stored there after compiling.
+    Programs with errors aren't cached (so the errors get reported
+    every time).
+    '''
+    if cache is not None:
+        key = cache.key(source, backend=backend, optimize=optimize)
+        data = cache.get(key)
+        if data is not None:
+            # The disk cache gives back bytes for WAT text too
+            if backend == 'wat' and isinstance(data, bytes):
+                data = data.decode('utf-8')
+            return data
+    from .parse import parse_source, parse_buffer
+    model = parse_source(source) if isinstance(source, str) else parse_buffer(source)
+    output = compile_model(model, backend, optimize)
+    if output is not None and cache is not None:
+        cache.put(key, output)
+    return output
+
+def check_source(source, cache=None):
+    '''
+    Parse and type check source.  Returns True if it has no errors.
+    A pass is cached like the output of compile_source() (and a fail
+    isn't, so the errors are reported again).
+    '''
+    if cache is not None:
+        key = cache.key(source, check=True)
+        if cache.get(key) is not None:
+            return True
+    from .parse import parse_source, parse_buffer
+    from .typecheck import check_program
+    model = parse_source(source) if isinstance(source, str) else parse_buffer(source)
+    ok = check_program(model)
+    if ok and cache is not None:
+        cache.put(key, b'1')
+    return ok
+
+def compile_file(filename, backend='wat', optimize=True, cache=None):
+    if backend in ('wat', 'wasm'):
+        with open(filename, 'rb') as file:
+            source = file.read()
+        output = compile_source(source, backend, optimize, cache)
+        if output is None:
+            return False
+        outname = f'out.{backend}'
+        write_output(outname, output)
+        print(f'Wrote {outname}')
+        return True
+    from .parse import parse_file
+    from .typecheck import check_program
+    model = parse_file(filename)
+    if not check_program(model):
+        return False
+    if optimize:
+        from .transform import transform
+        model = transform(model)
+    if backend == 'interp':
+        from .interp import interpret_program
+        interpret_program(model)
+    elif backend == 'vm':
+        from .vm import compile_program, run
+        run(compile_program(model))
+    else:
+        raise ValueError(f'Unknown backend {backend!r}')
+    return True
+
+def write_output(outname, output):
+    with open(outname, 'w' if isinstance(output, str) else 'wb') as file:
+        file.write(output)
+
+# Batch compiling
+
+def find_sources(paths):
+    '''
+    Expand directories in paths into the .wb files under them (sorted,
+    so a batch always goes in the same order).
+    '''
+    sources = [ ]
+    for path in paths:
+        if os.path.isdir(path):
+            found = [ ]
+            for dirpath, dirnames, filenames in os.walk(path):
+                found.extend(os.path.join(dirpath, name) for name in filenames
+                             if name.endswith('.wb'))
+            sources.extend(sorted(found))
+        else:
+            sources.append(path)
+    return sources
+
+def output_name(filename, backend):
+    return os.path.splitext(filename)[0] + '.' + backend
+
+def compile_job(job):
+    '''
+    Compile one file of a batch (in a worker process).  Returns
+    (filename, outname, messages) with outname None if it failed.  The
+    error messages the compiler prints are collected in messages.
+    '''
+    import io
+    from contextlib import redirect_stdout
+    filename, backend, optimize, cache = job
+    messages = io.StringIO()
+    outname = None
+    try:
+        with redirect_stdout(messages):
+            with open(filename, 'rb') as file:
+                source = file.read()
+            output = compile_source(source, backend, optimize, cache)
+        if output is not None:
+            outname = output_name(filename, backend)
+            write_output(outname, output)
+    except Exception as err:
+        messages.write(f'{type(err).__name__}: {err}\n')
+    return filename, outname, messages.getvalue()
+
+def compile_batch(paths, backend='wat', optimize=True, cache=None, jobs=None):
+    '''
+    Compile all the files in paths (directories are searched for .wb
+    files) using jobs worker processes.  Results are reported in the
+    order of the files, whatever order the workers finish in.  Returns
+    the number of files that failed.
+    With more than one job, the cache has to be an on-disk cache.Cache
+    (the workers share it through the files).  A MemoryCache only works
+    with jobs=1.
+    '''
+    from .cache import Cache
+    if backend not in ('wat', 'wasm'):
+        raise ValueError(f"Can't batch compile with backend {backend!r}")
+    sources = find_sources(paths)
+    jobs = min(jobs or os.cpu_count() or 1, max(len(sources), 1))
+    if jobs > 1 and cache is not None and not isinstance(cache, Cache):
+        raise ValueError('Only an on-disk Cache can be shared by the worker processes')
+    work = [ (filename, backend, optimize, cache) for filename in sources ]
+    if jobs == 1:
+        results = map(compile_job, work)
+        return report_batch(results)
+    from concurrent.futures import ProcessPoolExecutor
+    # Hand out the files in chunks (a few per worker) to cut down on
+    # the traffic between processes
+    chunksize = max(1, len(work) // (jobs * 4))
+    with ProcessPoolExecutor(jobs) as pool:
+        return report_batch(pool.map(compile_job, work, chunksize=chunksize))
+
+def report_batch(results):
+    failed = 0
+    for filename, outname, messages in results:
+        for line in messages.splitlines():
+            print(f'{filename}: {line}')
+        if outname is None:
+            failed += 1
+            print(f'{filename}: failed')
+        else:
+            print(f'Wrote {outname}')
+    return failed
+
+def main(argv):
+    usage = f"Usage: python3 -m compared_py_to_wasm.compile [-O0] [-cache] [-jN] [{' | '.join('-' + b for b in backends)}] filename ..."
+    backend = 'wat'
+    optimize = True
+    cache = None
+    jobs = None
+    args = [ ]
+    for arg in argv:
+        if arg == '-O0':
+            optimize = False
+        elif arg == '-cache':
+            from .cache import Cache
+            cache = Cache()
+        elif arg.startswith('-j'):
+            if not arg[2:].isdigit() or int(arg[2:]) < 1:
+                raise SystemExit(usage)
+            jobs = int(arg[2:])
+        elif arg.startswith('-'):
+            if arg[1:] not in backends:
+                raise SystemExit(usage)
+            backend = arg[1:]
+        else:
+            args.append(arg)
+    if not args:
+        raise SystemExit(usage)
+    if len(args) > 1 or os.path.isdir(args[0]):
+        if backend not in ('wat', 'wasm'):
+            raise SystemExit(usage)
+        if compile_batch(args, backend, optimize, cache, jobs):
+            raise SystemExit(1)
+        return
+    if not compile_file(args[0], backend, optimize, cache):
+        raise SystemExit(1)
 
+if __name__ == '__main__':
+    import sys
+    main(sys.argv[1:])
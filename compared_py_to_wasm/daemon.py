@@ -0,0 +1,294 @@
+# daemon.py
+#
+# Compile server.  Starting a new Python and importing the compiler
+# for every compile costs more than compiling a small program, so this
+# keeps the compiler loaded and takes requests over a Unix socket, or
+# over stdin/stdout (as pipes):
+#
+#    python3 -m compared_py_to_wasm.daemon -serve /tmp/wabbit.sock [-jN]
+#    python3 -m compared_py_to_wasm.daemon -stdio [-jN]
+#
+# Requests and responses are JSON, one object per line:
+#
+#    {"id": 1, "source": "print 1;", "backend": "wasm", "optimize": true}
+#    {"id": 1, "ok": true, "diagnostics": [], "output": "AGFzbQEAAAAB..."}
+#
+# "backend" is "wat" (the default) or "wasm", and "optimize" defaults
+# to true.  The output is the WAT text, or the binary module in base64,
+# or null if the program has errors.  Each diagnostic is {"line": N,
+# "message": "..."} (line is null if there isn't one).  A request that
+# can't be understood gets {"id": ..., "ok": false, "error": "..."}.
+#
+# Requests on a connection are handled at the same time, so responses
+# can come back in a different order (match them up by id).  The
+# compiles run in a pool of -jN worker processes (one per CPU by
+# default).  At most max_pending requests are in progress at once.
+# Past that, the server stops reading requests until some finish, so
+# a client sending faster than it can compile gets held back instead
+# of piling up work in memory.  Results are kept in a MemoryCache, so
+# compiling the same source again doesn't go to the pool at all.
+#
+# Client is a small client for the socket:
+#
+#    with Client('/tmp/wabbit.sock') as client:
+#        response = client.compile(source, backend='wasm')
+#
+#    python3 -m compared_py_to_wasm.daemon -connect /tmp/wabbit.sock [-wat | -wasm] [-O0] prog.wb
+
+import asyncio
+import base64
+import json
+import os
+import socket
+import stat
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from .cache import MemoryCache
+
+max_pending = 64
+max_line = 64 * 1024 * 1024     # Longest request (or response) line
+
+def compile_request(source, backend, optimize):
+    '''
+    Compile source (in a worker process).  Returns (ok, diagnostics,
+    output) ready to go in a response.
+    '''
+    import io
+    from contextlib import redirect_stdout
+    from .compile import compile_source
+    messages = io.StringIO()
+    output = None
+    try:
+        with redirect_stdout(messages):
+            output = compile_source(source, backend, optimize)
+    except Exception as err:
+        messages.write(f'{err}\n')
+    diagnostics = [ diagnostic(line) for line in messages.getvalue().splitlines() ]
+    if isinstance(output, bytes):
+        output = base64.b64encode(output).decode('ascii')
+    return output is not None, diagnostics, output
+
+def diagnostic(message):
+    # The compiler's messages are "lineno: message" (mostly)
+    lineno, sep, text = message.partition(': ')
+    if sep and lineno.isdigit():
+        return { 'line': int(lineno), 'message': text }
+    return { 'line': None, 'message': message }
+
+def warm_up():
+    # Import the compiler in each worker before the first request
+    from . import compile, parse, typecheck, transform, wasm, binary, peephole
+
+class CompileServer:
+    def __init__(self, jobs=None, max_pending=max_pending, cache=None):
+        self.pool = ProcessPoolExecutor(jobs, initializer=warm_up)
+        self.pending = asyncio.Semaphore(max_pending)
+        self.cache = MemoryCache() if cache is None else cache
+
+    def close(self):
+        self.pool.shutdown()
+
+    async def handle(self, reader, writer):
+        '''
+        Serve the requests on one connection until it's closed.
+        '''
+        lock = asyncio.Lock()           # One response written at a time
+        tasks = set()
+        try:
+            while True:
+                await self.pending.acquire()
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # Longer than max_line.  There's no telling where the
+                    # next request starts, so give up on the connection.
+                    self.pending.release()
+                    break
+                if not line:
+                    self.pending.release()
+                    break
+                task = asyncio.create_task(self.respond(line, writer, lock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+        finally:
+            writer.close()
+
+    async def respond(self, line, writer, lock):
+        try:
+            response = await self.run(line)
+            async with lock:
+                writer.write(response.encode('utf-8') + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass                        # The client went away
+        finally:
+            self.pending.release()
+
+    async def run(self, line):
+        '''
+        Handle one request line.  Returns the response (JSON text).
+        '''
+        request = None
+        try:
+            request = json.loads(line)
+            request_id = request.get('id')
+            source = request['source']
+            backend = request.get('backend', 'wat')
+            optimize = bool(request.get('optimize', True))
+            if not isinstance(source, str):
+                raise TypeError('source has to be a string')
+            if backend not in ('wat', 'wasm'):
+                raise ValueError(f'Unknown backend {backend!r}')
+        except (ValueError, KeyError, TypeError, AttributeError) as err:
+            request_id = request.get('id') if isinstance(request, dict) else None
+            return json.dumps({ 'id': request_id, 'ok': False, 'error': f'Bad request: {err}' })
+        # The cache holds the rest of the response after the id
+        key = self.cache.key(source, backend=backend, optimize=optimize)
+        body = self.cache.get(key)
+        if body is None:
+            loop = asyncio.get_running_loop()
+            ok, diagnostics, output = await loop.run_in_executor(self.pool, compile_request,
+                                                                 source, backend, optimize)
+            body = json.dumps({ 'ok': ok, 'diagnostics': diagnostics, 'output': output })[1:-1]
+            self.cache.put(key, body)
+        return f'{{"id": {json.dumps(request_id)}, {body}}}'
+
+async def serve_socket(path, jobs=None):
+    # Clear away the socket left by a server that has stopped
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+    server = CompileServer(jobs)
+    try:
+        listener = await asyncio.start_unix_server(server.handle, path, limit=max_line)
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        server.close()
+
+class FileWriter:
+    '''
+    Stands in for a StreamWriter when the output is a regular file
+    (which asyncio can't write to without blocking anyway).
+    '''
+    def __init__(self, file):
+        self.file = file
+
+    def write(self, data):
+        self.file.write(data)
+
+    async def drain(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.flush()
+
+async def serve_stdio(jobs=None):
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=max_line)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    try:
+        transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, sys.stdout)
+        writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+    except ValueError:
+        writer = FileWriter(sys.stdout.buffer)     # Output to a file
+    server = CompileServer(jobs)
+    try:
+        await server.handle(reader, writer)
+    finally:
+        server.close()
+
+class Client:
+    '''
+    Client for a server on a Unix socket.  The output of a wasm compile
+    comes back as bytes.
+    '''
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.file = self.sock.makefile('rwb')
+        self.next_id = 0
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def compile(self, source, backend='wat', optimize=True):
+        return self.compile_many([ source ], backend, optimize)[0]
+
+    def compile_many(self, sources, backend='wat', optimize=True):
+        '''
+        Send all the sources and then wait for all the responses, so the
+        server works on them at the same time.  Returns the responses
+        in the same order as the sources.
+        '''
+        ids = [ ]
+        for source in sources:
+            self.next_id += 1
+            ids.append(self.next_id)
+            request = { 'id': self.next_id, 'source': source, 'backend': backend, 'optimize': optimize }
+            self.file.write(json.dumps(request).encode('utf-8') + b'\n')
+        self.file.flush()
+        responses = { }
+        while len(responses) < len(ids):
+            line = self.file.readline()
+            if not line:
+                raise ConnectionError('Server closed the connection')
+            response = json.loads(line)
+            if backend == 'wasm' and response.get('output') is not None:
+                response['output'] = base64.b64decode(response['output'])
+            responses[response['id']] = response
+        return [ responses[request_id] for request_id in ids ]
+
+def main(argv):
+    usage = ('Usage: python3 -m compared_py_to_wasm.daemon -serve path [-jN]\n'
+             '       python3 -m compared_py_to_wasm.daemon -stdio [-jN]\n'
+             '       python3 -m compared_py_to_wasm.daemon -connect path [-wat | -wasm] [-O0] filename')
+    jobs = None
+    backend = 'wat'
+    optimize = True
+    args = [ ]
+    for arg in argv:
+        if arg.startswith('-j') and arg[2:].isdigit() and int(arg[2:]) >= 1:
+            jobs = int(arg[2:])
+        elif arg in ('-wat', '-wasm'):
+            backend = arg[1:]
+        elif arg == '-O0':
+            optimize = False
+        else:
+            args.append(arg)
+    if args[:1] == ['-serve'] and len(args) == 2:
+        try:
+            asyncio.run(serve_socket(args[1], jobs))
+        except KeyboardInterrupt:
+            pass
+    elif args == ['-stdio']:
+        asyncio.run(serve_stdio(jobs))
+    elif args[:1] == ['-connect'] and len(args) == 3:
+        with open(args[2]) as file:
+            source = file.read()
+        with Client(args[1]) as client:
+            response = client.compile(source, backend, optimize)
+        for diag in response.get('diagnostics', ()):
+            print(f"{diag['line']}: {diag['message']}" if diag['line'] is not None else diag['message'])
+        if not response.get('ok'):
+            raise SystemExit(response.get('error', 1))
+        outname = f'out.{backend}'
+        with open(outname, 'w' if backend == 'wat' else 'wb') as file:
+            file.write(response['output'])
+        print(f'Wrote {outname}')
+    else:
+        raise SystemExit(usage)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,430 @@
+# incremental.py
+#
+# Incremental front end for editors.  A Document holds the text of a
+# program along with its tokens, its top-level statements and the
+# results of checking them.  An edit replaces some characters of the
+# text with others:
+#
+#     doc = Document(text)
+#     doc.edit(offset, removed, inserted)
+#     for lineno, message in doc.diagnostics():
+#         ...
+#
+# After an edit, only the text around it is scanned again, only the
+# top-level statements (a whole function, say) that the new tokens fall
+# in are parsed again, and only the statements whose code or whose
+# environment changed are checked again.  Everything else is reused.
+#
+# Scanning
+# --------
+# Scanning starts again at the end of the last token before the edit
+# (the end of a token is never inside a comment or a character
+# literal).  It goes on until it gets to a token that was there before
+# the edit, in the same place once moved by the size of the edit.  The
+# scanner keeps no state from one token to the next, so from there on
+# the tokens are the old ones, moved along (see tokenize.scan_into()).
+#
+# Moving every token after the edit would take time in proportion to
+# the size of the file on every keystroke.  So the tokens are kept in
+# an EditableTokens, which moves them lazily: the tokens after the last
+# edit hold offsets and line numbers that are out by an amount that it
+# adds on when they are read.  Typing in one place just adds to that
+# amount.  An edit before the tokens that are out moves them all.
+#
+# Parsing
+# -------
+# Each top-level statement is kept as a Part that remembers the tokens
+# it was parsed from.  Parsing starts again with the first statement
+# that takes in (or looked ahead at) a new token.  It goes on until it
+# ends exactly where an old statement after the edit starts, and the
+# statements from there on are reused.  Their nodes' line numbers are
+# fixed up lazily: each part keeps a count of lines to move by, applied
+# when the node is needed again.
+#
+# A syntax error leaves a gap (a part with no node) from the statement
+# that failed to the next old statement.  The next edit parses the gap
+# again along with the new tokens.
+#
+# Checking
+# --------
+# Checking a top-level statement depends on the definitions (globals
+# and functions) made by the statements before it, and adds
+# definitions of its own.  Each part records the definitions it was
+# checked with (as a key chained through the statements before it),
+# its errors and its own definitions.  A part that hasn't changed and
+# comes after the same definitions as before gets its old results.
+#
+# Text that isn't pure ASCII is tokenized by the slow scanner, which
+# doesn't keep offsets, so a Document holding it is built again from
+# scratch after each edit.
+
+from bisect import bisect_left
+from itertools import islice
+from .model import *
+from .tokenize import TokenArray, tokenize_array, scan_into
+from .parse import Tokens, parse_statement, EOF, BLOCK_END
+from .typecheck import CheckContext, define_types, check
+from .trampoline import trampoline
+
+class EditableTokens(TokenArray):
+    '''
+    A TokenArray (of ASCII text) where the tokens from split on have
+    offsets delta less and line numbers lines less than they should.
+    Read positions with start(), end(), lineno() and column().
+    '''
+    def __init__(self, source):
+        super().__init__(source)
+        self.split = 0
+        self.delta = 0
+        self.lines = 0
+
+    def start(self, n):
+        return self.starts[n] + self.delta if n >= self.split else self.starts[n]
+
+    def end(self, n):
+        return self.ends[n] + self.delta if n >= self.split else self.ends[n]
+
+    def lineno(self, n):
+        return self.linenos[n] + self.lines if n >= self.split else self.linenos[n]
+
+    def value(self, n):
+        return self.source[self.start(n):self.end(n)]
+
+    def column(self, n):
+        start = self.start(n)
+        return start - self.source.rfind('\n', 0, start)
+
+    def find_end(self, offset, lo=0):
+        '''
+        The index of the first token (from lo on) that ends at or after offset
+        '''
+        n = bisect_left(self.ends, offset, lo, max(lo, self.split))
+        if n < self.split:
+            return n
+        return bisect_left(self.ends, offset - self.delta, max(lo, self.split))
+
+    def find_start(self, offset, lo=0):
+        '''
+        The index of the first token (from lo on) that starts at or after offset
+        '''
+        n = bisect_left(self.starts, offset, lo, max(lo, self.split))
+        if n < self.split:
+            return n
+        return bisect_left(self.starts, offset - self.delta, max(lo, self.split))
+
+    def settle(self, upto=None):
+        '''
+        Move the tokens before upto (all of them by default) to where
+        they should be.
+        '''
+        if upto is None:
+            upto = len(self)
+        if upto <= self.split:
+            return
+        if self.delta:
+            self.starts[self.split:upto] = moved(self.starts[self.split:upto], self.delta)
+            self.ends[self.split:upto] = moved(self.ends[self.split:upto], self.delta)
+        if self.lines:
+            self.linenos[self.split:upto] = moved(self.linenos[self.split:upto], self.lines)
+        self.split = upto
+        if upto == len(self):
+            self.delta = self.lines = 0
+
+class Part:
+    '''
+    A top-level statement: its node (None for text that didn't parse)
+    and the range of tokens [start, end) it was parsed from.
+    '''
+    __slots__ = ('node', 'start', 'end', 'line_shift', 'key', 'definitions', 'errors')
+
+    def __init__(self, node, start, end):
+        self.node = node
+        self.start = start
+        self.end = end
+        self.line_shift = 0         # Lines the node's positions are out by
+        self.key = None             # Definitions it was checked with
+        self.definitions = ()       # (name, value) that it defines
+        self.errors = [ ]           # (lineno, message) from checking it
+
+    def settle(self):
+        '''
+        Bring the line numbers in the node (and the errors) up to date.
+        '''
+        if self.line_shift:
+            shift_lines(self.node, self.line_shift)
+            self.errors = [ (lineno + self.line_shift, message) for lineno, message in self.errors ]
+            self.line_shift = 0
+
+class Document:
+    def __init__(self, text):
+        self.load(text)
+
+    def load(self, text):
+        '''
+        Scan and parse text from scratch.
+        '''
+        self.text = text
+        self.lex_errors = [ ]           # (offset, lineno, message)
+        if text.isascii():
+            self.tokens = EditableTokens(text)
+            scan_into(self.tokens, text, errors=self.lex_errors)
+        else:
+            self.tokens = collect_errors(tokenize_array, text, self.lex_errors)
+        self.parts = [ ]
+        self.gap = False
+        self.syntax_error = None
+        self.reparse(0, len(self.tokens), 0, 0, 0, None)
+
+    def edit(self, offset, removed, inserted):
+        '''
+        Replace the removed characters at offset with the inserted text.
+        '''
+        text = self.text[:offset] + inserted + self.text[offset + removed:]
+        old = self.tokens
+        if old._values is not None or not text.isascii():
+            self.load(text)
+            return
+        delta = len(inserted) - removed
+
+        # Keep the tokens that end before the edit, and scan again from
+        # the end of the last of them
+        keep = old.find_end(offset)
+        after = old.find_start(offset + removed, keep)
+        # The tokens after the edit all have to be out by the same amount
+        old.settle(keep if after >= old.split else None)
+        if keep:
+            pos, lineno = old.ends[keep - 1], old.linenos[keep - 1]
+        else:
+            pos, lineno = 0, 1
+        tokens = EditableTokens(text)
+        tokens.kinds = old.kinds[:keep]
+        tokens.starts = old.starts[:keep]
+        tokens.ends = old.ends[:keep]
+        tokens.linenos = old.linenos[:keep]
+        errors = [ error for error in self.lex_errors if error[0] < pos ]
+        synced = scan_into(tokens, text, pos, lineno, (old, after, old.delta + delta), errors)
+        hi = len(tokens)
+        if synced:
+            # The rest of the old tokens follow on, moved lazily
+            j, lineno = synced
+            line_shift = lineno - old.lineno(j)
+            tokens.kinds.extend(old.kinds[j:])
+            tokens.starts.extend(old.starts[j:])
+            tokens.ends.extend(old.ends[j:])
+            tokens.linenos.extend(old.linenos[j:])
+            tokens.split = hi
+            tokens.delta = old.delta + delta
+            tokens.lines = lineno - old.linenos[j]
+            # An error for the token it stopped at is already in the old list
+            resume = old.start(j)
+            errors = [ error for error in errors if error[0] < resume + delta ]
+            errors.extend((erroffset + delta, errline + line_shift, message)
+                          for erroffset, errline, message in self.lex_errors if erroffset >= resume)
+        else:
+            j = len(old)
+            line_shift = 0
+        self.text = text
+        self.tokens = tokens
+        self.lex_errors = errors
+        self.reparse(keep, hi, j, hi - j, line_shift, old)
+
+    def reparse(self, lo, hi, old_hi, shift, line_shift, old):
+        '''
+        Parse again after the tokens [lo, hi) have changed.  The old
+        tokens from old_hi on are now at (index + shift), with line
+        numbers line_shift more than before.
+        '''
+        parts = self.parts
+        tokens = self.tokens
+        # The first part that took in or looked ahead at a new token
+        # (a gap is always parsed again)
+        a = bisect_left(parts, lo, key=lambda part: part.end)
+        if self.gap:
+            g = next(n for n, part in enumerate(parts) if part.node is None)
+            a = min(a, g)
+            if parts[g].end >= old_hi:
+                hi = max(hi, parts[g].end + shift)
+        if a < len(parts):
+            start = parts[a].start
+        else:
+            start = parts[-1].end if parts else 0
+        # The parts that might be reused start at or after old_hi
+        b = bisect_left(parts, old_hi, lo=a, key=lambda part: part.start)
+
+        def reusable(pos):
+            # Move b on to the old part at pos (if there is one) and say
+            # whether it can be used from there
+            nonlocal b
+            while b < len(parts) and parts[b].start + shift < pos:
+                b += 1
+            return (b < len(parts) and parts[b].start + shift == pos and parts[b].node is not None
+                    and tokens.column(pos) == old.column(parts[b].start))
+
+        new_parts = [ ]
+        cursor = Tokens(tokens)
+        cursor.pos = start
+        self.syntax_error = None
+        self.gap = False
+        tail = len(parts)
+        try:
+            while True:
+                pos = cursor.pos
+                if pos >= hi and reusable(pos):
+                    tail = b
+                    break
+                if cursor.peek(BLOCK_END) is not None:
+                    cursor.expect(EOF)
+                    break
+                node = trampoline(parse_statement(cursor))
+                new_parts.append(Part(node, pos, cursor.pos))
+        except SyntaxError as err:
+            self.syntax_error = (tokens.lineno(cursor.pos), str(err))
+            # Skip to the next old part that can be used
+            gap_end = len(tokens) - 1
+            next_pos = max(hi, pos + 1)
+            while b < len(parts):
+                if parts[b].start + shift >= next_pos and reusable(parts[b].start + shift):
+                    gap_end = parts[b].start + shift
+                    break
+                b += 1
+            tail = b
+            new_parts.append(Part(None, pos, gap_end))
+            self.gap = True
+
+        for part in parts[tail:]:
+            part.start += shift
+            part.end += shift
+            part.line_shift += line_shift
+            if part.node is None:
+                self.gap = True
+        self.parts = parts[:a] + new_parts + parts[tail:]
+
+    def check(self):
+        '''
+        Check the program (up to the first syntax error).  Returns the
+        errors as a list of (lineno, message).
+        '''
+        context = CollectingContext()
+        define_types(context)
+        defined = context.env.scopes[0]     # Names defined at the top level
+        errors = [ ]
+        key = 0
+        unmade = [ ]        # Definitions of reused parts not made in context yet
+        for part in self.parts:
+            if part.node is None:
+                break
+            if part.key == key:
+                if part.definitions:
+                    unmade.append(part.definitions)
+            else:
+                for definitions in unmade:
+                    for name, value in definitions:
+                        context.env[name] = value
+                unmade = [ ]
+                part.settle()
+                context.errors = [ ]
+                before = len(defined)
+                trampoline(check(part.node, context))
+                part.errors = context.errors
+                part.definitions = tuple((name, context.env[name]) for name in islice(defined, before, None))
+                part.key = key
+            if part.line_shift:
+                errors.extend((lineno + part.line_shift, message) for lineno, message in part.errors)
+            else:
+                errors.extend(part.errors)
+            key = hash((key, part.definitions))
+        return errors
+
+    def diagnostics(self):
+        '''
+        All the errors in the program: from scanning, parsing (at most
+        one, since parsing stops there) and checking.
+        '''
+        errors = [ (lineno, message) for _, lineno, message in self.lex_errors ]
+        if self.syntax_error:
+            errors.append(self.syntax_error)
+        errors.extend(self.check())
+        return errors
+
+    @property
+    def model(self):
+        '''
+        The whole program as a Statements node (None if it has a syntax error)
+        '''
+        if self.gap:
+            return None
+        for part in self.parts:
+            part.settle()
+        return Statements([ part.node for part in self.parts ])
+
+class CollectingContext(CheckContext):
+    # Keeps the errors instead of printing them
+    def __init__(self):
+        super().__init__()
+        self.errors = [ ]
+
+    def error(self, lineno, message):
+        self.errors.append((lineno, message))
+        self.ok = False
+
+def moved(values, delta):
+    return type(values)(values.typecode, map(delta.__add__, values))
+
+def collect_errors(func, text, errors):
+    # Run func(text), adding the "lineno: message" lines it prints to errors
+    import io
+    from contextlib import redirect_stdout
+    out = io.StringIO()
+    with redirect_stdout(out):
+        result = func(text)
+    for line in out.getvalue().splitlines():
+        lineno, _, message = line.partition(': ')
+        errors.append((None, int(lineno), message))
+    return result
+
+# Moving the line numbers in a tree of nodes
+
+_fields = { }
+
+def node_fields(cls):
+    fields = _fields.get(cls)
+    if fields is None:
+        fields = _fields[cls] = tuple(name for klass in cls.__mro__
+                                      for name in getattr(klass, '__slots__', ())
+                                      if name not in ('lineno', 'col'))
+    return fields
+
+def shift_lines(node, delta):
+    stack = [ node ]
+    while stack:
+        node = stack.pop()
+        lineno = getattr(node, 'lineno', None)
+        if isinstance(lineno, int):
+            node.lineno = lineno + delta
+        for name in node_fields(type(node)):
+            value = getattr(node, name, None)
+            if isinstance(value, Node):
+                stack.append(value)
+            elif isinstance(value, list):
+                stack.extend(item for item in value if isinstance(item, Node))
+
+# Main program: apply edits from a file and show the diagnostics.  Each
+# line of the edits file is "offset removed text" (text is a Python
+# string literal).
+def main(filename, editsname):
+    import ast
+    with open(filename) as file:
+        doc = Document(file.read())
+    with open(editsname) as file:
+        for line in file:
+            if line.strip():
+                offset, removed, text = line.split(maxsplit=2)
+                doc.edit(int(offset), int(removed), ast.literal_eval(text))
+    for lineno, message in doc.diagnostics():
+        print(f'{lineno}: {message}')
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) != 3:
+        raise SystemExit('Usage: python3 -m wabbit.incremental filename edits')
+    main(sys.argv[1], sys.argv[2])
@@ -1,39 +1,490 @@
 # interp.py
 #
-
+# Interpreter for Wabbit programs.  Rather than walking the model on
+# every execution, each node is translated once into a Python closure.
+# All of the decisions that depend only on the program text are made
+# during that translation:
+#
+#   - Names are resolved to a storage slot (a global slot or a slot in
+#     the frame of the enclosing function).
+#   - Operators are picked based on the operand types (i32 arithmetic
+#     with wraparound, f64 arithmetic, comparisons, etc.).
+#   - Conversions, print formatting and function calls are specialized.
+#
+# Running the result is then just a matter of calling closures.  There
+# is no isinstance() dispatch and no environment lookup at runtime.
+#
+# Expression closures take the current frame and return a value.
+# Statement closures take the current frame and return None or one of
+# the control-flow signals below.  A function frame is a list where
+# slot 0 holds the return value and the remaining slots hold the
+# parameters and local variables.
 
 from .model import *
 from .parse import lineno
+from .scope import Scope
+from .trampoline import trampoline
 
-from collections import ChainMap
+from contextlib import contextmanager
+import sys
 
 class Context:
     def __init__(self):
-        self.env = ChainMap()          # Storage of variables
+        self.env = Scope()             # Storage of variables
         self.has_main = False
+        self.globals = [ ]             # Values of global variables
+        self.frame = None              # Slot types for the current function (None at top level)
+        self.compounds = 0             # Number of compound expressions seen
+        self.depth = 0                 # Nesting depth while translating
+        self.max_depth = 0
+
+    def lookup(self, name):
+        return self.env.get(name)
+
+    def define(self, name, value):
+        self.env[name] = value
+
+    @contextmanager
+    def new_scope(self):
+        self.env.push()
+        try:
+            yield
+        finally:
+            self.env.pop()
+
+    def allocate(self, valtype):
+        '''
+        Allocate storage for a new variable and return its location.
+        '''
+        if self.frame is None:
+            self.globals.append(_zero[valtype])
+            return ('global', len(self.globals) - 1)
+        else:
+            self.frame.append(valtype)
+            return ('local', len(self.frame) - 1)
 
-        
 valid_types = { 'int', 'float', 'char', 'bool' }
 
+_zero = {
+    'int': 0,
+    'float': 0.0,
+    'char': 0,
+    'bool': False,
+    None: None,
+    }
+
+# Control-flow signals returned by statement closures
+BREAK = 'break'
+CONTINUE = 'continue'
+RETURN = 'return'
+
+class ControlFlow(Exception):
+    '''
+    Raised when a break/continue/return occurs inside of a compound
+    expression.  It is turned back into a signal by the statement that
+    contains the expression.
+    '''
+    def __init__(self, signal):
+        self.signal = signal
+
+class Function:
+    __slots__ = ('name', 'nparams', 'ret_type', 'frame', 'body')
+
+    def __init__(self, name, nparams, ret_type):
+        self.name = name
+        self.nparams = nparams
+        self.ret_type = ret_type
+        self.frame = None              # Initial frame (zero values)
+        self.body = None
 
+# i32 semantics.  Integers wrap around on overflow and division
+# truncates towards zero, the same as the Wasm code.
+def wrap_i32(value):
+    return ((value + 0x80000000) & 0xffffffff) - 0x80000000
+
+def div_i32(left, right):
+    if right == 0:
+        raise RuntimeError('Integer divide by zero')
+    quotient = abs(left) // abs(right)
+    if (left < 0) != (right < 0):
+        quotient = -quotient
+    return wrap_i32(quotient)
+
+def div_f64(left, right):
+    try:
+        return left / right
+    except ZeroDivisionError:
+        if left == 0 or left != left:
+            return float('nan')
+        return float('inf') if (left > 0) == (str(right)[0] != '-') else float('-inf')
+
+def _int_binop(op, left, right):
+    if op == '+':
+        return lambda frame: (left(frame) + right(frame) + 0x80000000 & 0xffffffff) - 0x80000000
+    elif op == '-':
+        return lambda frame: (left(frame) - right(frame) + 0x80000000 & 0xffffffff) - 0x80000000
+    elif op == '*':
+        return lambda frame: (left(frame) * right(frame) + 0x80000000 & 0xffffffff) - 0x80000000
+    elif op == '/':
+        return lambda frame: div_i32(left(frame), right(frame))
+
+def _float_binop(op, left, right):
+    if op == '+':
+        return lambda frame: left(frame) + right(frame)
+    elif op == '-':
+        return lambda frame: left(frame) - right(frame)
+    elif op == '*':
+        return lambda frame: left(frame) * right(frame)
+    elif op == '/':
+        return lambda frame: div_f64(left(frame), right(frame))
+
+def _compare(op, left, right):
+    if op == '<':
+        return lambda frame: left(frame) < right(frame)
+    elif op == '<=':
+        return lambda frame: left(frame) <= right(frame)
+    elif op == '>':
+        return lambda frame: left(frame) > right(frame)
+    elif op == '>=':
+        return lambda frame: left(frame) >= right(frame)
+    elif op == '==':
+        return lambda frame: left(frame) == right(frame)
+    elif op == '!=':
+        return lambda frame: left(frame) != right(frame)
+    # Both sides are always evaluated (no short-circuit), like the Wasm code
+    elif op == '&&':
+        return lambda frame: left(frame) & right(frame)
+    elif op == '||':
+        return lambda frame: left(frame) | right(frame)
+
+def _constant(value):
+    return lambda frame: value
+
+def _printer(valtype, value):
+    if valtype == 'char':
+        def run(frame):
+            sys.stdout.write(chr(value(frame)))
+        return run
+    elif valtype == 'bool':
+        return lambda frame: print('true' if value(frame) else 'false')
+    else:
+        return lambda frame: print(value(frame))
+
+def _convert(totype, fromtype, value):
+    if totype == 'float':
+        if fromtype == 'float':
+            return value
+        return lambda frame: float(value(frame))
+    elif fromtype == 'float':
+        return lambda frame: wrap_i32(int(value(frame)))
+    elif fromtype == 'bool':
+        return lambda frame: int(value(frame))
+    else:
+        return value
+
+def _call(func, args):
+    # Specialized for the common small numbers of arguments
+    if len(args) == 0:
+        def call(frame):
+            new = func.frame.copy()
+            func.body(new)
+            return new[0]
+    elif len(args) == 1:
+        arg0, = args
+        def call(frame):
+            new = func.frame.copy()
+            new[1] = arg0(frame)
+            func.body(new)
+            return new[0]
+    elif len(args) == 2:
+        arg0, arg1 = args
+        def call(frame):
+            new = func.frame.copy()
+            new[1] = arg0(frame)
+            new[2] = arg1(frame)
+            func.body(new)
+            return new[0]
+    else:
+        def call(frame):
+            new = func.frame.copy()
+            new[1:len(args)+1] = [arg(frame) for arg in args]
+            func.body(new)
+            return new[0]
+    return call
+
+def _sequence(stmts):
+    if len(stmts) == 0:
+        return lambda frame: None
+    elif len(stmts) == 1:
+        return stmts[0]
+    def run(frame):
+        for stmt in stmts:
+            signal = stmt(frame)
+            if signal is not None:
+                return signal
+    return run
+
+# Top-level function: translate the program and run it
 def interpret_program(model):
     context = Context()
-    ...
+    context.define('int', ('type', 'int'))
+    context.define('float', ('type', 'float'))
+    context.define('char', ('type', 'char'))
+    context.define('bool', ('type', 'bool'))
+    program = trampoline(interpret_statement(model, context))
+    if context.has_main:
+        kind, main = context.lookup('main')
+        program = _sequence([program, _call(main, [])])
+    # The closures call each other as deeply as the program is nested
+    # (at most a couple of calls per level), so make room for that
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(limit + 2 * context.max_depth)
+    try:
+        program(None)
+    finally:
+        sys.setrecursionlimit(limit)
     return
 
+# The translating functions are generators run by trampoline() (see
+# trampoline.py), so deeply nested programs don't use up the Python
+# stack.  They yield the translation of each child and get back its
+# result.
+
+# Translate an expression into a closure.  Returns (closure, type).
+def interpret(node, context):
+    context.depth += 1
+    if context.depth > context.max_depth:
+        context.max_depth = context.depth
+    try:
+        return (yield _interpret(node, context))
+    finally:
+        context.depth -= 1
 
-def interpret(node, context, next):
+def _interpret(node, context):
     if isinstance(node, Integer):
-        return lambda: next(('int', int(node.value)))
+        return _constant(wrap_i32(int(node.value))), 'int'
 
+    elif isinstance(node, Float):
+        return _constant(float(node.value)), 'float'
 
-def interpret_lhs(node, value, context, next):
-    if isinstance(node, Name):
+    elif isinstance(node, Boolean):
+        return _constant(node.value == 'true'), 'bool'
+
+    elif isinstance(node, Character):
+        return _constant(ord(eval(node.value))), 'char'
+
+    elif isinstance(node, Name):
         decl = context.lookup(node.value)
+        if decl[0] == 'global':
+            store, slot = context.globals, decl[1]
+            return (lambda frame: store[slot]), decl[2]
+        elif decl[0] == 'local':
+            slot = decl[1]
+            return (lambda frame: frame[slot]), decl[2]
+        raise RuntimeError(f'{lineno(node)}: {node.value} is not a value')
 
+    elif isinstance(node, BinOp):
+        left, ltype = yield interpret(node.left, context)
+        right, rtype = yield interpret(node.right, context)
+        if node.op in {'+', '-', '*', '/'}:
+            if ltype == 'float':
+                return _float_binop(node.op, left, right), 'float'
+            return _int_binop(node.op, left, right), ltype
+        return _compare(node.op, left, right), 'bool'
 
-if __name__ == '__main__':
-    import sys
+    elif isinstance(node, UnaryOp):
+        operand, optype = yield interpret(node.operand, context)
+        if node.op == '-':
+            if optype == 'float':
+                return (lambda frame: 0.0 - operand(frame)), optype
+            return (lambda frame: wrap_i32(-operand(frame))), optype
+        elif node.op == '!':
+            return (lambda frame: not operand(frame)), optype
+        return operand, optype
+
+    elif isinstance(node, Grouping):
+        return (yield interpret(node.expression, context))
+
+    elif isinstance(node, CompoundExpression):
+        context.compounds += 1
+        with context.new_scope():
+            stmts = node.statements.statements
+            last = stmts[-1] if stmts else None
+            body = [ ]
+            if isinstance(last, ExpressionAsStatement):
+                for stmt in stmts[:-1]:
+                    body.append((yield interpret_statement(stmt, context)))
+                value, valtype = yield interpret(last.expression, context)
+            else:
+                for stmt in stmts:
+                    body.append((yield interpret_statement(stmt, context)))
+                value, valtype = (lambda frame: None), None
+        def run(frame):
+            for stmt in body:
+                signal = stmt(frame)
+                if signal is not None:
+                    raise ControlFlow(signal)
+            return value(frame)
+        return run, valtype
+
+    elif isinstance(node, FunctionApplication):
+        kind, value = context.lookup(node.func.value)
+        args = [ ]
+        argtypes = [ ]
+        for arg in node.arguments:
+            closure, argtype = yield interpret(arg, context)
+            args.append(closure)
+            argtypes.append(argtype)
+        if kind == 'type':
+            return _convert(value, argtypes[0], args[0]), value
+        elif kind == 'func':
+            return _call(value, args), value.ret_type
+        raise RuntimeError(f'{lineno(node)}: {node.func.value} is not a function')
+
+    else:
+        raise RuntimeError(f"Can't interpret {node}")
+
+# Translate a statement into a closure.  Returns the closure.
+def interpret_statement(node, context):
+    compounds = context.compounds
+    context.depth += 1
+    if context.depth > context.max_depth:
+        context.max_depth = context.depth
+    try:
+        stmt = yield _interpret_statement(node, context)
+    finally:
+        context.depth -= 1
+    if context.compounds != compounds and not isinstance(node, (Statements, FunctionDeclaration)):
+        # A compound expression somewhere in this statement could break,
+        # continue, or return.  Catch that here and turn it into a signal.
+        inner = stmt
+        def stmt(frame):
+            try:
+                return inner(frame)
+            except ControlFlow as flow:
+                return flow.signal
+    return stmt
+
+def _interpret_statement(node, context):
+    if isinstance(node, Statements):
+        stmts = [ ]
+        for stmt in node.statements:
+            stmts.append((yield interpret_statement(stmt, context)))
+        return _sequence(stmts)
+
+    elif isinstance(node, ExpressionAsStatement):
+        value, valtype = yield interpret(node.expression, context)
+        def run(frame):
+            value(frame)
+        return run
+
+    elif isinstance(node, PrintStatement):
+        value, valtype = yield interpret(node.value, context)
+        return _printer(valtype, value)
 
-    
+    elif isinstance(node, (ConstDeclaration, VarDeclaration)):
+        if node.value:
+            value, valtype = yield interpret(node.value, context)
+        else:
+            valtype = node.type
+            zero = _zero[valtype]
+            value = lambda frame: zero
+        kind, slot = context.allocate(valtype)
+        context.define(node.name, (kind, slot, valtype))
+        return interpret_lhs(node, value, context)
 
+    elif isinstance(node, Assignment):
+        value, valtype = yield interpret(node.value, context)
+        return interpret_lhs(node.location, value, context)
+
+    elif isinstance(node, IfStatement):
+        test, testtype = yield interpret(node.test, context)
+        with context.new_scope():
+            consequence = yield interpret_statement(node.consequence, context)
+        if node.alternative:
+            with context.new_scope():
+                alternative = yield interpret_statement(node.alternative, context)
+            def run(frame):
+                if test(frame):
+                    return consequence(frame)
+                else:
+                    return alternative(frame)
+        else:
+            def run(frame):
+                if test(frame):
+                    return consequence(frame)
+        return run
+
+    elif isinstance(node, WhileStatement):
+        test, testtype = yield interpret(node.test, context)
+        with context.new_scope():
+            body = yield interpret_statement(node.body, context)
+        def run(frame):
+            while test(frame):
+                signal = body(frame)
+                if signal is not None:
+                    if signal is BREAK:
+                        break
+                    elif signal is not CONTINUE:
+                        return signal
+        return run
+
+    elif isinstance(node, BreakStatement):
+        return lambda frame: BREAK
+
+    elif isinstance(node, ContinueStatement):
+        return lambda frame: CONTINUE
+
+    elif isinstance(node, ReturnStatement):
+        value, valtype = yield interpret(node.value, context)
+        def run(frame):
+            frame[0] = value(frame)
+            return RETURN
+        return run
+
+    elif isinstance(node, FunctionDeclaration):
+        func = Function(node.name, len(node.parameters), node.return_type)
+        context.define(node.name, ('func', func))
+        oldframe = context.frame
+        context.frame = [ node.return_type ]
+        try:
+            with context.new_scope():
+                for parm in node.parameters:
+                    kind, slot = context.allocate(parm.type)
+                    context.define(parm.name, (kind, slot, parm.type))
+                func.body = yield interpret_statement(node.body, context)
+            func.frame = [ _zero[valtype] for valtype in context.frame ]
+        finally:
+            context.frame = oldframe
+        if node.name == 'main' and oldframe is None:
+            context.has_main = True
+        return lambda frame: None
+
+    else:
+        raise RuntimeError(f"Can't interpret {node}")
+
+# Translate a store into a location.  Returns a statement closure.
+def interpret_lhs(node, value, context):
+    name = node.name if isinstance(node, (ConstDeclaration, VarDeclaration)) else node.value
+    kind, slot, valtype = context.lookup(name)
+    if kind == 'global':
+        store = context.globals
+        def run(frame):
+            store[slot] = value(frame)
+    else:
+        def run(frame):
+            frame[slot] = value(frame)
+    return run
+
+def main(filename):
+    from .parse import parse_file
+    from .typecheck import check_program
+    model = parse_file(filename)
+    if check_program(model):
+        interpret_program(model)
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) != 2:
+        raise SystemExit('Usage: python3 -m wabbit.interp filename')
+    main(sys.argv[1])
@@ -52,19 +52,18 @@
 # Feel free to modify as appropriate.  You don't even have to use classes
 # if you want to go in a different direction with it.
 
+# Every node uses __slots__.  Besides its own fields, each node has a
+# position (lineno, col) that the parser fills in.  Nodes made by later
+# passes might not have one, so read it with parse.lineno().
 class Node:
-    id = 0
-    @staticmethod
-    def __new__(cls, *args, **kwargs):
-        self = super().__new__(cls)
-        self.id = Node.id + 1
-        Node.id += 1
-        return self
+    __slots__ = ('lineno', 'col')
 
 class Integer(Node):
     '''
     Example: 42
     '''
+    __slots__ = ('value',)
+
     def __init__(self, value):
         self.value = value
 
@@ -75,6 +74,8 @@ class Float(Node):
     '''
     Example: 4.2
     '''
+    __slots__ = ('value',)
+
     def __init__(self, value):
         self.value = value
 
@@ -85,6 +86,8 @@ class Boolean(Node):
     '''
     Example:  true/false
     '''
+    __slots__ = ('value',)
+
     def __init__(self, value):
         self.value = value
 
@@ -95,6 +98,8 @@ class Character(Node):
     '''
     Example: '\n'
     '''
+    __slots__ = ('value',)
+
     def __init__(self, value):
         self.value = value
 
@@ -102,6 +107,8 @@ class Character(Node):
         return f'Character({self.value})'
     
 class Name(Node):
+    __slots__ = ('value',)
+
     def __init__(self, value):
         self.value = value
 
@@ -109,7 +116,109 @@ class Name(Node):
         return f'Name({self.value})'
 
 
+class BinOp(Node):
+    '''
+    Example: left + right
+    '''
+    __slots__ = ('op', 'left', 'right')
+
+    def __init__(self, op, left, right):
+        self.op = op
+        self.left = left
+        self.right = right
+
+    def __repr__(self):
+        return f'BinOp({self.op!r}, {self.left}, {self.right})'
+
+class UnaryOp(Node):
+    '''
+    Example: -operand
+    '''
+    __slots__ = ('op', 'operand')
+
+    def __init__(self, op, operand):
+        self.op = op
+        self.operand = operand
+
+    def __repr__(self):
+        return f'UnaryOp({self.op!r}, {self.operand})'
+
+class Grouping(Node):
+    '''
+    Example: ( expression )
+    '''
+    __slots__ = ('expression',)
+
+    def __init__(self, expression):
+        self.expression = expression
+
+    def __repr__(self):
+        return f'Grouping({self.expression})'
+
+class CompoundExpression(Node):
+    '''
+    Example: { statements; value }
+    '''
+    __slots__ = ('statements',)
+
+    def __init__(self, statements):
+        self.statements = statements
+
+    def __repr__(self):
+        return f'CompoundExpression({self.statements})'
+
+class Statements(Node):
+    __slots__ = ('statements',)
+
+    def __init__(self, statements):
+        self.statements = statements
+
+    def __repr__(self):
+        return f'Statements({self.statements})'
+
+class PrintStatement(Node):
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __repr__(self):
+        return f'PrintStatement({self.value})'
+
+class ExpressionAsStatement(Node):
+    __slots__ = ('expression',)
+
+    def __init__(self, expression):
+        self.expression = expression
+
+    def __repr__(self):
+        return f'ExpressionAsStatement({self.expression})'
+
+class ConstDeclaration(Node):
+    __slots__ = ('name', 'type', 'value')
+
+    def __init__(self, name, type, value):
+        self.name = name
+        self.type = type
+        self.value = value
+
+    def __repr__(self):
+        return f'ConstDeclaration({self.name}, {self.type}, {self.value})'
+
+class VarDeclaration(Node):
+    __slots__ = ('name', 'type', 'value')
+
+    def __init__(self, name, type, value):
+        self.name = name
+        self.type = type
+        self.value = value
+
+    def __repr__(self):
+        return f'VarDeclaration({self.name}, {self.type}, {self.value})'
+
 class Assignment(Node):
+    __slots__ = ('location', 'value')
+
     def __init__(self, location, value):
         self.location = location
         self.value = value
@@ -118,6 +227,8 @@ class Assignment(Node):
         return f'Assignment({self.location}, {self.value})'
 
 class IfStatement(Node):
+    __slots__ = ('test', 'consequence', 'alternative')
+
     def __init__(self, test, consequence, alternative):
         self.test = test
         self.consequence = consequence
@@ -127,6 +238,8 @@ class IfStatement(Node):
         return f'IfStatement({self.test}, {self.consequence}, {self.alternative})'
 
 class WhileStatement(Node):
+    __slots__ = ('test', 'body')
+
     def __init__(self, test, body):
         self.test = test
         self.body = body
@@ -135,14 +248,20 @@ class WhileStatement(Node):
         return f'WhileStatement({self.test}, {self.body})'
 
 class BreakStatement(Node):
+    __slots__ = ()
+
     def __repr__(self):
         return f'BreakStatement()'
 
 class ContinueStatement(Node):
+    __slots__ = ()
+
     def __repr__(self):
         return f'ContinueStatement()'
 
 class FunctionDeclaration(Node):
+    __slots__ = ('name', 'parameters', 'return_type', 'body')
+
     def __init__(self, name, parameters, return_type, body):
         self.name = name
         self.parameters = parameters
@@ -153,6 +272,8 @@ class FunctionDeclaration(Node):
         return f'FunctionDeclaration({self.name}, {self.parameters}, {self.return_type}, {self.body})'
 
 class FunctionApplication(Node):
+    __slots__ = ('func', 'arguments')
+
     def __init__(self, func, arguments):
         self.func = func
         self.arguments = arguments
@@ -161,6 +282,8 @@ class FunctionApplication(Node):
         return f'FunctionApplication({self.func}, {self.arguments})'
 
 class ReturnStatement(Node):
+    __slots__ = ('value',)
+
     def __init__(self, value):
         self.value = value
 
@@ -168,6 +291,8 @@ class ReturnStatement(Node):
         return f'ReturnStatement({self.value})'
 
 class Parameter(Node):
+    __slots__ = ('name', 'type')
+
     def __init__(self, name, type):
         self.name = name
         self.type = type
@@ -177,6 +302,8 @@ class Parameter(Node):
 
 
 class SourceContext:
+    __slots__ = ('indent', 'newline')
+
     def __init__(self, indent='', newline='\n'):
         self.indent = indent
         self.newline = newline
@@ -3,252 +3,347 @@
 
 
 from .model import *
-from .tokenize import tokenize
+from .tokenize import tokenize_array, map_file, kind, token_types
+from .trampoline import trampoline
 
-# Line number tracking
-_line_numbers = { }
-def record_lineno(node, lineno):
-    _line_numbers[node.id] = lineno
+# Position tracking.  The line number and column are stored on the
+# node itself, so they go away along with the model.
+def record_lineno(node, lineno, col=None):
+    node.lineno = lineno
+    node.col = col
     return node
 
 def lineno(node):
-    return _line_numbers.get(node.id, '')
-    
-class EOF:
-    type = 'EOF'
-    value = 'EOF'
-    lineno = 'EOF'
-    
+    return getattr(node, 'lineno', '')
+
+def column(node):
+    return getattr(node, 'col', None)
+
+def position(node):
+    return lineno(node), column(node)
+
+# Sets of token kinds.  Kinds are small integers, so a set of kinds is
+# a bitmask and checking the next token against it is a single test.
+def kinds(*types):
+    mask = 0
+    for toktype in types:
+        mask |= 1 << kind[toktype]
+    return mask
+
+def kind_names(mask):
+    return tuple(toktype for toktype, k in kind.items() if mask & (1 << k))
+
+ID = kinds('ID')
+INTEGER = kinds('INTEGER')
+FLOAT = kinds('FLOAT')
+CHAR = kinds('CHAR')
+BOOLEAN = kinds('TRUE', 'FALSE')
+PRINT = kinds('PRINT')
+CONST = kinds('CONST')
+VAR = kinds('VAR')
+RETURN = kinds('RETURN')
+IF = kinds('IF')
+ELSE = kinds('ELSE')
+WHILE = kinds('WHILE')
+BREAK = kinds('BREAK')
+CONTINUE = kinds('CONTINUE')
+FUNC = kinds('FUNC')
+ASSIGN = kinds('ASSIGN')
+SEMI = kinds('SEMI')
+COMMA = kinds('COMMA')
+LPAREN = kinds('LPAREN')
+RPAREN = kinds('RPAREN')
+LBRACE = kinds('LBRACE')
+RBRACE = kinds('RBRACE')
+EOF = kinds('EOF')
+BLOCK_END = kinds('RBRACE', 'EOF')
+UNARYOPS = kinds('PLUS', 'MINUS', 'LNOT')
+
+# Binary operators from loosest to tightest binding, with their
+# associativity.  The relational operators don't associate at all, so
+# a < b < c is a syntax error.
+precedence = [
+    ('left', ('LOR',)),
+    ('left', ('LAND',)),
+    ('nonassoc', ('LT', 'LE', 'GT', 'GE', 'EQ', 'NE')),
+    ('left', ('PLUS', 'MINUS')),
+    ('left', ('TIMES', 'DIVIDE')),
+    ]
+
+# Binding power of each token kind (0 if it's not a binary operator)
+# and the binding powers that are non-associative
+binding_power = [0] * len(token_types)
+nonassociative = set()
+for bp, (assoc, toktypes) in enumerate(precedence, start=1):
+    for toktype in toktypes:
+        binding_power[kind[toktype]] = bp
+    if assoc == 'nonassoc':
+        nonassociative.add(bp)
+
+# Cursor over a TokenArray.  peek/accept/expect take a set of kinds and
+# return the index of the matching token (or None).  The text and line
+# number of a token are fetched through value(), lineno() and position().
 class Tokens:
-    def __init__(self, gen):
-        self._gen = gen
-        self._lookahead = None
-
-    def peek(self, *types):
-        if self._lookahead is None:
-            self._lookahead = next(self._gen, EOF)
-        if self._lookahead.type in types:
-            return self._lookahead
-        else:
-            return None
-
-    def accept(self, *types):
-        tok = self.peek(*types)
-        if tok:
-            self._lookahead = None
-        return tok
-
-    def expect(self, *types):
-        tok = self.peek(*types)
-        if not tok:
-            raise SyntaxError(f'Expected {types} before {self._lookahead}')
-        self._lookahead = None
-        return tok
-            
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.kinds = tokens.kinds
+        self.pos = 0
+
+    def peek(self, kinds):
+        pos = self.pos
+        if (1 << self.kinds[pos]) & kinds:
+            return pos
+        return None
+
+    def accept(self, kinds):
+        pos = self.pos
+        if (1 << self.kinds[pos]) & kinds:
+            self.pos = pos + 1
+            return pos
+        return None
+
+    def expect(self, kinds):
+        pos = self.pos
+        if (1 << self.kinds[pos]) & kinds:
+            self.pos = pos + 1
+            return pos
+        raise SyntaxError(f'Expected {kind_names(kinds)} before {self.tokens.token(pos)}')
+
+    def value(self, tok):
+        return self.tokens.value(tok)
+
+    def lineno(self, tok):
+        return self.tokens.lineno(tok)
+
+    def position(self, tok):
+        return self.tokens.lineno(tok), self.tokens.column(tok)
+
 # Top-level function that runs everything    
 def parse_source(text):
-    tokens = tokenize(text)
+    tokens = tokenize_array(text)
     model = parse_program(Tokens(tokens))     # You need to implement this part
     return model
 
+# The parse_* functions below that can nest (statements, expressions)
+# are generators run by trampoline(): they yield the parser for a
+# nested part and get the parsed node back.  So deeply nested input
+# doesn't use up the Python stack.
 def parse_program(tokens):
     # Code this to recognize any Wabbit program and return the model
-    statements = parse_statements(tokens)
-    tokens.expect('EOF')
+    statements = trampoline(parse_statements(tokens))
+    tokens.expect(EOF)
     return statements
 
 def parse_statements(tokens):
     statements = [ ]
-    while not tokens.peek('RBRACE', 'EOF'):
-        statement = parse_statement(tokens)
+    while tokens.peek(BLOCK_END) is None:
+        statement = yield parse_statement(tokens)
         statements.append(statement)
     return Statements(statements)
 
 def parse_statement(tokens):
-    if tokens.peek('PRINT'):
-        return parse_print_statement(tokens)
-    elif tokens.peek('CONST'):
-        return parse_const_declaration(tokens)
-    elif tokens.peek('VAR'):
-        return parse_var_declaration(tokens)
-    elif tokens.peek('RETURN'):
-        return parse_return_statement(tokens)
-    elif tokens.peek('IF'):
-        return parse_if_statement(tokens)
-    elif tokens.peek('WHILE'):
-        return parse_while_statement(tokens)
-    elif tokens.peek('BREAK'):
+    if tokens.peek(PRINT) is not None:
+        return (yield parse_print_statement(tokens))
+    elif tokens.peek(CONST) is not None:
+        return (yield parse_const_declaration(tokens))
+    elif tokens.peek(VAR) is not None:
+        return (yield parse_var_declaration(tokens))
+    elif tokens.peek(RETURN) is not None:
+        return (yield parse_return_statement(tokens))
+    elif tokens.peek(IF) is not None:
+        return (yield parse_if_statement(tokens))
+    elif tokens.peek(WHILE) is not None:
+        return (yield parse_while_statement(tokens))
+    elif tokens.peek(BREAK) is not None:
         return parse_break_statement(tokens)
-    elif tokens.peek('CONTINUE'):
+    elif tokens.peek(CONTINUE) is not None:
         return parse_continue_statement(tokens)
-    elif tokens.peek('FUNC'):
-        return parse_function_declaration(tokens)
+    elif tokens.peek(FUNC) is not None:
+        return (yield parse_function_declaration(tokens))
     else:
-        return parse_assignment_statement(tokens)
+        return (yield parse_assignment_statement(tokens))
 
 def parse_const_declaration(tokens):
-    lineno = tokens.expect('CONST').lineno
-    name = tokens.expect('ID')
-    type = tokens.accept('ID')
-    tokens.expect('ASSIGN')
-    value = parse_expression(tokens)
-    tokens.expect('SEMI')
-    return record_lineno(ConstDeclaration(name.value, type.value if type else None, value), lineno)
+    pos = tokens.position(tokens.expect(CONST))
+    name = tokens.expect(ID)
+    type = tokens.accept(ID)
+    tokens.expect(ASSIGN)
+    value = yield parse_expression(tokens)
+    tokens.expect(SEMI)
+    return record_lineno(ConstDeclaration(tokens.value(name), tokens.value(type) if type is not None else None, value), *pos)
 
 def parse_var_declaration(tokens):
-    lineno = tokens.expect('VAR').lineno
-    name = tokens.expect('ID')
-    type = tokens.accept('ID')
-    if tokens.accept('ASSIGN'):
-        value = parse_expression(tokens)
+    pos = tokens.position(tokens.expect(VAR))
+    name = tokens.expect(ID)
+    type = tokens.accept(ID)
+    if tokens.accept(ASSIGN) is not None:
+        value = yield parse_expression(tokens)
     else:
         value = None
-    tokens.expect('SEMI')
-    return record_lineno(VarDeclaration(name.value, type.value if type else None, value), lineno)
+    tokens.expect(SEMI)
+    return record_lineno(VarDeclaration(tokens.value(name), tokens.value(type) if type is not None else None, value), *pos)
 
 def parse_assignment_statement(tokens):
-    location = parse_expression(tokens)
-    if tokens.accept('ASSIGN'):
-        value = parse_expression(tokens)
-        tokens.expect('SEMI')
-        return record_lineno(Assignment(location, value), lineno(location))
+    location = yield parse_expression(tokens)
+    if tokens.accept(ASSIGN) is not None:
+        value = yield parse_expression(tokens)
+        tokens.expect(SEMI)
+        return record_lineno(Assignment(location, value), *position(location))
     else:
-        tokens.expect('SEMI')
-        return record_lineno(ExpressionAsStatement(location), lineno(location))
+        tokens.expect(SEMI)
+        return record_lineno(ExpressionAsStatement(location), *position(location))
 
 def parse_if_statement(tokens):
-    lineno = tokens.expect('IF').lineno
-    test = parse_expression(tokens)
-    tokens.expect('LBRACE')
-    consequence = parse_statements(tokens)
-    tokens.expect('RBRACE')
-    if tokens.accept('ELSE'):
-        tokens.expect('LBRACE')
-        alternative = parse_statements(tokens)
-        tokens.expect('RBRACE')
+    pos = tokens.position(tokens.expect(IF))
+    test = yield parse_expression(tokens)
+    tokens.expect(LBRACE)
+    consequence = yield parse_statements(tokens)
+    tokens.expect(RBRACE)
+    if tokens.accept(ELSE) is not None:
+        tokens.expect(LBRACE)
+        alternative = yield parse_statements(tokens)
+        tokens.expect(RBRACE)
     else:
         alternative = None
-    return record_lineno(IfStatement(test, consequence, alternative), lineno)
+    return record_lineno(IfStatement(test, consequence, alternative), *pos)
 
 def parse_while_statement(tokens):
-    lineno = tokens.expect('WHILE').lineno
-    test = parse_expression(tokens)
-    tokens.expect('LBRACE')
-    body = parse_statements(tokens)
-    tokens.expect('RBRACE')
-    return record_lineno(WhileStatement(test, body), lineno)
+    pos = tokens.position(tokens.expect(WHILE))
+    test = yield parse_expression(tokens)
+    tokens.expect(LBRACE)
+    body = yield parse_statements(tokens)
+    tokens.expect(RBRACE)
+    return record_lineno(WhileStatement(test, body), *pos)
 
 def parse_break_statement(tokens):
     # Example of parsing a simple statement (pseudocode)
-    lineno = tokens.expect('BREAK').lineno
-    tokens.expect('SEMI')
-    return record_lineno(BreakStatement(), lineno)
+    pos = tokens.position(tokens.expect(BREAK))
+    tokens.expect(SEMI)
+    return record_lineno(BreakStatement(), *pos)
 
 def parse_continue_statement(tokens):
-    lineno = tokens.expect('CONTINUE').lineno
-    tokens.expect('SEMI')
-    return record_lineno(ContinueStatement(), lineno)
+    pos = tokens.position(tokens.expect(CONTINUE))
+    tokens.expect(SEMI)
+    return record_lineno(ContinueStatement(), *pos)
 
 def parse_print_statement(tokens):
-    lineno = tokens.expect('PRINT').lineno
-    value = parse_expression(tokens)
-    tokens.expect('SEMI')
-    return record_lineno(PrintStatement(value), lineno)
+    pos = tokens.position(tokens.expect(PRINT))
+    value = yield parse_expression(tokens)
+    tokens.expect(SEMI)
+    return record_lineno(PrintStatement(value), *pos)
 
 def parse_function_declaration(tokens):
-    lineno = tokens.expect('FUNC').lineno
-    nametok = tokens.expect('ID')
-    tokens.expect('LPAREN')
+    pos = tokens.position(tokens.expect(FUNC))
+    nametok = tokens.expect(ID)
+    tokens.expect(LPAREN)
     parameters = []
-    while not tokens.peek('RPAREN'):
-        pname = tokens.expect('ID')
-        ptype = tokens.expect('ID')
-        parm = record_lineno(Parameter(pname.value, ptype.value), pname.lineno)
+    while tokens.peek(RPAREN) is None:
+        pname = tokens.expect(ID)
+        ptype = tokens.expect(ID)
+        parm = record_lineno(Parameter(tokens.value(pname), tokens.value(ptype)), *tokens.position(pname))
         parameters.append(parm)
-        if not tokens.peek('RPAREN'):
-            tokens.expect('COMMA')
-    tokens.expect('RPAREN')
-    rettype = tokens.expect('ID')
-    tokens.expect('LBRACE')
-    body = parse_statements(tokens)
-    tokens.expect('RBRACE')
-    return record_lineno(FunctionDeclaration(nametok.value, parameters, rettype.value, body), lineno)
+        if tokens.peek(RPAREN) is None:
+            tokens.expect(COMMA)
+    tokens.expect(RPAREN)
+    rettype = tokens.expect(ID)
+    tokens.expect(LBRACE)
+    body = yield parse_statements(tokens)
+    tokens.expect(RBRACE)
+    return record_lineno(FunctionDeclaration(tokens.value(nametok), parameters, tokens.value(rettype), body), *pos)
     
 def parse_return_statement(tokens):
-    lineno = tokens.expect('RETURN').lineno
-    value = parse_expression(tokens)
-    tokens.expect('SEMI')
-    return record_lineno(ReturnStatement(value), lineno)
-
-def parse_expression(tokens):
-    return parse_orterm(tokens)
-
-def parse_orterm(tokens):
-    left = parse_andterm(tokens)
-    while (tok := tokens.accept('LOR')):
-        right = parse_andterm(tokens)
-        left = record_lineno(BinOp(tok.value, left, right), tok.lineno)
-    return left
-
-def parse_andterm(tokens):
-    left = parse_relterm(tokens)
-    while (tok := tokens.accept('LAND')):
-        right = parse_relterm(tokens)
-        left = record_lineno(BinOp(tok.value, left, right), tok.lineno)
-    return left
-
-def parse_relterm(tokens):
-    left = parse_addterm(tokens)
-    if (tok := tokens.accept('LT','LE','GT','GE','EQ','NE')):
-        right = parse_addterm(tokens)
-        left = record_lineno(BinOp(tok.value, left, right), tok.lineno)
-    return left
-
-def parse_addterm(tokens):
-    left = parse_multerm(tokens)
-    while (tok := tokens.accept('PLUS','MINUS')):
-        right = parse_multerm(tokens)
-        left = record_lineno(BinOp(tok.value, left, right), tok.lineno)
-    return left
-    
-def parse_multerm(tokens):
-    left = parse_factor(tokens)
-    while (tok := tokens.accept('TIMES','DIVIDE')):
-        right = parse_factor(tokens)
-        left = record_lineno(BinOp(tok.value, left, right), tok.lineno)
-    return left
-    
+    pos = tokens.position(tokens.expect(RETURN))
+    value = yield parse_expression(tokens)
+    tokens.expect(SEMI)
+    return record_lineno(ReturnStatement(value), *pos)
+
+# Expressions are parsed by precedence climbing.  After the left operand,
+# every binary operator that binds at least as tightly as min_bp is
+# folded in, with its right operand parsed at the next tighter level
+# (this makes the operators left-associative).  Once an operator has
+# been folded in, only operators at the same level or looser may follow
+# it, and after a non-associative operator only looser ones.  Anything
+# else is left for the caller to reject, as in a < b < c.
+#
+# Simple operands (literals and names) are parsed directly by
+# parse_atom().  A nested parser is only started for an operand that
+# needs one, or for a right operand that is followed by a tighter
+# binding operator.  In that case the operand already parsed is passed
+# in as left.
+def parse_expression(tokens, min_bp=1, left=None):
+    if left is None:
+        left = parse_atom(tokens)
+        if left is None:
+            left = yield parse_factor(tokens)
+    kinds = tokens.kinds
+    max_bp = len(precedence)
+    while True:
+        tok = tokens.pos
+        bp = binding_power[kinds[tok]]
+        if bp < min_bp or bp > max_bp:
+            return left
+        tokens.pos = tok + 1
+        right = parse_atom(tokens)
+        if right is None or binding_power[kinds[tokens.pos]] > bp:
+            right = yield parse_expression(tokens, bp + 1, right)
+        left = record_lineno(BinOp(tokens.value(tok), left, right), *tokens.position(tok))
+        max_bp = bp - 1 if bp in nonassociative else bp
+
+# Literal kinds and the node classes for them
+_literals = [ None ] * len(token_types)
+_literals[kind['INTEGER']] = Integer
+_literals[kind['FLOAT']] = Float
+_literals[kind['TRUE']] = Boolean
+_literals[kind['FALSE']] = Boolean
+_literals[kind['CHAR']] = Character
+
+def parse_atom(tokens):
+    '''
+    Parse a literal or a name that isn't being called.  Returns None
+    (consuming nothing) for anything else.
+    '''
+    tok = tokens.pos
+    cls = _literals[tokens.kinds[tok]]
+    if cls is not None:
+        tokens.pos = tok + 1
+        return record_lineno(cls(tokens.value(tok)), *tokens.position(tok))
+    if tokens.peek(ID) is not None and not (1 << tokens.kinds[tok + 1]) & LPAREN:
+        return parse_location(tokens)
+    return None
+
 def parse_factor(tokens):
-    tok = tokens.accept('INTEGER')
-    if tok:
-        return record_lineno(Integer(tok.value), tok.lineno)
-    tok = tokens.accept('FLOAT')
-    if tok:
-        return record_lineno(Float(tok.value), tok.lineno)
-    tok = tokens.accept('TRUE', 'FALSE')
-    if tok:
-        return record_lineno(Boolean(tok.value), tok.lineno)
-    tok = tokens.accept('CHAR')
-    if tok:
-        return record_lineno(Character(tok.value), tok.lineno)
-    if tokens.accept('LPAREN'):
-        value = parse_expression(tokens)
-        tokens.expect('RPAREN')
-        return record_lineno(Grouping(value), lineno(value))
-    if tokens.accept('LBRACE'):
-        value = parse_statements(tokens)
-        tokens.accept('RBRACE')
-        return record_lineno(CompoundExpression(value), lineno(value))
-    tok = tokens.accept('PLUS','MINUS','LNOT')
-    if tok:
-        value = parse_factor(tokens)
-        return record_lineno(UnaryOp(tok.value, value), tok.lineno)
-    if tokens.peek('ID'):
+    tok = tokens.accept(INTEGER)
+    if tok is not None:
+        return record_lineno(Integer(tokens.value(tok)), *tokens.position(tok))
+    tok = tokens.accept(FLOAT)
+    if tok is not None:
+        return record_lineno(Float(tokens.value(tok)), *tokens.position(tok))
+    tok = tokens.accept(BOOLEAN)
+    if tok is not None:
+        return record_lineno(Boolean(tokens.value(tok)), *tokens.position(tok))
+    tok = tokens.accept(CHAR)
+    if tok is not None:
+        return record_lineno(Character(tokens.value(tok)), *tokens.position(tok))
+    if tokens.accept(LPAREN) is not None:
+        value = yield parse_expression(tokens)
+        tokens.expect(RPAREN)
+        return record_lineno(Grouping(value), *position(value))
+    if tokens.accept(LBRACE) is not None:
+        value = yield parse_statements(tokens)
+        tokens.accept(RBRACE)
+        return record_lineno(CompoundExpression(value), *position(value))
+    tok = tokens.accept(UNARYOPS)
+    if tok is not None:
+        value = parse_atom(tokens)
+        if value is None:
+            value = yield parse_factor(tokens)
+        return record_lineno(UnaryOp(tokens.value(tok), value), *tokens.position(tok))
+    if tokens.peek(ID) is not None:
         loc = parse_location(tokens)
-        if tokens.accept('LPAREN'):
-            args = parse_arguments(tokens)
-            tokens.expect('RPAREN')
-            return record_lineno(FunctionApplication(loc, args), lineno(loc))
+        if tokens.accept(LPAREN) is not None:
+            args = yield parse_arguments(tokens)
+            tokens.expect(RPAREN)
+            return record_lineno(FunctionApplication(loc, args), *position(loc))
         else:
             return loc
         
@@ -256,22 +351,26 @@ def parse_factor(tokens):
 
 def parse_arguments(tokens):
     arguments = []
-    while not tokens.peek('RPAREN'):
-        expr = parse_expression(tokens)
-        if not tokens.peek('RPAREN'):
-            tokens.expect('COMMA')
+    while tokens.peek(RPAREN) is None:
+        expr = yield parse_expression(tokens)
+        if tokens.peek(RPAREN) is None:
+            tokens.expect(COMMA)
         arguments.append(expr)
     return arguments
 
 def parse_location(tokens):
-    name = tokens.expect('ID')
-    return record_lineno(Name(name.value), name.lineno)
+    name = tokens.expect(ID)
+    return record_lineno(Name(tokens.value(name)), *tokens.position(name))
+
+# Parse source held in a bytes-like buffer (bytes, mmap, memoryview)
+# without first copying it into a str
+def parse_buffer(buf):
+    return parse_program(Tokens(tokenize_array(buf)))
 
 # Example of a main program
 def parse_file(filename):
-    with open(filename) as file:
-        text = file.read()
-    return parse_source(text)
+    with map_file(filename) as buf:
+        return parse_buffer(buf)
 
 if __name__ == '__main__':
     import sys
@@ -0,0 +1,143 @@
+# peephole.py
+#
+# Peephole optimizer for the instructions in a WasmFunction.  It runs on
+# the module made by wasm.generate_module() before it is written out as
+# WAT text or encoded as binary.
+#
+# The optimizations are a table of rules.  Each rule has a pattern, a
+# sequence of opcodes, and a function that gets the matching (opcode,
+# operand) instructions and returns the instructions to use instead (or
+# None to leave them alone).  Rules are added with the @rule decorator:
+#
+#     @rule('local.set', 'local.get')
+#     def tee(store, load):
+#         ...
+#
+# Instructions are moved one at a time to the output.  After each one,
+# the rules whose pattern ends with its opcode are tried against the
+# end of the output.  A replacement goes back on the output and is
+# tried again, so rules combine (i32.lt_s; i32.eqz; i32.eqz becomes
+# i32.ge_s; i32.eqz and then i32.lt_s) in one pass over the code.
+#
+# Function wrapper
+# ----------------
+# Every function starts out wrapped in "block $return ... end" with a
+# local $return holding the result if the code runs off the end.
+# Nothing branches to $return, so the block is dropped.  The local is
+# only ever zero, so running off the end just pushes a zero (and if the
+# code ends with a return, there is nothing to push).
+
+from .binary import wrap_i32
+
+_rules = { }            # last opcode -> [ (pattern, rewrite) ]
+
+def rule(*pattern):
+    def register(func):
+        _rules.setdefault(pattern[-1], []).append((pattern, func))
+        return func
+    return register
+
+def optimize_module(mod):
+    for func in mod.functions:
+        optimize_function(func)
+    return mod
+
+def optimize_function(func):
+    func.code = optimize_code(func.code)
+    unwrap_function(func)
+    return func
+
+def optimize_code(code):
+    out = [ ]
+    pending = [ ]
+    for instr in code:
+        pending.append(instr)
+        while pending:
+            out.append(pending.pop())
+            for pattern, rewrite in _rules.get(out[-1][0], ()):
+                size = len(pattern)
+                if len(out) < size:
+                    continue
+                window = out[-size:]
+                if any(instr[0] != op for instr, op in zip(window, pattern)):
+                    continue
+                replacement = rewrite(*window)
+                if replacement is not None:
+                    del out[-size:]
+                    # Put the replacement back through the rules
+                    pending.extend(reversed(replacement))
+                    break
+    return out
+
+def unwrap_function(func):
+    if not func.wrapped:
+        return
+    if any(op in ('br', 'br_if') and arg == 'return' for op, arg in func.code):
+        return
+    func.wrapped = False
+    if func.ret_type and not (func.code and func.code[-1][0] in _ends_code):
+        func.code.append(_zeros[func.ret_type])
+
+# Instructions after which the end of the function can't be reached
+_ends_code = { 'return', 'br', 'unreachable' }
+
+_zeros = {
+    'int': ('i32.const', 0),
+    'float': ('f64.const', 0.0),
+    'bool': ('i32.const', 0),
+    'char': ('i32.const', 0),
+    }
+
+# Rules
+
+@rule('i32.eqz', 'i32.eqz', 'br_if')
+@rule('i32.eqz', 'i32.eqz', 'if')
+def double_not(first, second, branch):
+    return [ branch ]
+
+_inverse = {
+    'i32.eq': 'i32.ne',
+    'i32.ne': 'i32.eq',
+    'i32.lt_s': 'i32.ge_s',
+    'i32.ge_s': 'i32.lt_s',
+    'i32.gt_s': 'i32.le_s',
+    'i32.le_s': 'i32.gt_s',
+    }
+
+def inverse_compare(compare, eqz):
+    # Not for f64, since comparisons with NaN are false both ways
+    return [ (_inverse[compare[0]], None) ]
+
+for _compare in _inverse:
+    rule(_compare, 'i32.eqz')(inverse_compare)
+
+@rule('local.set', 'local.get')
+def tee(store, load):
+    if store[1] == load[1]:
+        return [ ('local.tee', store[1]) ]
+
+@rule('i32.const', 'i32.const', 'i32.sub')
+def negate_int(zero, const, sub):
+    if zero[1] == 0:
+        return [ ('i32.const', wrap_i32(-const[1])) ]
+
+@rule('f64.const', 'f64.const', 'f64.sub')
+def negate_float(zero, const, sub):
+    # Unary minus is 0.0 - x (so -0.0 gives 0.0), which is kept here
+    if zero[1] == 0.0:
+        return [ ('f64.const', zero[1] - const[1]) ]
+
+# Main function (for testing)
+def main(filename):
+    from .parse import parse_file
+    from .typecheck import check_program
+    from .wasm import generate_module
+    model = parse_file(filename)
+    if check_program(model):
+        print(optimize_module(generate_module(model, optimize=False)))
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) != 2:
+        raise SystemExit('usage: python3 -m wabbit.peephole filename')
+    main(sys.argv[1])
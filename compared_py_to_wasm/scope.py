@@ -0,0 +1,154 @@
+# scope.py
+#
+# Nested symbol table used by the checker and the code generator.
+#
+# It does the same job as a ChainMap with new_child()/parents, but
+# every operation is O(1) no matter how deeply the scopes are nested.
+# A ChainMap copies its list of maps on every new_child() and parents,
+# and a lookup walks the maps, so deeply nested programs take quadratic
+# time with it.  Here each name maps to a list of its definitions,
+# innermost last, and every open scope records the names defined in
+# it so they can be removed when it closes.
+
+class Scope:
+    def __init__(self):
+        self.bindings = { }       # name -> [value, ...] (innermost last)
+        self.scopes = [ { } ]     # one dict of names per open scope
+
+    def __getitem__(self, name):
+        return self.bindings[name][-1]
+
+    def get(self, name, default=None):
+        values = self.bindings.get(name)
+        return values[-1] if values else default
+
+    def __contains__(self, name):
+        return name in self.bindings
+
+    def __setitem__(self, name, value):
+        '''
+        Define name in the innermost scope (replacing any definition
+        already made in that scope).
+        '''
+        if name in self.scopes[-1]:
+            self.bindings[name][-1] = value
+        else:
+            self.scopes[-1][name] = True
+            self.bindings.setdefault(name, []).append(value)
+
+    def defined_here(self, name):
+        '''
+        True if name is defined in the innermost scope
+        '''
+        return name in self.scopes[-1]
+
+    def push(self):
+        self.scopes.append({ })
+
+    def pop(self):
+        for name in self.scopes.pop():
+            values = self.bindings[name]
+            values.pop()
+            if not values:
+                del self.bindings[name]
+
+# A Scope that keeps a history of its definitions, so that what was
+# visible at an earlier point can still be looked up after the scopes
+# have changed.  The code generator uses it to hand each function
+# declaration to a worker process with just a point in the history
+# (instead of a copy of every definition it can see).
+#
+# Each definition is an entry [start, end, value, outer], where start
+# and end are values of the clock (end is None while it's visible) and
+# outer is the entry of the same name it hides, if any.  The clock
+# goes up with every definition and every scope closed.
+
+_missing = object()
+
+class RecordingScope(Scope):
+    def __init__(self):
+        super().__init__()
+        self.clock = 0
+        self.history = { }         # name -> [entry, ...] in order of start
+        self.visible = { }         # name -> [entry, ...] innermost last
+
+    def __setitem__(self, name, value):
+        self.clock += 1
+        visible = self.visible.setdefault(name, [])
+        if name in self.scopes[-1]:
+            replaced = visible.pop()
+            replaced[1] = self.clock
+            outer = replaced[3]
+        else:
+            outer = visible[-1] if visible else None
+        entry = [ self.clock, None, value, outer ]
+        visible.append(entry)
+        self.history.setdefault(name, []).append(entry)
+        super().__setitem__(name, value)
+
+    def pop(self):
+        self.clock += 1
+        for name in self.scopes[-1]:
+            visible = self.visible[name]
+            visible.pop()[1] = self.clock
+            if not visible:
+                del self.visible[name]
+        super().pop()
+
+    def view(self, point=None):
+        '''
+        The definitions that were visible when the clock read point (by
+        default, now).
+        '''
+        return ScopeView(self.history, self.clock if point is None else point)
+
+class ScopeView:
+    '''
+    Read-only view of the definitions in a history at one point.  A
+    lookup takes time for the nesting depth, not the size of the history.
+    '''
+    def __init__(self, history, point):
+        self.history = history
+        self.point = point
+
+    def get(self, name, default=None):
+        entries = self.history.get(name)
+        if not entries:
+            return default
+        # The last entry started by the point, or one it was hidden by
+        low, high = 0, len(entries)
+        while low < high:
+            mid = (low + high) // 2
+            if entries[mid][0] <= self.point:
+                low = mid + 1
+            else:
+                high = mid
+        entry = entries[low - 1] if low else None
+        while entry is not None and entry[1] is not None and entry[1] <= self.point:
+            entry = entry[3]
+        return default if entry is None else entry[2]
+
+class LayeredScope(Scope):
+    '''
+    A Scope on top of a base (such as a ScopeView) that supplies the
+    names not defined in the scope itself.
+    '''
+    def __init__(self, base):
+        super().__init__()
+        self.base = base
+
+    def __getitem__(self, name):
+        values = self.bindings.get(name)
+        if values:
+            return values[-1]
+        value = self.base.get(name, _missing)
+        if value is _missing:
+            raise KeyError(name)
+        return value
+
+    def get(self, name, default=None):
+        values = self.bindings.get(name)
+        return values[-1] if values else self.base.get(name, default)
+
+    def __contains__(self, name):
+        return name in self.bindings or self.base.get(name, _missing) is not _missing
@@ -1,6 +1,12 @@
 # tokenizer.py
 # -------------------------------
 
+from array import array
+from contextlib import contextmanager
+import mmap
+import re
+import sys
+
 # Class that represents a token
 class Token:
     def __init__(self, type, value, lineno):
@@ -39,8 +45,24 @@ _literals = {
     }
 
 _keywords = { 'print', 'if', 'else', 'var', 'const', 'func', 'while', 'break', 'continue', 'return', 'true', 'false' }
-    
-def tokenize(text):
+
+def error(lineno, message):
+    print(f'{lineno}: {message}')
+
+def tokenize(text, fast=True):
+    '''
+    Return a generator of tokens.  By default this uses the regex
+    based scanner below.  Input that isn't pure ASCII goes through the
+    character-by-character scanner so that str.isalpha()/isdigit()
+    decide what is an identifier or a number, exactly as before.
+    '''
+    if fast and text.isascii():
+        return _tokenize_fast(text)
+    else:
+        return _tokenize_slow(text)
+
+# Reference scanner.  Walks the text one character at a time.
+def _tokenize_slow(text):
     n = 0
     lineno = 1
     size = len(text)
@@ -129,23 +151,351 @@ def tokenize(text):
             error(lineno, f'Illegal character {text[n]!r}')
             n += 1
 
+# Fast scanner.  One compiled master pattern recognizes every lexeme
+# and the name of the matching group says what it is.  The alternatives
+# that can start with the same character ('/') are tried in the same
+# order as the reference scanner, so both produce the same token stream
+# (including error messages).  Leading blanks are folded into each
+# match and a run of newlines is a single match.
+_pattern = r'''
+    [ \t]*
+    (?:
+      (?P<NAME>%(name)s)
+    | (?P<OP><=|>=|==|!=|&&|\|\||[-+*;(){},<>=!])
+    | (?P<NEWLINE>(?:\n[ \t]*)+)
+    | (?P<NUMBER>\d+(?P<FRACTION>\.\d*)?)
+    | (?P<COMMENT>/\*(?:/|[\s\S]*?\*/))
+    | (?P<BADCOMMENT>/\*)
+    | (?P<LINECOMMENT>//[^\n]*\n?)
+    | (?P<DIVIDE>/)
+    | (?P<DOT>\.\d*)
+    | (?P<CHAR>'(?:\\[\s\S]|[^'\\])*')
+    | (?P<BADCHAR>'[\s\S]*)
+    | (?P<WS>[ \t]+)
+    | (?P<ERROR>[\s\S])
+    )
+'''
+_master = re.compile(_pattern % { 'name': r'[A-Za-z_]\w*' }, re.VERBOSE | re.ASCII)
+
+def _tokenize_fast(text):
+    lineno = 1
+    literals = _literals
+    keywords = _keywords
+    for m in _master.finditer(text):
+        kind = m.lastgroup
+        if kind == 'NAME':
+            value = m['NAME']
+            if value in keywords:
+                yield Token(value.upper(), value, lineno)
+            else:
+                yield Token('ID', value, lineno)
+        elif kind == 'OP':
+            value = m['OP']
+            yield Token(literals[value], value, lineno)
+        elif kind == 'NEWLINE':
+            lineno += m['NEWLINE'].count('\n')
+        elif kind == 'NUMBER':
+            yield Token('FLOAT' if m['FRACTION'] else 'INTEGER', m['NUMBER'], lineno)
+        elif kind == 'COMMENT':
+            lineno += m['COMMENT'].count('\n')
+        elif kind == 'LINECOMMENT':
+            lineno += 1
+        elif kind == 'DIVIDE':
+            yield Token('DIVIDE', '/', lineno)
+        elif kind == 'DOT':
+            value = m['DOT']
+            yield Token('FLOAT' if len(value) > 1 else 'DOT', value, lineno)
+        elif kind == 'CHAR':
+            yield Token('CHAR', m['CHAR'], lineno)
+        elif kind == 'BADCHAR':
+            error(lineno, "Unterminated character constant")
+            yield Token('CHAR', m['BADCHAR'], lineno)
+        elif kind == 'BADCOMMENT':
+            error(lineno, "Unterminated comment")
+            return
+        elif kind == 'ERROR':
+            error(lineno, f'Illegal character {m["ERROR"]!r}')
+
+# Zero-copy scanner.  This works directly on a bytes-like buffer
+# (bytes, mmap, memoryview, ...) holding UTF-8 source.  Tokens only
+# record where they are in the buffer.  The text of a token is decoded
+# the first time something asks for its value, so keywords and
+# operators that the parser only checks by type never become strings.
+#
+# Bytes outside of ASCII are treated as identifier characters.
+class BufferToken:
+    __slots__ = ('type', 'start', 'end', 'lineno', '_buf', '_value')
+
+    def __init__(self, type, buf, start, end, lineno):
+        self.type = type
+        self.start = start
+        self.end = end
+        self.lineno = lineno
+        self._buf = buf
+        self._value = None
+
+    @property
+    def value(self):
+        if self._value is None:
+            self._value = str(self._buf[self.start:self.end], 'utf-8')
+        return self._value
+
+    def __repr__(self):
+        return f'Token({self.type!r}, {self.value!r}, {self.lineno})'
+
+_master_bytes = re.compile((_pattern % { 'name': r'[A-Za-z_\x80-\xff][\w\x80-\xff]*' }).encode('ascii'),
+                           re.VERBOSE | re.ASCII)
+_keywords_bytes = { kw.encode('ascii'): kw.upper() for kw in _keywords }
+_literals_bytes = { op.encode('ascii'): toktype for op, toktype in _literals.items() }
+
+def tokenize_buffer(buf):
+    lineno = 1
+    literals = _literals_bytes
+    keywords = _keywords_bytes
+    for m in _master_bytes.finditer(buf):
+        kind = m.lastgroup
+        if kind == 'NAME':
+            start, end = m.span('NAME')
+            if keyword := keywords.get(m['NAME']):
+                yield BufferToken(keyword, buf, start, end, lineno)
+            else:
+                yield BufferToken('ID', buf, start, end, lineno)
+        elif kind == 'OP':
+            start, end = m.span('OP')
+            yield BufferToken(literals[m['OP']], buf, start, end, lineno)
+        elif kind == 'NEWLINE':
+            lineno += m['NEWLINE'].count(b'\n')
+        elif kind == 'NUMBER':
+            start, end = m.span('NUMBER')
+            yield BufferToken('FLOAT' if m.start('FRACTION') >= 0 else 'INTEGER', buf, start, end, lineno)
+        elif kind == 'COMMENT':
+            lineno += m['COMMENT'].count(b'\n')
+        elif kind == 'LINECOMMENT':
+            lineno += 1
+        elif kind == 'DIVIDE':
+            start, end = m.span('DIVIDE')
+            yield BufferToken('DIVIDE', buf, start, end, lineno)
+        elif kind == 'DOT':
+            start, end = m.span('DOT')
+            yield BufferToken('FLOAT' if end - start > 1 else 'DOT', buf, start, end, lineno)
+        elif kind == 'CHAR':
+            start, end = m.span('CHAR')
+            yield BufferToken('CHAR', buf, start, end, lineno)
+        elif kind == 'BADCHAR':
+            error(lineno, "Unterminated character constant")
+            start, end = m.span('BADCHAR')
+            yield BufferToken('CHAR', buf, start, end, lineno)
+        elif kind == 'BADCOMMENT':
+            error(lineno, "Unterminated comment")
+            return
+        elif kind == 'ERROR':
+            error(lineno, f'Illegal character {m["ERROR"].decode("ascii")!r}')
+
+# Struct-of-arrays token buffer.  Instead of one object per token, the
+# tokens are rows in parallel arrays: the kind (a small integer index
+# into token_types), the (start, end) offsets into the source and the
+# line number.  The source may be a str or a bytes-like buffer.  This is
+# what the parser works on.
+token_types = ('EOF', 'ID', 'INTEGER', 'FLOAT', 'CHAR', 'DOT',
+               *sorted(kw.upper() for kw in _keywords),
+               *_literals.values())
+kind = { toktype: n for n, toktype in enumerate(token_types) }
+
+class TokenArray:
+    def __init__(self, source):
+        self.source = source
+        self.kinds = array('B')
+        self.starts = array('q')
+        self.ends = array('q')
+        self.linenos = array('l')
+        self._values = None        # Token text, if it can't be sliced from source
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def type(self, n):
+        return token_types[self.kinds[n]]
+
+    def value(self, n):
+        if self._values is not None:
+            return self._values[n]
+        value = self.source[self.starts[n]:self.ends[n]]
+        return value if isinstance(value, str) else str(value, 'utf-8')
+
+    def lineno(self, n):
+        return self.linenos[n]
+
+    def column(self, n):
+        # Columns count from 1.  They are worked out from the offsets, so
+        # tokens from the slow (non-ASCII) path don't have one.
+        if self._values is not None:
+            return None
+        start = self.starts[n]
+        newline = '\n' if isinstance(self.source, str) else b'\n'
+        return start - self.source.rfind(newline, 0, start)
+
+    def token(self, n):
+        return Token(self.type(n), self.value(n), self.lineno(n))
+
+    def __iter__(self):
+        return (self.token(n) for n in range(len(self.kinds)))
+
+_groups = _master.groupindex
+_NAME, _OP, _NEWLINE, _NUMBER, _FRACTION, _COMMENT, _BADCOMMENT, _LINECOMMENT, \
+    _DIVIDE, _DOT, _CHAR, _BADCHAR, _WS = (_groups[name] for name in (
+        'NAME', 'OP', 'NEWLINE', 'NUMBER', 'FRACTION', 'COMMENT', 'BADCOMMENT', 'LINECOMMENT',
+        'DIVIDE', 'DOT', 'CHAR', 'BADCHAR', 'WS'))
+
+_keyword_kinds = { kw: kind[kw.upper()] for kw in _keywords }
+_literal_kinds = { op: kind[toktype] for op, toktype in _literals.items() }
+_keyword_kinds_bytes = { kw.encode('ascii'): k for kw, k in _keyword_kinds.items() }
+_literal_kinds_bytes = { op.encode('ascii'): k for op, k in _literal_kinds.items() }
+
+def tokenize_array(source):
+    '''
+    Tokenize a str or bytes-like buffer into a TokenArray.  The array
+    always ends with an EOF token.
+    '''
+    tokens = TokenArray(source)
+    if isinstance(source, str) and not source.isascii():
+        kinds = tokens.kinds.append
+        starts = tokens.starts.append
+        ends = tokens.ends.append
+        linenos = tokens.linenos.append
+        lineno = 1
+        # Same rule as tokenize(): non-ASCII text takes the slow path
+        tokens._values = [ ]
+        for tok in _tokenize_slow(source):
+            kinds(kind[tok.type])
+            starts(0)
+            ends(0)
+            linenos(tok.lineno)
+            tokens._values.append(tok.value)
+            lineno = tok.lineno
+        kinds(kind['EOF'])
+        starts(0)
+        ends(0)
+        linenos(lineno)
+        tokens._values.append('')
+        return tokens
+    scan_into(tokens, source)
+    return tokens
+
+def scan_into(tokens, source, pos=0, lineno=1, resync=None, errors=None):
+    '''
+    Scan source (an ASCII str or bytes-like buffer) from offset pos,
+    which is on line lineno, and append the tokens to the TokenArray
+    tokens, ending with EOF.  pos has to be at the start of a token or
+    between tokens (not in a comment or a literal).
+
+    resync is for scanning again after an edit (see incremental.py).
+    It's (old, j, delta): old is the TokenArray from before the edit,
+    and its tokens from j on come after the edited text, which moved
+    them by delta.  If the scan gets to a token that is one of those
+    (same kind and the same place, after moving it), everything from
+    there on would come out the same as before.  The scan then stops
+    without adding the token and returns (index in old, line number).
+    Otherwise it returns None.
+
+    Errors are printed, unless a list is given for errors.  They are
+    then added to it as (offset, lineno, message).
+    '''
+    kinds = tokens.kinds.append
+    starts = tokens.starts.append
+    ends = tokens.ends.append
+    linenos = tokens.linenos.append
+    if resync is None:
+        sync_start = sys.maxsize
+    else:
+        old, j, delta = resync
+        last = len(old) - 1
+        sync_start = old.starts[j] + delta if j < last else sys.maxsize
+    report = error if errors is None else (lambda lineno, message: errors.append((m.start(m.lastindex), lineno, message)))
+    if isinstance(source, str):
+        master, keywords, literals, newline = _master, _keyword_kinds, _literal_kinds, '\n'
+    else:
+        master, keywords, literals, newline = _master_bytes, _keyword_kinds_bytes, _literal_kinds_bytes, b'\n'
+
+    ID, INTEGER, FLOAT, CHAR, DOT, DIVIDE = (kind[toktype] for toktype in ('ID', 'INTEGER', 'FLOAT', 'CHAR', 'DOT', 'DIVIDE'))
+    for m in master.finditer(source, pos):
+        group = m.lastindex
+        if group == _NAME:
+            k = keywords.get(m[group], ID)
+        elif group == _OP:
+            k = literals[m[group]]
+        elif group == _NEWLINE:
+            lineno += m[group].count(newline)
+            continue
+        elif group == _NUMBER:
+            k = FLOAT if m.start(_FRACTION) >= 0 else INTEGER
+        elif group == _COMMENT:
+            lineno += m[group].count(newline)
+            continue
+        elif group == _LINECOMMENT:
+            lineno += 1
+            continue
+        elif group == _DIVIDE:
+            k = DIVIDE
+        elif group == _DOT:
+            k = FLOAT if m.end(group) - m.start(group) > 1 else DOT
+        elif group == _CHAR:
+            k = CHAR
+        elif group == _BADCHAR:
+            report(lineno, "Unterminated character constant")
+            k = CHAR
+        elif group == _BADCOMMENT:
+            report(lineno, "Unterminated comment")
+            break
+        elif group == _WS:
+            continue
+        else:
+            char = m[group]
+            report(lineno, f'Illegal character {char if isinstance(char, str) else char.decode("ascii")!r}')
+            continue
+        start, end = m.span(group)
+        if start >= sync_start:
+            while sync_start < start:
+                j += 1
+                sync_start = old.starts[j] + delta if j < last else sys.maxsize
+            if sync_start == start and old.ends[j] + delta == end and old.kinds[j] == k:
+                return j, lineno
+        kinds(k)
+        starts(start)
+        ends(end)
+        linenos(lineno)
+    kinds(kind['EOF'])
+    starts(len(source))
+    ends(len(source))
+    linenos(lineno)
+    return None
+
+@contextmanager
+def map_file(filename):
+    '''
+    Memory-map a file read-only for tokenize_buffer().  Empty files
+    can't be mapped, so those give an empty bytes object.
+    '''
+    with open(filename, 'rb') as file:
+        try:
+            buf = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            yield b''
+            return
+        with buf:
+            yield buf
+
 # Main program to test on input files
 def main(filename):
-    with open(filename) as file:
-        text = file.read()
-
-    for tok in tokenize(text):
-        print(tok)
+    with map_file(filename) as buf:
+        tokens = tokenize_buffer(buf)
+        try:
+            for tok in tokens:
+                print(tok)
+        finally:
+            tokens.close()
 
 if __name__ == '__main__':
     import sys
     if len(sys.argv) != 2:
         raise SystemExit("Usage: python3 -m wabbit.tokenize filename")
     main(sys.argv[1])
-
-    
-            
-        
-
-            
-    
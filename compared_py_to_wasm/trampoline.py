@@ -0,0 +1,57 @@
+# trampoline.py
+#
+# Running tree walks without Python recursion.
+#
+# A walker is written as a generator function.  Where it would normally
+# call itself on a child, it yields the generator for the child instead
+# and gets the child's result back from the yield:
+#
+#     def check(node, context):
+#         ...
+#         ltype = yield check(node.left, context)
+#
+# A walker for a node that has nothing to walk (a literal, say) can just
+# return its result instead of a generator.  Anything yielded that isn't
+# a generator is taken to be the child's result as is, which saves
+# creating a generator for every leaf.
+#
+# trampoline() runs the outermost generator, keeping the suspended
+# walkers on an explicit list.  So the depth of the tree is limited
+# only by memory, not by the recursion limit or the C stack.  If a
+# walker raises an exception, the walkers waiting on it are closed
+# (innermost first, so their with statements and finally blocks run)
+# and the exception propagates out of trampoline() unchanged.
+
+from types import GeneratorType
+
+def trampoline(gen):
+    '''
+    Run a generator-based walker to completion and return its result.
+    '''
+    if type(gen) is not GeneratorType:
+        return gen
+    stack = [ gen ]
+    push = stack.append
+    pop = stack.pop
+    send = gen.send
+    value = None
+    try:
+        while True:
+            try:
+                child = send(value)
+            except StopIteration as e:
+                pop()
+                if not stack:
+                    return e.value
+                send = stack[-1].send
+                value = e.value
+            else:
+                if type(child) is GeneratorType:
+                    push(child)
+                    send = child.send
+                    value = None
+                else:
+                    value = child
+    finally:
+        while stack:
+            stack.pop().close()
@@ -1,13 +1,1369 @@
 # transform.py
-
 #
+# Optimizations on the model.  These run after type checking, so they
+# can assume a well-typed program, and produce a model that any of the
+# backends can take.
+#
+# Constant folding and propagation
+# --------------------------------
+# Operators, groupings and type conversions whose operands are all
+# literals are evaluated at compile time and replaced by a literal.
+# Constants declared with a literal value (possibly after folding) are
+# substituted into every place they're used, and the declaration itself
+# is dropped:
+#
+#     const n = 10;                     print 15;
+#     print n + 5;            ==>       print 1.5;
+#     print float(3) / 2.0;
+#
+# Folding follows the Wasm code exactly.  Integers are 32 bits and wrap
+# around, division truncates towards zero, floats are IEEE doubles and
+# -x is computed as 0 - x.  An operation that would trap at runtime
+# (integer division by zero, or an out-of-range float to int
+# conversion) is left alone, as is floating point division by zero.
+#
+# Dead code elimination
+# ---------------------
+# Statements that can never run are removed: anything after a return,
+# break or continue, the branch of an if statement that the (folded)
+# test never takes, and "while false" loops.  Then variables and
+# constants that are never read are removed, along with all of the
+# assignments to them.  If computing the value has a side effect, that
+# part is kept as an expression statement.  Reads made only to compute
+# the value of another unused variable don't count.  The last statement
+# of a compound expression gives it its value, so it is left alone.
+#
+# The passes don't modify the model they are given.  A node is only
+# copied if something under it changed.  Like check() and generate(),
+# each pass looks up a handler by node type and is run by trampoline().
+
+from bisect import bisect_left
 
 from .model import *
+from .scope import Scope
+from .trampoline import trampoline
 
 def transform(node):
     # Return the node back (unmodified) or a new node in its place
+    node = inline_functions(node)
+    node = fold_constants(node)
+    node = prune_unreachable(node)
+    node = remove_unused(node)
+    node = hoist_invariants(node)
+    return node
+
+# Helpers for building nodes
+
+def _fields(cls):
+    fields = [ ]
+    for klass in reversed(cls.__mro__):
+        fields.extend(getattr(klass, '__slots__', ()))
+    return fields
+
+def replace(node, **changes):
+    '''
+    Return a copy of node with some fields changed.  The position is
+    kept.
+    '''
+    cls = type(node)
+    new = cls.__new__(cls)
+    for field in _fields(cls):
+        if field in changes:
+            setattr(new, field, changes[field])
+        elif hasattr(node, field):
+            setattr(new, field, getattr(node, field))
+    return new
+
+def _located(new, node):
+    # Give a new node the position of the node it replaces
+    for field in ('lineno', 'col'):
+        if hasattr(node, field):
+            setattr(new, field, getattr(node, field))
+    return new
+
+# Literals and their values.  Values are Python ints (i32 range), floats
+# and bools.  Characters are their code point.
+
+def wrap_i32(value):
+    return ((value + 0x80000000) & 0xffffffff) - 0x80000000
+
+def literal_value(node):
+    '''
+    Return (type, value) for a literal node or None for anything else.
+    '''
+    cls = type(node)
+    if cls is Integer:
+        return 'int', wrap_i32(int(node.value))
+    elif cls is Float:
+        return 'float', float(node.value)
+    elif cls is Boolean:
+        return 'bool', node.value == 'true'
+    elif cls is Character:
+        return 'char', ord(eval(node.value))
+    return None
+
+def make_literal(valtype, value):
+    '''
+    Make a literal node for a value.  Returns None if the value can't
+    be written as a literal of that type.
+    '''
+    if valtype == 'int':
+        return Integer(str(value))
+    elif valtype == 'float':
+        if value - value != 0.0:
+            return None            # inf and nan have no literal
+        return Float(repr(value))
+    elif valtype == 'bool':
+        if value not in (0, 1):
+            return None
+        return Boolean('true' if value else 'false')
+    elif valtype == 'char':
+        if not 0 <= value <= 0x10ffff:
+            return None
+        return Character(repr(chr(value)))
+    return None
+
+def is_literal(node):
+    return type(node) in _literal_classes
+
+_literal_classes = { Integer, Float, Boolean, Character }
+
+# Evaluation of operators.  These return the (type, value) of the result
+# or None if the operation can't be done at compile time.
+
+def fold_binop(op, left, right):
+    ltype, lvalue = left
+    rtype, rvalue = right
+    if op in _comparisons:
+        return 'bool', _comparisons[op](lvalue, rvalue)
+    if ltype == 'int':
+        if op == '+':
+            return 'int', wrap_i32(lvalue + rvalue)
+        elif op == '-':
+            return 'int', wrap_i32(lvalue - rvalue)
+        elif op == '*':
+            return 'int', wrap_i32(lvalue * rvalue)
+        elif op == '/':
+            if rvalue == 0 or (lvalue == -0x80000000 and rvalue == -1):
+                return None
+            quotient = abs(lvalue) // abs(rvalue)
+            return 'int', -quotient if (lvalue < 0) != (rvalue < 0) else quotient
+    elif ltype == 'float':
+        if op == '+':
+            return 'float', lvalue + rvalue
+        elif op == '-':
+            return 'float', lvalue - rvalue
+        elif op == '*':
+            return 'float', lvalue * rvalue
+        elif op == '/':
+            if rvalue == 0.0:
+                return None
+            return 'float', lvalue / rvalue
+    elif ltype == 'bool':
+        # Both sides always get evaluated, so these are just and/or
+        if op == '&&':
+            return 'bool', lvalue and rvalue
+        elif op == '||':
+            return 'bool', lvalue or rvalue
+    return None
+
+_comparisons = {
+    '<': lambda x, y: x < y,
+    '<=': lambda x, y: x <= y,
+    '>': lambda x, y: x > y,
+    '>=': lambda x, y: x >= y,
+    '==': lambda x, y: x == y,
+    '!=': lambda x, y: x != y,
+    }
+
+def fold_unaryop(op, operand):
+    optype, value = operand
+    if op == '+':
+        return operand
+    elif op == '-':
+        if optype == 'float':
+            return 'float', 0.0 - value
+        return optype, wrap_i32(0 - value)
+    elif op == '!':
+        return 'bool', not value
+    return None
+
+def fold_conversion(totype, operand):
+    optype, value = operand
+    if totype == 'float':
+        return 'float', float(value)
+    if optype == 'float':
+        # i32.trunc_f64_s traps on NaN and out of range values
+        if value != value or not -2147483649.0 < value < 2147483648.0:
+            return None
+        value = int(value)
+    return totype, int(value)
+
+_conversions = { 'int', 'float', 'bool', 'char' }
+
+# Constant folding and propagation.  The environment maps each name in
+# scope to the literal it stands for, or None if it isn't a constant.
+
+_folders = { }
+
+def folds(*classes):
+    def register(func):
+        for cls in classes:
+            _folders[cls] = func
+        return func
+    return register
+
+def fold_constants(node):
+    return trampoline(fold(node, Scope()))
+
+def fold(node, env):
+    folder = _folders.get(type(node))
+    if folder is None:
+        raise RuntimeError(f"Can't fold {node}")
+    return folder(node, env)
+
+def _result(node, result):
+    # Turn a folded (type, value) into a literal for node (if possible)
+    if result is not None:
+        literal = make_literal(*result)
+        if literal is not None:
+            return _located(literal, node)
+    return node
+
+@folds(Integer, Float, Boolean, Character, BreakStatement, ContinueStatement)
+def fold_leaf(node, env):
+    return node
+
+@folds(Name)
+def fold_Name(node, env):
+    value = env.get(node.value)
+    if value is None:
+        return node
+    return _located(replace(value), node)
+
+@folds(BinOp)
+def fold_BinOp(node, env):
+    left = yield fold(node.left, env)
+    right = yield fold(node.right, env)
+    if is_literal(left) and is_literal(right):
+        folded = _result(node, fold_binop(node.op, literal_value(left), literal_value(right)))
+        if folded is not node:
+            return folded
+    if left is not node.left or right is not node.right:
+        node = replace(node, left=left, right=right)
+    return node
+
+@folds(UnaryOp)
+def fold_UnaryOp(node, env):
+    operand = yield fold(node.operand, env)
+    if is_literal(operand):
+        folded = _result(node, fold_unaryop(node.op, literal_value(operand)))
+        if folded is not node:
+            return folded
+    if operand is not node.operand:
+        node = replace(node, operand=operand)
+    return node
+
+@folds(Grouping)
+def fold_Grouping(node, env):
+    expression = yield fold(node.expression, env)
+    if is_literal(expression):
+        return expression
+    if expression is not node.expression:
+        node = replace(node, expression=expression)
+    return node
+
+@folds(FunctionApplication)
+def fold_FunctionApplication(node, env):
+    changed = False
+    arguments = [ ]
+    for arg in node.arguments:
+        newarg = yield fold(arg, env)
+        changed = changed or newarg is not arg
+        arguments.append(newarg)
+    if (node.func.value in _conversions and len(arguments) == 1
+        and is_literal(arguments[0])):
+        folded = _result(node, fold_conversion(node.func.value, literal_value(arguments[0])))
+        if folded is not node:
+            return folded
+    if changed:
+        node = replace(node, arguments=arguments)
+    return node
+
+@folds(Statements)
+def fold_Statements(node, env):
+    changed = False
+    statements = [ ]
+    last = len(node.statements) - 1
+    for n, stmt in enumerate(node.statements):
+        newstmt = yield fold(stmt, env)
+        # A constant that has been substituted everywhere isn't needed.
+        # The last statement is kept because it gives a block its value.
+        if (type(stmt) is ConstDeclaration and env.get(stmt.name) is not None
+            and n != last):
+            changed = True
+            continue
+        changed = changed or newstmt is not stmt
+        statements.append(newstmt)
+    if changed:
+        node = replace(node, statements=statements)
+    return node
+
+@folds(CompoundExpression)
+def fold_CompoundExpression(node, env):
+    env.push()
+    try:
+        statements = yield fold(node.statements, env)
+    finally:
+        env.pop()
+    # { literal; } is just the literal
+    if (len(statements.statements) == 1
+        and type(statements.statements[0]) is ExpressionAsStatement
+        and is_literal(statements.statements[0].expression)):
+        return _located(statements.statements[0].expression, node)
+    if statements is not node.statements:
+        node = replace(node, statements=statements)
     return node
 
+@folds(ConstDeclaration)
+def fold_ConstDeclaration(node, env):
+    value = yield fold(node.value, env)
+    env[node.name] = value if is_literal(value) else None
+    if value is not node.value:
+        node = replace(node, value=value)
+    return node
+
+@folds(VarDeclaration)
+def fold_VarDeclaration(node, env):
+    value = (yield fold(node.value, env)) if node.value else None
+    env[node.name] = None
+    if value is not node.value:
+        node = replace(node, value=value)
+    return node
+
+@folds(Assignment)
+def fold_Assignment(node, env):
+    value = yield fold(node.value, env)
+    if value is not node.value:
+        node = replace(node, value=value)
+    return node
+
+@folds(PrintStatement, ReturnStatement)
+def fold_value(node, env):
+    value = yield fold(node.value, env)
+    if value is not node.value:
+        node = replace(node, value=value)
+    return node
+
+@folds(ExpressionAsStatement)
+def fold_ExpressionAsStatement(node, env):
+    expression = yield fold(node.expression, env)
+    if expression is not node.expression:
+        node = replace(node, expression=expression)
+    return node
+
+@folds(IfStatement)
+def fold_IfStatement(node, env):
+    test = yield fold(node.test, env)
+    env.push()
+    try:
+        consequence = yield fold(node.consequence, env)
+    finally:
+        env.pop()
+    alternative = node.alternative
+    if alternative:
+        env.push()
+        try:
+            alternative = yield fold(alternative, env)
+        finally:
+            env.pop()
+    if (test is not node.test or consequence is not node.consequence
+        or alternative is not node.alternative):
+        node = replace(node, test=test, consequence=consequence, alternative=alternative)
+    return node
+
+@folds(WhileStatement)
+def fold_WhileStatement(node, env):
+    test = yield fold(node.test, env)
+    env.push()
+    try:
+        body = yield fold(node.body, env)
+    finally:
+        env.pop()
+    if test is not node.test or body is not node.body:
+        node = replace(node, test=test, body=body)
+    return node
+
+@folds(FunctionDeclaration)
+def fold_FunctionDeclaration(node, env):
+    env[node.name] = None
+    env.push()
+    try:
+        for parm in node.parameters:
+            env[parm.name] = None
+        body = yield fold(node.body, env)
+    finally:
+        env.pop()
+    if body is not node.body:
+        node = replace(node, body=body)
+    return node
+
+# Walking the children of a node.  A pass that only cares about a few
+# kinds of node uses rebuild() for the rest, which walks the children
+# listed here and makes a new node if any of them changed.
+
+_subnodes = {
+    Integer: (), Float: (), Boolean: (), Character: (), Name: (),
+    BreakStatement: (), ContinueStatement: (),
+    BinOp: ('left', 'right'),
+    UnaryOp: ('operand',),
+    Grouping: ('expression',),
+    CompoundExpression: ('statements',),
+    Statements: ('statements',),
+    PrintStatement: ('value',),
+    ExpressionAsStatement: ('expression',),
+    ConstDeclaration: ('value',),
+    VarDeclaration: ('value',),
+    Assignment: ('value',),
+    IfStatement: ('test', 'consequence', 'alternative'),
+    WhileStatement: ('test', 'body'),
+    FunctionDeclaration: ('body',),
+    FunctionApplication: ('arguments',),
+    ReturnStatement: ('value',),
+    }
+
+def rebuild(node, walk, context):
+    fields = _subnodes.get(type(node))
+    if fields is None:
+        raise RuntimeError(f"Can't transform {node}")
+    if not fields:
+        return node
+    return _rebuild(node, fields, walk, context)
+
+def _rebuild(node, fields, walk, context):
+    changes = { }
+    for field in fields:
+        child = getattr(node, field)
+        if child is None:
+            continue
+        if type(child) is list:
+            newchild = [ ]
+            for item in child:
+                newchild.append((yield walk(item, context)))
+            if any(new is not old for new, old in zip(newchild, child)):
+                changes[field] = newchild
+        else:
+            newchild = yield walk(child, context)
+            if newchild is not child:
+                changes[field] = newchild
+    return replace(node, **changes) if changes else node
+
+def _declares(statements):
+    return any(type(stmt) in _declarations for stmt in statements.statements)
+
+_declarations = { ConstDeclaration, VarDeclaration, FunctionDeclaration }
+
+# Removing unreachable code.  A statement is "terminal" if control never
+# goes on to the statement after it: return, break and continue, an if
+# statement whose branches are all terminal, and a while loop on true
+# with no break.
+
+class PruneContext:
+    def __init__(self):
+        self.terminal = set()       # Statements that never complete
+        self.breaks = [ ]           # For each enclosing loop, has it got a break?
+
+    def ends(self, statements):
+        return bool(statements.statements) and statements.statements[-1] in self.terminal
+
+_pruners = { }
+
+def prunes(cls):
+    def register(func):
+        _pruners[cls] = func
+        return func
+    return register
+
+def prune_unreachable(node):
+    return trampoline(prune(node, PruneContext()))
+
+def prune(node, context):
+    pruner = _pruners.get(type(node))
+    if pruner is None:
+        return rebuild(node, prune, context)
+    return pruner(node, context)
+
+@prunes(Statements)
+def prune_Statements(node, context):
+    return prune_statements(node, False, context)
+
+@prunes(CompoundExpression)
+def prune_CompoundExpression(node, context):
+    statements = yield prune_statements(node.statements, True, context)
+    if statements is not node.statements:
+        node = replace(node, statements=statements)
+    return node
+
+def prune_statements(node, is_value, context):
+    '''
+    Prune a list of statements.  If is_value is set, the statements are
+    the body of a compound expression.  The last statement is then kept
+    as it is, since it gives the block its value, and nothing is cut off
+    after a terminal statement.
+    '''
+    changed = False
+    statements = [ ]
+    last = len(node.statements) - 1
+    for n, stmt in enumerate(node.statements):
+        newstmt = yield prune(stmt, context)
+        changed = changed or newstmt is not stmt
+        if is_value and n == last:
+            statements.append(newstmt)
+            break
+        if type(newstmt) is IfStatement and type(newstmt.test) is Boolean:
+            changed = True
+            if newstmt.test.value == 'true':
+                branch = newstmt.consequence
+            else:
+                branch = newstmt.alternative
+            if branch is None:
+                continue
+            if _declares(branch):
+                # The declarations need a scope of their own
+                newstmt = replace(newstmt, test=_located(Boolean('true'), newstmt.test),
+                                  consequence=branch, alternative=None)
+                if context.ends(branch):
+                    context.terminal.add(newstmt)
+                statements.append(newstmt)
+            else:
+                statements.extend(branch.statements)
+        elif (type(newstmt) is WhileStatement and type(newstmt.test) is Boolean
+              and newstmt.test.value == 'false'):
+            changed = True
+        else:
+            statements.append(newstmt)
+        if not is_value and statements and statements[-1] in context.terminal:
+            changed = changed or n != last
+            break
+    if changed:
+        node = replace(node, statements=statements)
+    return node
+
+@prunes(IfStatement)
+def prune_IfStatement(node, context):
+    node = yield rebuild(node, prune, context)
+    if type(node.test) is Boolean:
+        branch = node.consequence if node.test.value == 'true' else node.alternative
+        terminal = branch is not None and context.ends(branch)
+    else:
+        terminal = (node.alternative is not None and context.ends(node.consequence)
+                    and context.ends(node.alternative))
+    if terminal:
+        context.terminal.add(node)
+    return node
+
+@prunes(WhileStatement)
+def prune_WhileStatement(node, context):
+    context.breaks.append(False)
+    try:
+        node = yield rebuild(node, prune, context)
+    finally:
+        has_break = context.breaks.pop()
+    if type(node.test) is Boolean and node.test.value == 'true' and not has_break:
+        context.terminal.add(node)
+    return node
+
+@prunes(BreakStatement)
+def prune_BreakStatement(node, context):
+    if context.breaks:
+        context.breaks[-1] = True
+    context.terminal.add(node)
+    return node
+
+@prunes(ContinueStatement)
+def prune_ContinueStatement(node, context):
+    context.terminal.add(node)
+    return node
+
+@prunes(ReturnStatement)
+def prune_ReturnStatement(node, context):
+    node = yield rebuild(node, prune, context)
+    context.terminal.add(node)
+    return node
+
+# Removing unused variables.  First scan() finds, for every declaration,
+# the declarations that computing its value reads.  A read that happens
+# anywhere else (in a test, a print, a value with side effects ...)
+# makes the declaration it reads live.  Whatever can be reached from a
+# live declaration is live too, and everything else is removed.  scan()
+# returns True if the node has no side effects (and can't trap), so
+# that its value can be thrown away.
+
+class UseContext:
+    def __init__(self):
+        self.env = Scope()          # name -> declaration (None if not a variable)
+        self.reads = [ [ ] ]        # Declarations read, for each value being scanned
+        self.uses = { }             # declaration -> declarations its values read
+        self.targets = { }          # assignment -> declaration assigned to
+        self.pure = set()           # Declarations and assignments with values that can be dropped
+        self.kept = [ ]             # Declarations that have to stay
+
+    def live(self):
+        live = set()
+        pending = self.reads[0] + self.kept
+        while pending:
+            decl = pending.pop()
+            if decl not in live:
+                live.add(decl)
+                pending.extend(self.uses.get(decl, ()))
+        return live
+
+_scanners = { }
+
+def scans(*classes):
+    def register(func):
+        for cls in classes:
+            _scanners[cls] = func
+        return func
+    return register
+
+def scan(node, context):
+    scanner = _scanners.get(type(node))
+    if scanner is None:
+        raise RuntimeError(f"Can't scan {node}")
+    return scanner(node, context)
+
+@scans(Integer, Float, Boolean, Character)
+def scan_literal(node, context):
+    return True
+
+@scans(BreakStatement, ContinueStatement)
+def scan_jump(node, context):
+    return False
+
+@scans(Name)
+def scan_Name(node, context):
+    decl = context.env.get(node.value)
+    if decl is not None:
+        context.reads[-1].append(decl)
+    return True
+
+@scans(BinOp)
+def scan_BinOp(node, context):
+    left = yield scan(node.left, context)
+    right = yield scan(node.right, context)
+    # Integer division traps on a zero divisor (and on INT_MIN / -1)
+    if node.op == '/':
+        divisor = literal_value(node.right)
+        if divisor is None or (divisor[0] == 'int' and divisor[1] in (0, -1)):
+            return False
+    return left and right
+
+@scans(UnaryOp)
+def scan_UnaryOp(node, context):
+    return (yield scan(node.operand, context))
+
+@scans(Grouping, ExpressionAsStatement)
+def scan_expression(node, context):
+    return (yield scan(node.expression, context))
+
+@scans(FunctionApplication)
+def scan_FunctionApplication(node, context):
+    pure = True
+    for arg in node.arguments:
+        pure = (yield scan(arg, context)) and pure
+    # Converting to float can't trap, the other conversions can
+    return pure and node.func.value == 'float'
+
+@scans(Statements)
+def scan_Statements(node, context):
+    return (yield scan_statements(node, False, context))
+
+@scans(CompoundExpression)
+def scan_CompoundExpression(node, context):
+    context.env.push()
+    try:
+        return (yield scan_statements(node.statements, True, context))
+    finally:
+        context.env.pop()
+
+def scan_statements(node, is_value, context):
+    pure = True
+    for stmt in node.statements:
+        pure = (yield scan(stmt, context)) and pure
+    # The last statement of a compound expression is never removed
+    if is_value and node.statements:
+        decl = _declaration(node.statements[-1], context)
+        if decl is not None:
+            context.kept.append(decl)
+    return pure
+
+def _declaration(stmt, context):
+    # The declaration that stmt declares or assigns to (if any)
+    if type(stmt) in (ConstDeclaration, VarDeclaration):
+        return stmt
+    elif type(stmt) is Assignment:
+        return context.targets.get(stmt)
+    return None
+
+def scan_value(stmt, decl, context):
+    '''
+    Scan the value in a declaration or assignment.  If it can be dropped,
+    the reads it makes only matter if decl is live.
+    '''
+    context.reads.append([ ])
+    pure = yield scan(stmt.value, context)
+    reads = context.reads.pop()
+    if pure and decl is not None:
+        context.uses.setdefault(decl, [ ]).extend(reads)
+        context.pure.add(stmt)
+    else:
+        context.reads[-1].extend(reads)
+    return pure
+
+@scans(ConstDeclaration, VarDeclaration)
+def scan_declaration(node, context):
+    pure = True
+    if node.value is not None:
+        pure = yield scan_value(node, node, context)
+    else:
+        context.pure.add(node)
+    context.env[node.name] = node
+    return pure
+
+@scans(Assignment)
+def scan_Assignment(node, context):
+    decl = context.env.get(node.location.value)
+    context.targets[node] = decl
+    yield scan_value(node, decl, context)
+    return False
+
+@scans(PrintStatement, ReturnStatement)
+def scan_value_statement(node, context):
+    yield scan(node.value, context)
+    return False
+
+@scans(IfStatement)
+def scan_IfStatement(node, context):
+    yield scan(node.test, context)
+    for branch in (node.consequence, node.alternative):
+        if branch is not None:
+            context.env.push()
+            try:
+                yield scan(branch, context)
+            finally:
+                context.env.pop()
+    return False
+
+@scans(WhileStatement)
+def scan_WhileStatement(node, context):
+    yield scan(node.test, context)
+    context.env.push()
+    try:
+        yield scan(node.body, context)
+    finally:
+        context.env.pop()
+    return False
+
+@scans(FunctionDeclaration)
+def scan_FunctionDeclaration(node, context):
+    context.env[node.name] = None
+    context.env.push()
+    try:
+        for parm in node.parameters:
+            context.env[parm.name] = None
+        yield scan(node.body, context)
+    finally:
+        context.env.pop()
+    return False
+
+class RemoveContext:
+    def __init__(self, uses):
+        self.live = uses.live()
+        self.targets = uses.targets
+        self.pure = uses.pure
+
+def remove_unused(node):
+    uses = UseContext()
+    trampoline(scan(node, uses))
+    return trampoline(remove(node, RemoveContext(uses)))
+
+_removers = { }
+
+def removes(cls):
+    def register(func):
+        _removers[cls] = func
+        return func
+    return register
+
+def remove(node, context):
+    remover = _removers.get(type(node))
+    if remover is None:
+        return rebuild(node, remove, context)
+    return remover(node, context)
+
+@removes(Statements)
+def remove_Statements(node, context):
+    return remove_statements(node, False, context)
+
+@removes(CompoundExpression)
+def remove_CompoundExpression(node, context):
+    statements = yield remove_statements(node.statements, True, context)
+    if statements is not node.statements:
+        node = replace(node, statements=statements)
+    return node
+
+def remove_statements(node, is_value, context):
+    changed = False
+    statements = [ ]
+    last = len(node.statements) - 1
+    for n, stmt in enumerate(node.statements):
+        decl = _declaration(stmt, context)
+        if decl is not None and decl not in context.live and not (is_value and n == last):
+            changed = True
+            if stmt not in context.pure:
+                # Keep the side effects of computing the value
+                value = yield remove(stmt.value, context)
+                statements.append(_located(ExpressionAsStatement(value), stmt))
+            continue
+        newstmt = yield remove(stmt, context)
+        changed = changed or newstmt is not stmt
+        statements.append(newstmt)
+    if changed:
+        node = replace(node, statements=statements)
+    return node
+
+# Inlining.  A call to a small function is replaced by a compound
+# expression that declares the parameters, runs the function body and
+# ends with the value being returned:
+#
+#     func scale(x int) int {          print scale(n);
+#         var y int = x * 2;     ==>
+#         return y + 1;                print { const x.1 int = n;
+#     }                                        var y.2 int = x.1 * 2;
+#                                              y.2 + 1; };
+#
+# The names declared in the copy are made unique by adding '.' and a
+# number, which can't clash with any name in the source.  Parameters
+# the body never assigns become constants so that constant arguments
+# get folded.  A function is only inlined if
+#
+#   - it is declared at the top level,
+#   - it isn't recursive (a function can only call itself or functions
+#     declared before it, so the call graph has no other cycles),
+#   - its only return statement is the last statement of its body,
+#   - its body has at most budget nodes in it, and
+#   - every name its body uses from outside means the same thing at
+#     the call site (it isn't hidden by a local variable there).
+#
+# Functions are processed in order, so calls inside a function that
+# gets inlined have already been inlined themselves.
+
+inline_budget = 40
+
+class Callee:
+    __slots__ = ('func', 'free', 'assigned')
+
+    def __init__(self, func, free, assigned):
+        self.func = func
+        self.free = free            # name -> what it meant where func was declared
+        self.assigned = assigned    # Names of parameters that the body assigns
+
+class InlineContext:
+    def __init__(self, budget):
+        self.budget = budget
+        self.env = Scope()          # name -> declaration
+        self.callees = { }          # FunctionDeclaration -> Callee
+        self.count = 0              # For making names unique
+        self.level = 0              # Nesting depth of statement blocks
+
+    def inlinable(self, name):
+        decl = self.env.get(name)
+        callee = self.callees.get(decl) if type(decl) is FunctionDeclaration else None
+        if callee is None:
+            return None
+        for free, meaning in callee.free.items():
+            if self.env.get(free) is not meaning:
+                return None
+        return callee
+
+_inliners = { }
+
+def inlines(cls):
+    def register(func):
+        _inliners[cls] = func
+        return func
+    return register
+
+def inline_functions(node, budget=inline_budget):
+    return trampoline(inline(node, InlineContext(budget)))
+
+def inline(node, context):
+    inliner = _inliners.get(type(node))
+    if inliner is None:
+        return rebuild(node, inline, context)
+    return inliner(node, context)
+
+def _in_scope(node, context):
+    context.env.push()
+    context.level += 1
+    try:
+        return (yield rebuild(node, inline, context))
+    finally:
+        context.level -= 1
+        context.env.pop()
+
+@inlines(FunctionApplication)
+def inline_FunctionApplication(node, context):
+    node = yield rebuild(node, inline, context)
+    callee = context.inlinable(node.func.value)
+    if callee is None:
+        return node
+    context.count += 1
+    renames = Scope()
+    statements = [ ]
+    for parm, arg in zip(callee.func.parameters, node.arguments):
+        renames[parm.name] = f'{parm.name}.{context.count}'
+        decl = VarDeclaration if parm.name in callee.assigned else ConstDeclaration
+        statements.append(_located(decl(renames[parm.name], parm.type, arg), arg))
+    body = callee.func.body.statements
+    for stmt in body[:-1]:
+        statements.append((yield rename(stmt, (renames, context))))
+    value = yield rename(body[-1].value, (renames, context))
+    statements.append(_located(ExpressionAsStatement(value), body[-1]))
+    return _located(CompoundExpression(_located(Statements(statements), node)), node)
+
+@inlines(CompoundExpression)
+@inlines(WhileStatement)
+def inline_block(node, context):
+    return _in_scope(node, context)
+
+@inlines(IfStatement)
+def inline_IfStatement(node, context):
+    test = yield inline(node.test, context)
+    consequence = yield _in_scope(node.consequence, context)
+    alternative = node.alternative
+    if alternative is not None:
+        alternative = yield _in_scope(alternative, context)
+    if (test is not node.test or consequence is not node.consequence
+        or alternative is not node.alternative):
+        node = replace(node, test=test, consequence=consequence, alternative=alternative)
+    return node
+
+@inlines(ConstDeclaration)
+@inlines(VarDeclaration)
+def inline_declaration(node, context):
+    node = yield rebuild(node, inline, context)
+    context.env[node.name] = node
+    return node
+
+@inlines(FunctionDeclaration)
+def inline_FunctionDeclaration(node, context):
+    context.env[node.name] = node
+    context.env.push()
+    context.level += 1
+    try:
+        for parm in node.parameters:
+            context.env[parm.name] = parm
+        node = yield rebuild(node, inline, context)
+    finally:
+        context.level -= 1
+        context.env.pop()
+    context.env[node.name] = node
+    if context.level == 0:
+        survey = Survey(node)
+        yield survey.walk(node.body)
+        statements = node.body.statements
+        if (node.name not in survey.free and survey.returns == 1
+            and statements and type(statements[-1]) is ReturnStatement
+            and survey.size <= context.budget):
+            free = { name: context.env.get(name) for name in survey.free }
+            context.callees[node] = Callee(node, free, survey.assigned)
+    return node
+
+class Survey:
+    '''
+    Gather what inlining needs to know about a function body: the names
+    it uses from outside, the parameters it assigns, how many return
+    statements it has and its size.
+    '''
+    def __init__(self, func):
+        self.env = Scope()
+        self.parameters = set()
+        for parm in func.parameters:
+            self.env[parm.name] = parm
+            self.parameters.add(parm.name)
+        self.free = set()
+        self.assigned = set()
+        self.returns = 0
+        self.size = 0
+
+    def use(self, name):
+        decl = self.env.get(name)
+        if decl is None:
+            self.free.add(name)
+        return decl
+
+    def walk(self, node):
+        self.size += 1
+        cls = type(node)
+        if cls is Name:
+            self.use(node.value)
+            return
+        if cls is FunctionApplication:
+            if node.func.value not in _conversions:
+                self.use(node.func.value)
+        elif cls is Assignment:
+            if type(self.use(node.location.value)) is Parameter:
+                self.assigned.add(node.location.value)
+        elif cls is ReturnStatement:
+            self.returns += 1
+        for field in _subnodes[cls]:
+            child = getattr(node, field)
+            if child is None:
+                continue
+            if cls in (IfStatement, WhileStatement, CompoundExpression) and field != 'test':
+                self.env.push()
+                try:
+                    yield self.walk(child)
+                finally:
+                    self.env.pop()
+            elif type(child) is list:
+                for item in child:
+                    yield self.walk(item)
+            else:
+                yield self.walk(child)
+        if cls in (ConstDeclaration, VarDeclaration):
+            self.env[node.name] = node
+
+# Copying a function body for inlining, with the names it declares
+# renamed.  The context is (renames, inline context), where renames maps
+# each name declared in the body to its new name.
+
+_renamers = { }
+
+def renames(cls):
+    def register(func):
+        _renamers[cls] = func
+        return func
+    return register
+
+def rename(node, context):
+    renamer = _renamers.get(type(node))
+    if renamer is None:
+        return _copy(node, context)
+    return renamer(node, context)
+
+def _copy(node, context):
+    # Unlike rebuild(), this always makes a new node so that no part of
+    # the function body is shared with a copy of it
+    changes = { }
+    for field in _subnodes[type(node)]:
+        child = getattr(node, field)
+        if type(child) is list:
+            newchild = [ ]
+            for item in child:
+                newchild.append((yield rename(item, context)))
+            changes[field] = newchild
+        elif child is not None:
+            changes[field] = yield rename(child, context)
+    return replace(node, **changes)
+
+def _scoped_copy(node, context):
+    renames, _ = context
+    renames.push()
+    try:
+        return (yield _copy(node, context))
+    finally:
+        renames.pop()
+
+@renames(Name)
+def rename_Name(node, context):
+    renames, _ = context
+    return replace(node, value=renames.get(node.value, node.value))
+
+@renames(ConstDeclaration)
+@renames(VarDeclaration)
+def rename_declaration(node, context):
+    renames, inlining = context
+    node = yield _copy(node, context)
+    inlining.count += 1
+    renames[node.name] = f'{node.name}.{inlining.count}'
+    node.name = renames[node.name]
+    return node
+
+@renames(Assignment)
+def rename_Assignment(node, context):
+    renames, _ = context
+    node = yield _copy(node, context)
+    node.location = rename_Name(node.location, context)
+    return node
+
+@renames(CompoundExpression)
+@renames(WhileStatement)
+def rename_block(node, context):
+    return _scoped_copy(node, context)
+
+@renames(IfStatement)
+def rename_IfStatement(node, context):
+    renames, _ = context
+    test = yield rename(node.test, context)
+    renames.push()
+    try:
+        consequence = yield rename(node.consequence, context)
+    finally:
+        renames.pop()
+    alternative = node.alternative
+    if alternative is not None:
+        renames.push()
+        try:
+            alternative = yield rename(alternative, context)
+        finally:
+            renames.pop()
+    return replace(node, test=test, consequence=consequence, alternative=alternative)
+
+# Loop-invariant code motion.  An expression inside a while loop that
+# gives the same value on every trip round the loop is computed once,
+# before the loop, into a new constant:
+#
+#     while i < n * m {                 const .t1 = n * m;
+#         a = a + x * 2.0;      ==>     const .t2 = x * 2.0;
+#         i = i + 1;                    while i < .t1 {
+#     }                                     a = a + .t2;
+#                                           i = i + 1;
+#                                       }
+#
+# The new names start with '.', so they can't clash with anything.  An
+# expression is invariant in a loop if no name in it is assigned or
+# declared anywhere in the loop (a call in the loop counts as assigning
+# every global).  It has to have no side effects and mustn't trap,
+# since the loop might never run: integer division is only moved if the
+# divisor is a constant other than 0 and -1, and of the conversions
+# only float() is moved.  An expression is moved out of as many nested
+# loops as it is invariant in.
+#
+# find_loops() numbers every node in order.  Each loop covers a range
+# of numbers, and each name has the sorted list of the numbers where it
+# gets assigned, so "is x changed in this loop?" is a binary search.
+
+class LoopInfo:
+    def __init__(self):
+        self.count = 0
+        self.spans = { }            # WhileStatement -> (first, last) node number
+        self.changes = { }          # name -> numbers of the nodes that change it
+        self.calls = [ ]            # numbers of the nodes that call a function
+
+    def changed(self, positions, span):
+        n = bisect_left(positions, span[0])
+        return n < len(positions) and positions[n] <= span[1]
+
+def find_loops(node, info):
+    info.count += 1
+    position = info.count
+    cls = type(node)
+    if cls in (Assignment, ConstDeclaration, VarDeclaration):
+        name = node.location.value if cls is Assignment else node.name
+        info.changes.setdefault(name, [ ]).append(position)
+    elif cls is FunctionApplication and node.func.value not in _conversions:
+        info.calls.append(position)
+    for field in _subnodes[cls]:
+        child = getattr(node, field)
+        if type(child) is list:
+            for item in child:
+                yield find_loops(item, info)
+        elif child is not None:
+            yield find_loops(child, info)
+    if cls is WhileStatement:
+        info.spans[node] = (position, info.count)
+
+class HoistContext:
+    def __init__(self, info):
+        self.info = info
+        self.env = Scope()          # name -> True if local to the current function
+        self.in_function = False
+        self.loops = [ ]            # (span, hoisted declarations), outermost first
+        self.count = 0
+
+    def level(self, name):
+        '''
+        Return the index of the outermost enclosing loop that name
+        doesn't change in (len(self.loops) if it changes in the innermost).
+        '''
+        positions = self.info.changes.get(name, ())
+        calls = () if self.env.get(name) else self.info.calls
+        low, high = 0, len(self.loops)
+        while low < high:
+            mid = (low + high) // 2
+            span = self.loops[mid][0]
+            if self.info.changed(positions, span) or self.info.changed(calls, span):
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def hoist(self, node, level):
+        # Move node in front of loop number level (if it is worth it)
+        if level >= len(self.loops) or not _computes(node):
+            return node
+        self.count += 1
+        name = f'.t{self.count}'
+        self.loops[level][1].append(_located(ConstDeclaration(name, None, node), node))
+        return _located(Name(name), node)
+
+def _computes(node):
+    while type(node) is Grouping:
+        node = node.expression
+    return type(node) in (BinOp, UnaryOp, FunctionApplication)
+
+_expressions = { Integer, Float, Boolean, Character, Name, BinOp, UnaryOp,
+                 Grouping, FunctionApplication, CompoundExpression }
+
+def hoist_invariants(node):
+    info = LoopInfo()
+    trampoline(find_loops(node, info))
+    if not info.spans:
+        return node
+    return trampoline(hoist(node, HoistContext(info)))
+
+_hoisters = { }
+
+def hoists(cls):
+    def register(func):
+        _hoisters[cls] = func
+        return func
+    return register
+
+def hoist(node, context):
+    if type(node) in _expressions:
+        return hoist_expression(node, context)
+    hoister = _hoisters.get(type(node))
+    if hoister is None:
+        return rebuild(node, hoist, context)
+    return hoister(node, context)
+
+def hoist_expression(node, context):
+    node, level = yield invariant(node, context)
+    return context.hoist(node, level)
+
+def invariant(node, context):
+    '''
+    Walk an expression.  Returns the new expression and the index of the
+    outermost enclosing loop it is invariant in.
+    '''
+    cls = type(node)
+    variant = len(context.loops)
+    if cls in _literal_classes:
+        return node, 0
+    elif cls is Name:
+        return node, context.level(node.value)
+    elif cls is CompoundExpression:
+        return (yield _hoist_block(node, context)), variant
+    parts = [ ]
+    for field in _subnodes[cls]:
+        child = getattr(node, field)
+        if type(child) is list:
+            for item in child:
+                parts.append((yield invariant(item, context)))
+        else:
+            parts.append((yield invariant(child, context)))
+    level = max((part[1] for part in parts), default=0)
+    if cls is BinOp and node.op == '/':
+        divisor = literal_value(node.right)
+        if divisor is None or (divisor[0] == 'int' and divisor[1] in (0, -1)):
+            level = variant
+    elif cls is FunctionApplication and node.func.value != 'float':
+        level = variant
+    # Children that can be moved further out than this node go now
+    children = [ context.hoist(child, childlevel) if childlevel < level else child
+                 for child, childlevel in parts ]
+    if cls is BinOp:
+        changed = children[0] is not node.left or children[1] is not node.right
+        if changed:
+            node = replace(node, left=children[0], right=children[1])
+    elif cls is FunctionApplication:
+        if any(new is not old for new, old in zip(children, node.arguments)):
+            node = replace(node, arguments=children)
+    else:
+        field = _subnodes[cls][0]
+        if children[0] is not getattr(node, field):
+            node = replace(node, **{field: children[0]})
+    return node, level
+
+def _hoist_block(node, context):
+    # Walk a block that is a scope of its own: a compound expression or
+    # the statements in a branch of an if statement
+    context.env.push()
+    try:
+        if type(node) is Statements:
+            return (yield hoist_Statements(node, context))
+        return (yield rebuild(node, hoist, context))
+    finally:
+        context.env.pop()
+
+@hoists(Statements)
+def hoist_Statements(node, context):
+    changed = False
+    statements = [ ]
+    for stmt in node.statements:
+        newstmt = yield hoist(stmt, context)
+        if type(newstmt) is list:
+            statements.extend(newstmt)
+            changed = True
+        else:
+            statements.append(newstmt)
+            changed = changed or newstmt is not stmt
+    if changed:
+        node = replace(node, statements=statements)
+    return node
+
+@hoists(WhileStatement)
+def hoist_WhileStatement(node, context):
+    hoisted = [ ]
+    context.loops.append((context.info.spans[node], hoisted))
+    context.env.push()
+    try:
+        node = yield rebuild(node, hoist, context)
+    finally:
+        context.env.pop()
+        context.loops.pop()
+    return hoisted + [ node ] if hoisted else node
+
+@hoists(IfStatement)
+def hoist_IfStatement(node, context):
+    test = yield hoist(node.test, context)
+    consequence = yield _hoist_block(node.consequence, context)
+    alternative = node.alternative
+    if alternative is not None:
+        alternative = yield _hoist_block(alternative, context)
+    if (test is not node.test or consequence is not node.consequence
+        or alternative is not node.alternative):
+        node = replace(node, test=test, consequence=consequence, alternative=alternative)
+    return node
+
+@hoists(ConstDeclaration)
+@hoists(VarDeclaration)
+def hoist_declaration(node, context):
+    node = yield rebuild(node, hoist, context)
+    context.env[node.name] = context.in_function
+    return node
+
+@hoists(FunctionDeclaration)
+def hoist_FunctionDeclaration(node, context):
+    # Nothing in the body can go in front of a loop the function is in
+    loops = context.loops
+    context.env[node.name] = False
+    context.env.push()
+    context.in_function = True
+    context.loops = [ ]
+    try:
+        for parm in node.parameters:
+            context.env[parm.name] = True
+        return (yield rebuild(node, hoist, context))
+    finally:
+        context.loops = loops
+        context.in_function = False
+        context.env.pop()
+
 # Main function (for testing)
 def main(filename):
     from .parse import parse_file
@@ -3,7 +3,10 @@
 
 from .model import *
 from .parse import lineno
-from collections import ChainMap
+from .arena import *
+from .trampoline import trampoline
+from .scope import Scope
+from collections import namedtuple
 from contextlib import contextmanager
 
 valid_types = { 'int', 'float', 'char', 'bool' }
@@ -12,7 +15,7 @@ valid_types = { 'int', 'float', 'char', 'bool' }
 # like the environment for the interpreter.
 class CheckContext:
     def __init__(self):
-        self.env = ChainMap()
+        self.env = Scope()
         self.ok = True
 
     # Use this method to report an error message
@@ -24,230 +27,477 @@ class CheckContext:
         return self.env.get(name)
 
     def define(self, name, value):
-        if name in self.env.maps[0]:
+        if self.env.defined_here(name):
             return False
         self.env[name] = value
         return True
 
     @contextmanager
     def new_scope(self):
-        self.env = self.env.new_child()
+        self.env.push()
         try:
             yield
         finally:
-            self.env = self.env.parents
+            self.env.pop()
         
-# Top-level function used to check programs
-def check_program(model):
-    context = CheckContext()
-    # Insert type definitions
+# Insert type definitions
+def define_types(context):
     context.define('int', ('type', 'int'))
     context.define('float', ('type', 'float'))
     context.define('char', ('type', 'char'))
     context.define('bool', ('type', 'bool'))
-    check(model, context)
+
+# Top-level function used to check programs
+def check_program(model):
+    context = CheckContext()
+    define_types(context)
+    if isinstance(model, Arena):
+        trampoline(check_arena(model, len(model) - 1, context))
+    else:
+        trampoline(check(model, context))
     return context.ok
 
 # Internal function used to check nodes with an environment.  Critical
 # point: Everything is focused on types.  The result of an expression
 # is a type.  The inputs to different operations are types.
+#
+# Each node class has its own checking function, registered with
+# @checks(cls).  check() looks it up by the node's type, so the cost of
+# dispatch doesn't depend on how many kinds of node there are.
+#
+# The rules themselves are in the check_* helper functions further
+# below.  They only deal in names, types and line numbers, so the same
+# rules are used to check the class-based model (check) and the flat
+# arena form of it (check_arena).
+#
+# The checking functions for nodes with children are generators that
+# yield the check of each child and get back its type.  They're run by
+# trampoline() so that deeply nested programs don't overflow the Python
+# stack.  Functions for leaf nodes just return the type.
+
+_checkers = { }
+
+def checks(cls):
+    def register(func):
+        _checkers[cls] = func
+        return func
+    return register
 
 def check(node, context):
     # Carefully notice that we are only interested in the type.
     # The value is disregarded.
-    if isinstance(node, Integer):
-        return "int"
-
-    elif isinstance(node, Float):
-        return "float"
-
-    elif isinstance(node, Character):
-        return "char"
-
-    elif isinstance(node, Boolean):
-        return "bool"
-
-    elif isinstance(node, BinOp):
-        ltype = check(node.left, context)
-        rtype = check(node.right, context)
-        if (   (ltype in { 'int', 'float' }
-                and node.op not in { '+', '-', '*', '/', '<', '>', '<=', '>=', '==', '!=' })
-               or (ltype == 'bool'
-                   and node.op not in { '&&', '||', '==', '!='})
-               or (ltype == 'char'
-                   and node.op not in { '<', '>', '<=', '>=', '==', '!=' })):
-            context.error(lineno(node), f'Unsupported binary operator: {ltype} {node.op} {rtype}')
-            return 'error'
-        if ltype != rtype:
-            context.error(lineno(node), f'Type error in binary operator. {ltype} {node.op} {rtype}')
-            return 'error'
-        if node.op in {'<', '>', '<=', '>=', '==', '!=', '&&', '!='}:
-            return 'bool'
-                    
-        return ltype
-
-    elif isinstance(node, UnaryOp):
-        optype = check(node.operand, context)
-        if (   (optype in { 'int', 'float' }
-                and node.op not in { '+', '-' })
-               or (optype == 'bool'
-                   and node.op not in { '!' })
-               or (optype == 'char')):
-            context.error(lineno(node), f'Unsupported unary operator: {node.op} {optype}')
-            return 'error'
-        return optype
-
-    elif isinstance(node, Grouping):
-        return check(node.expression, context)
-
-    elif isinstance(node, Statements):
-        resulttype = None
-        for stmt in node.statements:
-            resulttype = check(stmt, context)
-        return resulttype
-
-    elif isinstance(node, ConstDeclaration):
-        result_type = check(node.value, context)
-        if node.type and node.type != result_type:
-            context.error(lineno(node), f'Type error in assignment {node.type} = {result_type}')
-        if not context.define(node.name, ('const', result_type)):
-            context.error(lineno(node), f'Duplicate definition of {node.name}')
-        return None
-
-    elif isinstance(node, VarDeclaration):
-        if node.value:
-            result_type = check(node.value, context)
-        else:
-            result_type = None
-        if node.type and node.value and node.type != result_type:
-            context.error(lineno(node), f'Type error in assignment {node.type} = {result_type}')
-        elif node.type is None and not node.value:
-            context.error(lineno(node), f'Missing type on declaration of {node.name}')
-        elif node.type and node.type not in valid_types:
-            context.error(lineno(node), f'Unknown type {node.type}')
-        context.define(node.name, ('var', result_type if result_type else node.type))
-        return None
-
-    elif isinstance(node, Name):
-        decl = context.lookup(node.value)
-        if not decl:
-            context.error(lineno(node), f'Undefined name {node.value}')
-            return 'error'
-        else:
-            return decl[1]
-
-    elif isinstance(node, Assignment):
-        valuetype = check(node.value, context)
-        return check_lhs(node.location, valuetype, context)
-
-    elif isinstance(node, PrintStatement):
-        # Note: You don't actually print.  You just check the value to
-        # make sure it's good.
-        valuetype = check(node.value, context)
-        return None
-
-    elif isinstance(node, IfStatement):
-        testtype = check(node.test, context)
-        if testtype != 'bool':
-            context.error(lineno(node), f'Conditional test must be a bool. Got {testtype}')
-        with context.new_scope():
-            check(node.consequence, context)
-        if node.alternative:
-            with context.new_scope():
-                check(node.consequence, context)
-        return None
-
-    elif isinstance(node, WhileStatement):
-        testtype = check(node.test, context)
-        if testtype != 'bool':
-            context.error(lineno(node), f'While test must be a bool. Got {testtype}')
+    checker = _checkers.get(type(node))
+    if checker is None:
+        raise RuntimeError(f"Couldn't check {node}")
+    return checker(node, context)
+
+@checks(Integer)
+def check_Integer(node, context):
+    return "int"
+
+@checks(Float)
+def check_Float(node, context):
+    return "float"
+
+@checks(Character)
+def check_Character(node, context):
+    return "char"
+
+@checks(Boolean)
+def check_Boolean(node, context):
+    return "bool"
+
+@checks(Name)
+def check_Name(node, context):
+    return check_name(node.value, lineno(node), context)
+
+@checks(BinOp)
+def check_BinOp(node, context):
+    ltype = yield check(node.left, context)
+    rtype = yield check(node.right, context)
+    return check_binop(node.op, ltype, rtype, lineno(node), context)
+
+@checks(UnaryOp)
+def check_UnaryOp(node, context):
+    optype = yield check(node.operand, context)
+    return check_unaryop(node.op, optype, lineno(node), context)
+
+@checks(Grouping)
+def check_Grouping(node, context):
+    return (yield check(node.expression, context))
+
+@checks(Statements)
+def check_Statements(node, context):
+    resulttype = None
+    for stmt in node.statements:
+        resulttype = yield check(stmt, context)
+    return resulttype
+
+@checks(ConstDeclaration)
+def check_ConstDeclaration(node, context):
+    result_type = yield check(node.value, context)
+    check_const_declaration(node.name, node.type, result_type, lineno(node), context)
+    return None
+
+@checks(VarDeclaration)
+def check_VarDeclaration(node, context):
+    if node.value:
+        result_type = yield check(node.value, context)
+    else:
+        result_type = None
+    check_var_declaration(node.name, node.type, bool(node.value), result_type, lineno(node), context)
+    return None
+
+@checks(Assignment)
+def check_Assignment(node, context):
+    valuetype = yield check(node.value, context)
+    return check_lhs(node.location, valuetype, context)
+
+@checks(PrintStatement)
+def check_PrintStatement(node, context):
+    # Note: You don't actually print.  You just check the value to
+    # make sure it's good.
+    valuetype = yield check(node.value, context)
+    return None
+
+@checks(IfStatement)
+def check_IfStatement(node, context):
+    testtype = yield check(node.test, context)
+    check_test('Conditional', testtype, lineno(node), context)
+    with context.new_scope():
+        yield check(node.consequence, context)
+    if node.alternative:
         with context.new_scope():
-            context.define('while', True)
-            check(node.body, context)
-        return None
-
-    elif isinstance(node, BreakStatement):
-        if not context.lookup('while'):
-            context.error(lineno(node), f'break used outside of a while loop')
-        return None
-
-    elif isinstance(node, ContinueStatement):
-        if not context.lookup('while'):
-            context.error(lineno(node), f'continue used outside of a while loop')
-        return None
-
-    elif isinstance(node, ExpressionAsStatement):
-        return check(node.expression, context)
+            yield check(node.alternative, context)
+    return None
+
+@checks(WhileStatement)
+def check_WhileStatement(node, context):
+    testtype = yield check(node.test, context)
+    check_test('While', testtype, lineno(node), context)
+    with context.new_scope():
+        context.define('while', True)
+        yield check(node.body, context)
+    return None
+
+@checks(BreakStatement)
+def check_BreakStatement(node, context):
+    check_loop_control('break', lineno(node), context)
+    return None
+
+@checks(ContinueStatement)
+def check_ContinueStatement(node, context):
+    check_loop_control('continue', lineno(node), context)
+    return None
+
+@checks(ExpressionAsStatement)
+def check_ExpressionAsStatement(node, context):
+    return (yield check(node.expression, context))
+
+@checks(CompoundExpression)
+def check_CompoundExpression(node, context):
+    with context.new_scope():
+        return (yield check(node.statements, context))
+
+@checks(FunctionDeclaration)
+def check_FunctionDeclaration(node, context):
+    parameters = [ (p.name, p.type, lineno(p)) for p in node.parameters ]
+    check_function_declaration(node.name, parameters, node.return_type, lineno(node), context)
+    with context.new_scope():
+        define_parameters(parameters, node.return_type, context)
+        yield check(node.body, context)
+    return None
+
+@checks(FunctionApplication)
+def check_FunctionApplication(node, context):
+    decl = yield check(node.func, context)
+    result, parmtypes = check_call(decl, len(node.arguments), lineno(node), lineno(node.func), context)
+    if parmtypes:
+        for n, (parmtype, arg) in enumerate(zip(parmtypes, node.arguments), start=1):
+            argtype = yield check(arg, context)
+            check_argument(n, parmtype, argtype, lineno(arg), context)
+    return result
+
+@checks(ReturnStatement)
+def check_ReturnStatement(node, context):
+    rettype = yield check(node.value, context)
+    check_return(rettype, lineno(node), context)
+    return None
 
-    elif isinstance(node, CompoundExpression):
+def check_lhs(node, valuetype, context):
+    if isinstance(node, Name):
+        check_store(node.value, valuetype, lineno(node), context)
+
+# Check an arena (see arena.py) starting from the node with handle h.
+# This follows check() exactly, but reads the node fields straight out
+# of the arena's arrays.  The checking functions are kept in a list
+# indexed by the node kind.
+
+_arena_checkers = [ None ] * len(node_classes)
+
+def checks_arena(cls):
+    def register(func):
+        _arena_checkers[node_classes.index(cls)] = func
+        return func
+    return register
+
+def check_arena(arena, h, context):
+    checker = _arena_checkers[arena.kinds[h]]
+    if checker is None:
+        raise RuntimeError(f"Couldn't check arena node {h}")
+    return checker(arena, h, context)
+
+@checks_arena(Integer)
+def check_arena_Integer(arena, h, context):
+    return 'int'
+
+@checks_arena(Float)
+def check_arena_Float(arena, h, context):
+    return 'float'
+
+@checks_arena(Character)
+def check_arena_Character(arena, h, context):
+    return 'char'
+
+@checks_arena(Boolean)
+def check_arena_Boolean(arena, h, context):
+    return 'bool'
+
+@checks_arena(Name)
+def check_arena_Name(arena, h, context):
+    return check_name(arena.value(h), arena.lineno(h), context)
+
+@checks_arena(BinOp)
+def check_arena_BinOp(arena, h, context):
+    ltype = yield check_arena(arena, arena.b[h], context)
+    rtype = yield check_arena(arena, arena.c[h], context)
+    return check_binop(arena.value(h), ltype, rtype, arena.lineno(h), context)
+
+@checks_arena(UnaryOp)
+def check_arena_UnaryOp(arena, h, context):
+    optype = yield check_arena(arena, arena.b[h], context)
+    return check_unaryop(arena.value(h), optype, arena.lineno(h), context)
+
+@checks_arena(Grouping)
+@checks_arena(ExpressionAsStatement)
+def check_arena_Grouping(arena, h, context):
+    return (yield check_arena(arena, arena.a[h], context))
+
+@checks_arena(Statements)
+def check_arena_Statements(arena, h, context):
+    resulttype = None
+    for stmt in arena.statements(h):
+        resulttype = yield check_arena(arena, stmt, context)
+    return resulttype
+
+@checks_arena(ConstDeclaration)
+def check_arena_ConstDeclaration(arena, h, context):
+    result_type = yield check_arena(arena, arena.c[h], context)
+    type = arena.literals[arena.b[h]] if arena.b[h] != NONE else None
+    check_const_declaration(arena.value(h), type, result_type, arena.lineno(h), context)
+    return None
+
+@checks_arena(VarDeclaration)
+def check_arena_VarDeclaration(arena, h, context):
+    has_value = arena.c[h] != NONE
+    result_type = (yield check_arena(arena, arena.c[h], context)) if has_value else None
+    type = arena.literals[arena.b[h]] if arena.b[h] != NONE else None
+    check_var_declaration(arena.value(h), type, has_value, result_type, arena.lineno(h), context)
+    return None
+
+@checks_arena(Assignment)
+def check_arena_Assignment(arena, h, context):
+    valuetype = yield check_arena(arena, arena.b[h], context)
+    location = arena.a[h]
+    if arena.kinds[location] == NAME:
+        check_store(arena.value(location), valuetype, arena.lineno(location), context)
+    return None
+
+@checks_arena(PrintStatement)
+def check_arena_PrintStatement(arena, h, context):
+    yield check_arena(arena, arena.a[h], context)
+    return None
+
+@checks_arena(IfStatement)
+def check_arena_IfStatement(arena, h, context):
+    testtype = yield check_arena(arena, arena.a[h], context)
+    check_test('Conditional', testtype, arena.lineno(h), context)
+    with context.new_scope():
+        yield check_arena(arena, arena.b[h], context)
+    if arena.c[h] != NONE:
         with context.new_scope():
-            return check(node.statements, context)
-
-    elif isinstance(node, Name):
-        decl = context.lookup(node.value)
-        if not decl:
-            context.error(lineno(node), f'{node.value} undefined')
-            return 'error'
-        return decl[1]
-    
-    elif isinstance(node, FunctionDeclaration):
-        if node.return_type not in valid_types:
-            context.error(lineno(node), f'Invalid return type of {node.return_type}')
-
-        if context.lookup('return'):
-            context.error(lineno(node), f'Nested functions are not supported')
-
-        context.define(node.name, ('func', node))
-        with context.new_scope():        
-            for n, p in enumerate(node.parameters, start=1):
-                if p.type not in valid_types:
-                    context.error(lineno(p), f'Invalid type {p.type} in parameter {n}.')
-                context.define(p.name, ('var', p.type))
-
-            context.define('return', node.return_type)
-            check(node.body, context)
-
-    elif isinstance(node, FunctionApplication):
-        decl = check(node.func, context)
-        if decl in valid_types:
-            if len(node.arguments) != 1:
-                context.error(lineno(node), f"Type conversion to {decl} requires 1 argument.")
-                return decl
-            return decl
-        if not isinstance(decl, FunctionDeclaration):
-            context.error(lineno(node.func), f'Not a function')
-            return 
-        if len(node.arguments) != len(decl.parameters):
-            context.error(lineno(node), f"Wrong # arguments in function call. Expected {len(decl.parameters)}, got {len(node.arguments)}")
-            return decl.return_type
-        for n, (parm, arg) in enumerate(zip(decl.parameters, node.arguments), start=1):
-            argtype = check(arg, context)
-            if argtype != parm.type:
-                context.error(lineno(arg), f'Type error in argument {n}. Expected {parm.type}. Got {argtype}')
-        return decl.return_type
-
-    elif isinstance(node, ReturnStatement):
-        rettype = check(node.value, context)
-        expected = context.lookup('return')
-        if not expected:
-            context.error(lineno(node), f'return used outside a function')
-            return
-        if rettype != expected:
-            context.error(lineno(node), f'Type error in return. Expected {expected}. Got {rettype}')
-        
+            yield check_arena(arena, arena.c[h], context)
+    return None
+
+@checks_arena(WhileStatement)
+def check_arena_WhileStatement(arena, h, context):
+    testtype = yield check_arena(arena, arena.a[h], context)
+    check_test('While', testtype, arena.lineno(h), context)
+    with context.new_scope():
+        context.define('while', True)
+        yield check_arena(arena, arena.b[h], context)
+    return None
+
+@checks_arena(BreakStatement)
+def check_arena_BreakStatement(arena, h, context):
+    check_loop_control('break', arena.lineno(h), context)
+    return None
+
+@checks_arena(ContinueStatement)
+def check_arena_ContinueStatement(arena, h, context):
+    check_loop_control('continue', arena.lineno(h), context)
+    return None
+
+@checks_arena(CompoundExpression)
+def check_arena_CompoundExpression(arena, h, context):
+    with context.new_scope():
+        return (yield check_arena(arena, arena.a[h], context))
+
+@checks_arena(FunctionDeclaration)
+def check_arena_FunctionDeclaration(arena, h, context):
+    parameters = [ (arena.value(p), arena.literals[arena.b[p]], arena.lineno(p)) for p in arena.parameters(h) ]
+    return_type = arena.literals[arena.b[h]]
+    check_function_declaration(arena.value(h), parameters, return_type, arena.lineno(h), context)
+    with context.new_scope():
+        define_parameters(parameters, return_type, context)
+        yield check_arena(arena, arena.body(h), context)
+    return None
+
+@checks_arena(FunctionApplication)
+def check_arena_FunctionApplication(arena, h, context):
+    func = arena.a[h]
+    arguments = arena.arguments(h)
+    decl = yield check_arena(arena, func, context)
+    result, parmtypes = check_call(decl, len(arguments), arena.lineno(h), arena.lineno(func), context)
+    if parmtypes:
+        for n, (parmtype, arg) in enumerate(zip(parmtypes, arguments), start=1):
+            argtype = yield check_arena(arena, arg, context)
+            check_argument(n, parmtype, argtype, arena.lineno(arg), context)
+    return result
+
+@checks_arena(ReturnStatement)
+def check_arena_ReturnStatement(arena, h, context):
+    rettype = yield check_arena(arena, arena.a[h], context)
+    check_return(rettype, arena.lineno(h), context)
+    return None
+
+# Type of a function.  This is what a function name is bound to.
+FunctionType = namedtuple('FunctionType', ['parameters', 'return_type'])
+
+# Checking rules
+def check_binop(op, ltype, rtype, lineno, context):
+    if (   (ltype in { 'int', 'float' }
+            and op not in { '+', '-', '*', '/', '<', '>', '<=', '>=', '==', '!=' })
+           or (ltype == 'bool'
+               and op not in { '&&', '||', '==', '!='})
+           or (ltype == 'char'
+               and op not in { '<', '>', '<=', '>=', '==', '!=' })):
+        context.error(lineno, f'Unsupported binary operator: {ltype} {op} {rtype}')
+        return 'error'
+    if ltype != rtype:
+        context.error(lineno, f'Type error in binary operator. {ltype} {op} {rtype}')
+        return 'error'
+    if op in {'<', '>', '<=', '>=', '==', '!=', '&&', '!='}:
+        return 'bool'
+    return ltype
+
+def check_unaryop(op, optype, lineno, context):
+    if (   (optype in { 'int', 'float' }
+            and op not in { '+', '-' })
+           or (optype == 'bool'
+               and op not in { '!' })
+           or (optype == 'char')):
+        context.error(lineno, f'Unsupported unary operator: {op} {optype}')
+        return 'error'
+    return optype
+
+def check_const_declaration(name, type, result_type, lineno, context):
+    if type and type != result_type:
+        context.error(lineno, f'Type error in assignment {type} = {result_type}')
+    if not context.define(name, ('const', result_type)):
+        context.error(lineno, f'Duplicate definition of {name}')
+
+def check_var_declaration(name, type, has_value, result_type, lineno, context):
+    if type and has_value and type != result_type:
+        context.error(lineno, f'Type error in assignment {type} = {result_type}')
+    elif type is None and not has_value:
+        context.error(lineno, f'Missing type on declaration of {name}')
+    elif type and type not in valid_types:
+        context.error(lineno, f'Unknown type {type}')
+    context.define(name, ('var', result_type if result_type else type))
+
+def check_name(name, lineno, context):
+    decl = context.lookup(name)
+    if not decl:
+        context.error(lineno, f'Undefined name {name}')
+        return 'error'
     else:
-        raise RuntimeError(f"Couldn't check {node}")
+        return decl[1]
 
-def check_lhs(node, valuetype, context):
-    if isinstance(node, Name):
-        decl = context.lookup(node.value)
-        if not decl:
-            context.error(lineno(node), f'{node.value} not defined')
-            return
-        if decl[0] != 'var':
-            context.error(lineno(node), f"Can't assign to {node.value}")
-        if decl[1] != valuetype:
-            context.error(lineno(node), f'Type error in assignment. Expected {decl[1]}. Got {valuetype}')
+def check_store(name, valuetype, lineno, context):
+    decl = context.lookup(name)
+    if not decl:
+        context.error(lineno, f'{name} not defined')
+        return
+    if decl[0] != 'var':
+        context.error(lineno, f"Can't assign to {name}")
+    if decl[1] != valuetype:
+        context.error(lineno, f'Type error in assignment. Expected {decl[1]}. Got {valuetype}')
+
+def check_test(what, testtype, lineno, context):
+    if testtype != 'bool':
+        context.error(lineno, f'{what} test must be a bool. Got {testtype}')
+
+def check_loop_control(what, lineno, context):
+    if not context.lookup('while'):
+        context.error(lineno, f'{what} used outside of a while loop')
+
+def check_function_declaration(name, parameters, return_type, lineno, context):
+    # parameters is a list of (name, type, lineno)
+    if return_type not in valid_types:
+        context.error(lineno, f'Invalid return type of {return_type}')
+
+    if context.lookup('return'):
+        context.error(lineno, f'Nested functions are not supported')
+
+    context.define(name, ('func', FunctionType(tuple(ptype for _, ptype, _ in parameters), return_type)))
+
+def define_parameters(parameters, return_type, context):
+    for n, (pname, ptype, plineno) in enumerate(parameters, start=1):
+        if ptype not in valid_types:
+            context.error(plineno, f'Invalid type {ptype} in parameter {n}.')
+        context.define(pname, ('var', ptype))
+    context.define('return', return_type)
+
+def check_call(decl, nargs, lineno, funclineno, context):
+    '''
+    Check what is being called.  Returns the result type and the
+    parameter types the arguments need to be checked against (None if
+    the arguments shouldn't be checked).
+    '''
+    if decl in valid_types:
+        if nargs != 1:
+            context.error(lineno, f"Type conversion to {decl} requires 1 argument.")
+        return decl, None
+    if not isinstance(decl, FunctionType):
+        context.error(funclineno, f'Not a function')
+        return None, None
+    if nargs != len(decl.parameters):
+        context.error(lineno, f"Wrong # arguments in function call. Expected {len(decl.parameters)}, got {nargs}")
+        return decl.return_type, None
+    return decl.return_type, decl.parameters
+
+def check_argument(n, parmtype, argtype, lineno, context):
+    if argtype != parmtype:
+        context.error(lineno, f'Type error in argument {n}. Expected {parmtype}. Got {argtype}')
+
+def check_return(rettype, lineno, context):
+    expected = context.lookup('return')
+    if not expected:
+        context.error(lineno, f'return used outside a function')
+        return
+    if rettype != expected:
+        context.error(lineno, f'Type error in return. Expected {expected}. Got {rettype}')
     
 # Sample main program
 def main(filename):
@@ -0,0 +1,494 @@
+# vm.py
+#
+# A small stack-based bytecode VM for Wabbit.  The model is lowered
+# into one flat instruction stream stored in an array of integers.
+# Every instruction is two integers: an opcode and an operand (the
+# operand is 0 if unused).  Names are resolved at compile time to
+# global or local slot numbers, constants live in a separate pool and
+# jumps use absolute instruction addresses.
+#
+# Function bodies are placed inline in the stream with a jump around
+# them.  A call creates a new frame (a list of local slots) and saves
+# the return address on the call stack.
+#
+# Example:
+#
+#     var x int = 2;            CONST      0      # consts[0] = 2
+#     print x * 3;              STORE_GLOBAL 0
+#                               LOAD_GLOBAL 0
+#                               CONST      1      # consts[1] = 3
+#                               IMUL       0
+#                               PRINTI     0
+
+from .model import *
+from .interp import wrap_i32, div_i32, div_f64
+
+from .scope import Scope
+from .trampoline import trampoline
+
+from array import array
+from contextlib import contextmanager
+import sys
+
+# Opcodes.  The dispatch loop in run() tests them roughly in order of
+# how frequently they occur in loop-heavy code.
+opnames = [
+    'LOAD_LOCAL', 'STORE_LOCAL', 'CONST', 'LOAD_GLOBAL', 'STORE_GLOBAL',
+    'JUMP_IF_FALSE', 'JUMP',
+    'IADD', 'ISUB', 'IMUL', 'IDIV',
+    'LT', 'LE', 'GT', 'GE', 'EQ', 'NE', 'AND', 'OR', 'NOT',
+    'FADD', 'FSUB', 'FMUL', 'FDIV',
+    'CALL', 'RETURN', 'POP',
+    'INEG', 'FNEG', 'ITOF', 'FTOI', 'BTOI',
+    'PRINTI', 'PRINTF', 'PRINTB', 'PRINTC',
+    'HALT',
+    ]
+
+(LOAD_LOCAL, STORE_LOCAL, CONST, LOAD_GLOBAL, STORE_GLOBAL,
+ JUMP_IF_FALSE, JUMP,
+ IADD, ISUB, IMUL, IDIV,
+ LT, LE, GT, GE, EQ, NE, AND, OR, NOT,
+ FADD, FSUB, FMUL, FDIV,
+ CALL, RETURN, POP,
+ INEG, FNEG, ITOF, FTOI, BTOI,
+ PRINTI, PRINTF, PRINTB, PRINTC,
+ HALT) = range(len(opnames))
+
+# Effect of each opcode on the depth of the operand stack
+_stack_effect = {
+    LOAD_LOCAL: 1, STORE_LOCAL: -1, CONST: 1, LOAD_GLOBAL: 1, STORE_GLOBAL: -1,
+    JUMP_IF_FALSE: -1, JUMP: 0,
+    IADD: -1, ISUB: -1, IMUL: -1, IDIV: -1,
+    LT: -1, LE: -1, GT: -1, GE: -1, EQ: -1, NE: -1, AND: -1, OR: -1, NOT: 0,
+    FADD: -1, FSUB: -1, FMUL: -1, FDIV: -1,
+    CALL: 0, RETURN: -1, POP: -1,
+    INEG: 0, FNEG: 0, ITOF: 0, FTOI: 0, BTOI: 0,
+    PRINTI: -1, PRINTF: -1, PRINTB: -1, PRINTC: -1,
+    HALT: 0,
+    }
+
+_int_ops = { '+': IADD, '-': ISUB, '*': IMUL, '/': IDIV }
+_float_ops = { '+': FADD, '-': FSUB, '*': FMUL, '/': FDIV }
+_compare_ops = { '<': LT, '<=': LE, '>': GT, '>=': GE, '==': EQ, '!=': NE, '&&': AND, '||': OR }
+_print_ops = { 'int': PRINTI, 'float': PRINTF, 'bool': PRINTB, 'char': PRINTC }
+
+_zero = {
+    'int': 0,
+    'float': 0.0,
+    'char': 0,
+    'bool': False,
+    }
+
+class VMFunction:
+    __slots__ = ('name', 'entry', 'nparams', 'frame', 'ret_type')
+
+    def __init__(self, name, nparams, ret_type):
+        self.name = name
+        self.entry = None
+        self.nparams = nparams
+        self.frame = None              # Initial values of the local slots
+        self.ret_type = ret_type
+
+class Program:
+    '''
+    A compiled program: the instruction stream plus the tables that
+    the operands refer to.
+    '''
+    def __init__(self, code, consts, functions, nglobals):
+        self.code = code
+        self.consts = consts
+        self.functions = functions
+        self.nglobals = nglobals
+
+    def disassemble(self):
+        lines = [ ]
+        for pc in range(0, len(self.code), 2):
+            op, arg = self.code[pc], self.code[pc+1]
+            if op == CONST:
+                lines.append(f'{pc:6d} {opnames[op]:<14} {arg} ({self.consts[arg]!r})')
+            elif op == CALL:
+                lines.append(f'{pc:6d} {opnames[op]:<14} {arg} ({self.functions[arg].name})')
+            else:
+                lines.append(f'{pc:6d} {opnames[op]:<14} {arg}')
+        return '\n'.join(lines)
+
+class VMContext:
+    def __init__(self):
+        self.env = Scope()
+        self.code = [ ]
+        self.consts = [ ]
+        self.constmap = { }
+        self.functions = [ ]
+        self.nglobals = 0
+        self.frame = None              # Slot types of the current function
+        self.depth = 0                 # Static depth of the operand stack
+
+    def lookup(self, name):
+        return self.env.get(name)
+
+    def define(self, name, value):
+        self.env[name] = value
+
+    @contextmanager
+    def new_scope(self):
+        self.env.push()
+        try:
+            yield
+        finally:
+            self.env.pop()
+
+    def emit(self, op, arg=0):
+        self.code.append(op)
+        self.code.append(arg)
+        self.depth += _stack_effect[op]
+        return len(self.code) - 1      # Position of the operand (for patching)
+
+    def patch(self, pos, target=None):
+        self.code[pos] = len(self.code) if target is None else target
+
+    def here(self):
+        return len(self.code)
+
+    def constant(self, value):
+        key = (type(value), repr(value))
+        if key not in self.constmap:
+            self.constmap[key] = len(self.consts)
+            self.consts.append(value)
+        return self.emit(CONST, self.constmap[key])
+
+    def allocate(self, valtype):
+        if self.frame is None:
+            self.nglobals += 1
+            return ('global', self.nglobals - 1)
+        else:
+            self.frame.append(valtype)
+            return ('local', len(self.frame) - 1)
+
+# Top-level function: lower the model into a Program
+def compile_program(model):
+    context = VMContext()
+    context.define('int', ('type', 'int'))
+    context.define('float', ('type', 'float'))
+    context.define('char', ('type', 'char'))
+    context.define('bool', ('type', 'bool'))
+    trampoline(generate_statement(model, context))
+    main = context.lookup('main')
+    if main and main[0] == 'func':
+        context.emit(CALL, main[1])
+        context.emit(POP)
+    context.emit(HALT)
+    return Program(array('i', context.code), context.consts, context.functions, context.nglobals)
+
+# The lowering functions are generators run by trampoline() (see
+# trampoline.py), so deeply nested programs don't use up the Python
+# stack.  They yield the lowering of each child and get back its result.
+
+# Lower an expression.  Leaves its value on the stack and returns the type.
+def generate(node, context):
+    if isinstance(node, Integer):
+        context.constant(wrap_i32(int(node.value)))
+        return 'int'
+
+    elif isinstance(node, Float):
+        context.constant(float(node.value))
+        return 'float'
+
+    elif isinstance(node, Boolean):
+        context.constant(node.value == 'true')
+        return 'bool'
+
+    elif isinstance(node, Character):
+        context.constant(ord(eval(node.value)))
+        return 'char'
+
+    elif isinstance(node, Name):
+        kind, slot, valtype = context.lookup(node.value)
+        context.emit(LOAD_GLOBAL if kind == 'global' else LOAD_LOCAL, slot)
+        return valtype
+
+    elif isinstance(node, BinOp):
+        ltype = yield generate(node.left, context)
+        yield generate(node.right, context)
+        if node.op in _int_ops:
+            if ltype == 'float':
+                context.emit(_float_ops[node.op])
+            else:
+                context.emit(_int_ops[node.op])
+            return ltype
+        context.emit(_compare_ops[node.op])
+        return 'bool'
+
+    elif isinstance(node, UnaryOp):
+        optype = yield generate(node.operand, context)
+        if node.op == '-':
+            context.emit(FNEG if optype == 'float' else INEG)
+        elif node.op == '!':
+            context.emit(NOT)
+        return optype
+
+    elif isinstance(node, Grouping):
+        return (yield generate(node.expression, context))
+
+    elif isinstance(node, CompoundExpression):
+        with context.new_scope():
+            stmts = node.statements.statements
+            if stmts and isinstance(stmts[-1], ExpressionAsStatement):
+                for stmt in stmts[:-1]:
+                    yield generate_statement(stmt, context)
+                return (yield generate(stmts[-1].expression, context))
+            for stmt in stmts:
+                yield generate_statement(stmt, context)
+            return None
+
+    elif isinstance(node, FunctionApplication):
+        decl = context.lookup(node.func.value)
+        argtypes = [ ]
+        for arg in node.arguments:
+            argtypes.append((yield generate(arg, context)))
+        if decl[0] == 'type':
+            totype, fromtype = decl[1], argtypes[0]
+            if totype == 'float' and fromtype != 'float':
+                context.emit(ITOF)
+            elif totype != 'float' and fromtype == 'float':
+                context.emit(FTOI)
+            elif fromtype == 'bool' and totype != 'bool':
+                context.emit(BTOI)
+            return totype
+        func = context.functions[decl[1]]
+        context.emit(CALL, decl[1])
+        context.depth += 1 - func.nparams
+        return func.ret_type
+
+    else:
+        raise RuntimeError(f"Can't generate {node}")
+
+# Lower a statement.  Leaves the stack as it was.
+def generate_statement(node, context):
+    if isinstance(node, Statements):
+        for stmt in node.statements:
+            yield generate_statement(stmt, context)
+
+    elif isinstance(node, ExpressionAsStatement):
+        if (yield generate(node.expression, context)):
+            context.emit(POP)
+
+    elif isinstance(node, PrintStatement):
+        valtype = yield generate(node.value, context)
+        context.emit(_print_ops[valtype])
+
+    elif isinstance(node, (ConstDeclaration, VarDeclaration)):
+        if node.value:
+            valtype = yield generate(node.value, context)
+        else:
+            valtype = node.type
+            context.constant(_zero[valtype])
+        kind, slot = context.allocate(valtype)
+        context.define(node.name, (kind, slot, valtype))
+        context.emit(STORE_GLOBAL if kind == 'global' else STORE_LOCAL, slot)
+
+    elif isinstance(node, Assignment):
+        yield generate(node.value, context)
+        kind, slot, valtype = context.lookup(node.location.value)
+        context.emit(STORE_GLOBAL if kind == 'global' else STORE_LOCAL, slot)
+
+    elif isinstance(node, IfStatement):
+        yield generate(node.test, context)
+        to_else = context.emit(JUMP_IF_FALSE)
+        with context.new_scope():
+            yield generate_statement(node.consequence, context)
+        if node.alternative:
+            to_end = context.emit(JUMP)
+            context.patch(to_else)
+            with context.new_scope():
+                yield generate_statement(node.alternative, context)
+            context.patch(to_end)
+        else:
+            context.patch(to_else)
+
+    elif isinstance(node, WhileStatement):
+        top = context.here()
+        yield generate(node.test, context)
+        to_exit = context.emit(JUMP_IF_FALSE)
+        breaks = [ ]
+        with context.new_scope():
+            context.define('while', (top, breaks, context.depth))
+            yield generate_statement(node.body, context)
+        context.emit(JUMP, top)
+        context.patch(to_exit)
+        for pos in breaks:
+            context.patch(pos)
+
+    elif isinstance(node, (BreakStatement, ContinueStatement)):
+        top, breaks, depth = context.lookup('while')
+        # Discard anything left on the stack by enclosing expressions
+        saved = context.depth
+        for _ in range(context.depth - depth):
+            context.emit(POP)
+        if isinstance(node, BreakStatement):
+            breaks.append(context.emit(JUMP))
+        else:
+            context.emit(JUMP, top)
+        context.depth = saved
+
+    elif isinstance(node, ReturnStatement):
+        yield generate(node.value, context)
+        context.emit(RETURN)
+
+    elif isinstance(node, FunctionDeclaration):
+        func = VMFunction(node.name, len(node.parameters), node.return_type)
+        index = len(context.functions)
+        context.functions.append(func)
+        context.define(node.name, ('func', index))
+        skip = context.emit(JUMP)
+        func.entry = context.here()
+        oldframe, olddepth = context.frame, context.depth
+        context.frame, context.depth = [ ], 0
+        with context.new_scope():
+            for parm in node.parameters:
+                kind, slot = context.allocate(parm.type)
+                context.define(parm.name, (kind, slot, parm.type))
+            yield generate_statement(node.body, context)
+        # Falling off the end returns the zero value of the return type
+        context.constant(_zero.get(node.return_type, 0))
+        context.emit(RETURN)
+        func.frame = [ _zero[valtype] for valtype in context.frame ]
+        context.frame, context.depth = oldframe, olddepth
+        context.patch(skip)
+
+    else:
+        raise RuntimeError(f"Can't generate {node}")
+
+def run(program, out=sys.stdout):
+    '''
+    Execute a compiled program.
+    '''
+    code = program.code
+    consts = program.consts
+    functions = program.functions
+    globals_ = [0] * program.nglobals
+    stack = [ ]
+    push = stack.append
+    pop = stack.pop
+    frames = [ ]                       # Saved (pc, locals, stack base)
+    locals_ = None
+    base = 0
+    write = out.write
+    pc = 0
+    while True:
+        op = code[pc]
+        arg = code[pc+1]
+        pc += 2
+        if op == LOAD_LOCAL:
+            push(locals_[arg])
+        elif op == STORE_LOCAL:
+            locals_[arg] = pop()
+        elif op == CONST:
+            push(consts[arg])
+        elif op == LOAD_GLOBAL:
+            push(globals_[arg])
+        elif op == STORE_GLOBAL:
+            globals_[arg] = pop()
+        elif op == JUMP_IF_FALSE:
+            if not pop():
+                pc = arg
+        elif op == JUMP:
+            pc = arg
+        elif op <= IDIV:
+            right = pop()
+            if op == IADD:
+                stack[-1] = (stack[-1] + right + 0x80000000 & 0xffffffff) - 0x80000000
+            elif op == ISUB:
+                stack[-1] = (stack[-1] - right + 0x80000000 & 0xffffffff) - 0x80000000
+            elif op == IMUL:
+                stack[-1] = (stack[-1] * right + 0x80000000 & 0xffffffff) - 0x80000000
+            else:
+                stack[-1] = div_i32(stack[-1], right)
+        elif op <= NOT:
+            if op == NOT:
+                stack[-1] = not stack[-1]
+                continue
+            right = pop()
+            if op == LT:
+                stack[-1] = stack[-1] < right
+            elif op == LE:
+                stack[-1] = stack[-1] <= right
+            elif op == GT:
+                stack[-1] = stack[-1] > right
+            elif op == GE:
+                stack[-1] = stack[-1] >= right
+            elif op == EQ:
+                stack[-1] = stack[-1] == right
+            elif op == NE:
+                stack[-1] = stack[-1] != right
+            elif op == AND:
+                stack[-1] = stack[-1] & right
+            else:
+                stack[-1] = stack[-1] | right
+        elif op <= FDIV:
+            right = pop()
+            if op == FADD:
+                stack[-1] += right
+            elif op == FSUB:
+                stack[-1] -= right
+            elif op == FMUL:
+                stack[-1] *= right
+            else:
+                stack[-1] = div_f64(stack[-1], right)
+        elif op == CALL:
+            func = functions[arg]
+            frames.append((pc, locals_, base))
+            locals_ = func.frame.copy()
+            nparams = func.nparams
+            if nparams:
+                locals_[:nparams] = stack[-nparams:]
+                del stack[-nparams:]
+            base = len(stack)
+            pc = func.entry
+        elif op == RETURN:
+            value = pop()
+            del stack[base:]
+            push(value)
+            pc, locals_, base = frames.pop()
+        elif op == POP:
+            pop()
+        elif op == INEG:
+            stack[-1] = wrap_i32(-stack[-1])
+        elif op == FNEG:
+            stack[-1] = 0.0 - stack[-1]
+        elif op == ITOF:
+            stack[-1] = float(stack[-1])
+        elif op == FTOI:
+            stack[-1] = wrap_i32(int(stack[-1]))
+        elif op == BTOI:
+            stack[-1] = int(stack[-1])
+        elif op == PRINTI or op == PRINTF:
+            write(f'{pop()}\n')
+        elif op == PRINTB:
+            write('true\n' if pop() else 'false\n')
+        elif op == PRINTC:
+            write(chr(pop()))
+        elif op == HALT:
+            return
+        else:
+            raise RuntimeError(f'Bad opcode {op} at {pc-2}')
+
+def main(filename, disassemble=False):
+    from .parse import parse_file
+    from .typecheck import check_program
+    model = parse_file(filename)
+    if check_program(model):
+        program = compile_program(model)
+        if disassemble:
+            print(program.disassemble())
+        else:
+            run(program)
+
+if __name__ == '__main__':
+    import sys
+    args = sys.argv[1:]
+    disassemble = '-dis' in args
+    if disassemble:
+        args.remove('-dis')
+    if len(args) != 1:
+        raise SystemExit('Usage: python3 -m wabbit.vm [-dis] filename')
+    main(args[0], disassemble)
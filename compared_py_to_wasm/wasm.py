@@ -2,7 +2,10 @@
 #
 
 from .model import *
-from collections import ChainMap
+from .arena import *
+from .trampoline import trampoline
+from .scope import Scope, RecordingScope, ScopeView, LayeredScope
+from .binary import wrap_i32
 from contextlib import contextmanager
 
 _typemap = {
@@ -12,6 +15,23 @@ _typemap = {
     'char': 'i32',
     }
 
+# Instructions are (opcode, operand) tuples such as ('i32.const', 42),
+# ('local.get', 'x') or ('i32.add', None).  The operand of a variable,
+# call or branch instruction is a name (without the $) and the operand
+# of a block or loop is its label.  format_instruction() makes the WAT
+# text of an instruction, and binary.py encodes them.
+
+_named = { 'local.get', 'local.set', 'local.tee', 'global.get', 'global.set',
+           'call', 'br', 'br_if', 'block', 'loop' }
+
+def format_instruction(instr):
+    op, arg = instr
+    if arg is None:
+        return op
+    elif op in _named:
+        return f'{op} ${arg}'
+    return f'{op} {arg!r}'
+
 class WasmFunction:
     def __init__(self, name, parameters, ret_type):
         self.name = name
@@ -19,6 +39,10 @@ class WasmFunction:
         self.ret_type = ret_type
         self.code = [ ]
         self.locals = [ ]
+        self.names = { parm.name for parm in parameters }
+        self.free = { }           # wasm type -> local slots not in use
+        self.nlabels = 0          # Labels are numbered in each function
+        self.wrapped = True       # In block $return, with local $return (see peephole.py)
 
     def __str__(self):
         out = f'(func ${self.name} (export "{self.name}")\n'
@@ -26,38 +50,84 @@ class WasmFunction:
             out += f'(param ${parm.name} {_typemap[parm.type]})\n'
         if self.ret_type:
             out += f'(result {_typemap[self.ret_type]})\n'
-            out += f'(local $return {_typemap[self.ret_type]})\n'
-        out += '\n'.join(self.locals)
-        out += '\nblock $return\n'
-        out += '\n'.join(self.code)
-        out += '\nend\n'
-        if self.ret_type:
-            out += 'local.get $return\n'
+            if self.wrapped:
+                out += f'(local $return {_typemap[self.ret_type]})\n'
+        out += '\n'.join(f'(local ${name} {wtype})' for name, wtype in self.locals)
+        code = '\n'.join(map(format_instruction, self.code))
+        if self.wrapped:
+            out += '\nblock $return\n'
+            out += code
+            out += '\nend\n'
+            if self.ret_type:
+                out += 'local.get $return\n'
+        else:
+            out += '\n' + code + '\n'
         out += ')\n'
         return out
-        
+
+    def new_local(self, name, wtype):
+        '''
+        Get a local slot of type wtype for the variable name.  A slot
+        that is free again (its variable's scope has closed) is reused.
+        Returns (slot, reused).
+        '''
+        free = self.free.get(wtype)
+        if free:
+            return free.pop(), True
+        slot = unique_name(name, self.names)
+        self.locals.append((slot, wtype))
+        return slot, False
+
+def unique_name(name, names):
+    '''
+    Return name, or name with a '.N' suffix if it's already in names (a
+    variable declared twice in different scopes).  The result is added
+    to names.
+    '''
+    unique = name
+    n = 0
+    while unique in names:
+        n += 1
+        unique = f'{name}.{n}'
+    names.add(unique)
+    return unique
+
 # Class representing the world of Wasm
 class WabbitWasmModule:
     def __init__(self):
-        self.module = [ '(module' ]
-        self.env = ChainMap()
+        self.imports = [ ]
+        self.globals = [ ]
+        self.global_names = set()
+        self.functions = [ ]
+        self.env = Scope()
         self.function = WasmFunction('_init', [], None)
         self.scope = 'global'
-        self.nlabels = 0
-        self.have_main = False        
-        self.module.append('(import "env" "_printi" (func $_printi ( param i32 )))')
-        self.module.append('(import "env" "_printf" (func $_printf ( param f64 )))')
-        self.module.append('(import "env" "_printb" (func $_printb ( param i32 )))')
-        self.module.append('(import "env" "_printc" (func $_printc ( param i32 )))')
-                
+        self.scope_slots = [ [ ] ]     # Local slots in use, for each open scope
+        self.deferred = None           # Functions left to generate_deferred()
+        self.have_main = False
+        self.imports.append(('_printi', 'i32'))
+        self.imports.append(('_printf', 'f64'))
+        self.imports.append(('_printb', 'i32'))
+        self.imports.append(('_printc', 'i32'))
+
     def __str__(self):
-        return '\n'.join(self.module) + '\n)\n'
+        out = [ '(module' ]
+        for name, ptype in self.imports:
+            out.append(f'(import "env" "{name}" (func ${name} ( param {ptype} )))')
+        for name, gtype in self.globals:
+            out.append(f'(global ${name} (mut {gtype}) ({gtype}.const 0))')
+        out.extend(str(func) for func in self.functions)
+        return '\n'.join(out) + '\n)\n'
 
     @contextmanager
     def new_scope(self):
-        self.env = self.env.new_child()
+        self.env.push()
+        self.scope_slots.append([ ])
         yield
-        self.env = self.env.parents
+        # The locals declared in the scope can be reused from here on
+        for slot, wtype in self.scope_slots.pop():
+            self.function.free.setdefault(wtype, []).append(slot)
+        self.env.pop()
         
     def define(self, name, value):
         self.env[name] = value
@@ -66,308 +136,643 @@ class WabbitWasmModule:
         return self.env[name]
 
     def new_label(self):
-        self.nlabels += 1
-        return f'label{self.nlabels}'
+        self.function.nlabels += 1
+        return f'label{self.function.nlabels}'
     
-# Top-level function for generating code from the model
-def generate_program(model):
+# Top-level function for generating code from the model.  The module
+# object can be rendered as WAT text (str) or encoded to a binary .wasm
+# module (see binary.py).  Both come from the same instruction lists.
+#
+# With jobs > 1, the function bodies are generated in parallel.  The
+# code for a function only depends on the definitions it can see (the
+# globals and the functions before it) and makes nothing outside of its
+# WasmFunction.  So the top level is generated first, in a module that
+# keeps a history of its definitions (a RecordingScope), recording each
+# function with the point in the history where it was declared.  Then a
+# pool of worker processes generates (and optimizes) the bodies, each
+# looking names up in the history as of its function's point.  The
+# result is exactly the same as generating them one after another.
+def generate_module(model, optimize=True, jobs=1):
     mod = WabbitWasmModule()
-    generate(model, mod)
+    if jobs > 1:
+        mod.deferred = [ ]
+        mod.env = RecordingScope()
+    if isinstance(model, Arena):
+        valtype = trampoline(generate_arena(model, len(model) - 1, mod))
+    else:
+        valtype = trampoline(generate(model, mod))
+    emit_discard(valtype, mod)
     if mod.have_main:
-        mod.function.code.append('call $main')
-        mod.function.code.append('drop')
-    mod.module.append(str(mod.function))
-    return str(mod)
+        mod.function.code.append(('call', 'main'))
+        mod.function.code.append(('drop', None))
+    if mod.deferred:
+        generate_deferred(model, mod, optimize, jobs)
+    mod.functions.append(mod.function)
+    if optimize:
+        from .peephole import optimize_module, optimize_function
+        if mod.deferred is None:
+            optimize_module(mod)
+        else:
+            optimize_function(mod.function)
+    return mod
 
-# Internal function for generating code on each node
-def generate(node, mod):
-    if isinstance(node, Integer):
-        mod.function.code.append(f'i32.const {node.value}')
-        return 'int'
-    
-    elif isinstance(node, Float):
-        mod.function.code.append(f'f64.const {node.value}')
-        return 'float'
-    
-    elif isinstance(node, Boolean):
-        mod.function.code.append(f'i32.const {int(node.value=="true")}')
-        return 'bool'
-    
-    elif isinstance(node, Character):
-        mod.function.code.append(f'i32.const {ord(eval(node.value))}')
-        return 'char'
-
-    elif isinstance(node, PrintStatement):
-        valtype = generate(node.value, mod)
-        if valtype == 'int':
-            mod.function.code.append('call $_printi')
-        elif valtype == 'float':
-            mod.function.code.append('call $_printf')
-        elif valtype == 'bool':
-            mod.function.code.append('call $_printb')
-        elif valtype == 'char':
-            mod.function.code.append('call $_printc')
-        return None
+def generate_program(model, optimize=True, jobs=1):
+    return str(generate_module(model, optimize, jobs))
 
-    elif isinstance(node, BinOp):
-        ltype = generate(node.left, mod)
-        rtype = generate(node.right, mod)
-        if ltype == 'float':
-            if node.op == '+':
-                mod.function.code.append('f64.add')
-                return 'float'
-            elif node.op == '-':
-                mod.function.code.append('f64.sub')
-                return 'float'                
-            elif node.op == '*':
-                mod.function.code.append('f64.mul')
-                return 'float'                
-            elif node.op == '/':
-                mod.function.code.append('f64.div')
-                return 'float'                
-            elif node.op == '<':
-                mod.function.code.append('f64.lt')
-                return 'bool'
-            elif node.op == '>':
-                mod.function.code.append('f64.gt')
-                return 'bool'                
-            elif node.op == '<=':
-                mod.function.code.append('f64.le')
-                return 'bool'                
-            elif node.op == '>=':
-                mod.function.code.append('f64.ge')
-                return 'bool'                
-            elif node.op == '==':
-                mod.function.code.append('f64.eq')
-                return 'bool'                
-            elif node.op == '!=':
-                mod.function.code.append('f64.ne')
-                return 'bool'                
-        else:
-            if node.op == '+':
-                mod.function.code.append('i32.add')
-                return ltype
-            elif node.op == '-':
-                mod.function.code.append('i32.sub')
-                return ltype
-            elif node.op == '*':
-                mod.function.code.append('i32.mul')
-                return ltype
-            elif node.op == '/':
-                mod.function.code.append('i32.div_s')
-                return ltype
-            elif node.op == '<':
-                mod.function.code.append('i32.lt_s')
-                return 'bool'
-            elif node.op == '>':
-                mod.function.code.append('i32.gt_s')
-                return 'bool'                
-            elif node.op == '<=':
-                mod.function.code.append('i32.le_s')
-                return 'bool'                
-            elif node.op == '>=':
-                mod.function.code.append('i32.ge_s')
-                return 'bool'                
-            elif node.op == '==':
-                mod.function.code.append('i32.eq')
-                return 'bool'                
-            elif node.op == '!=':
-                mod.function.code.append('i32.ne')
-                return 'bool'
-            elif node.op == '&&':
-                mod.function.code.append('i32.and')
-                return 'bool'
-            elif node.op == '||':
-                mod.function.code.append('i32.or')
-                return 'bool'
-
-    elif isinstance(node, UnaryOp):
-        pos = len(mod.function.code)
-        operandtype = generate(node.operand, mod)
-        if node.op == '-':
-            if operandtype == 'float':
-                mod.function.code.insert(pos, 'f64.const 0.0')
-                mod.function.code.append('f64.sub')
-            else:
-                mod.function.code.insert(pos, 'i32.const 0')
-                mod.function.code.append('i32.sub')
-        elif node.op == '!':
-            mod.function.code.append('i32.const 1')
-            mod.function.code.append('i32.xor')
-        return operandtype
-
-    elif isinstance(node, Grouping):
-        return generate(node.expression, mod)
-
-    elif isinstance(node, ConstDeclaration):
-        valtype = generate(node.value, mod)
-        if mod.scope == 'global':
-            if valtype == 'float':
-                mod.module.append(f'(global ${node.name} (mut f64) (f64.const 0.0))')
-            else:
-                mod.module.append(f'(global ${node.name} (mut i32) (i32.const 0))')
-            mod.function.code.append(f'global.set ${node.name}')
-        elif mod.scope == 'local':
-            if valtype == 'float':
-                mod.function.locals.append(f'(local ${node.name} f64)')
-            else:
-                mod.function.locals.append(f'(local ${node.name} i32)')
-            mod.function.code.append(f'local.set ${node.name}')
-        mod.define(node.name, (mod.scope, valtype))
-        return None
+def generate_binary(model, optimize=True, jobs=1):
+    from .binary import encode_module
+    return encode_module(generate_module(model, optimize, jobs))
 
-    elif isinstance(node, VarDeclaration):
-        if node.value:
-            valtype = generate(node.value, mod)
+def defer_function(node, name, return_type, mod):
+    '''
+    Leave a function for generate_deferred().  node is the
+    FunctionDeclaration (or its handle in an arena).
+    '''
+    mod.define(name, ('func', return_type))
+    mod.deferred.append((len(mod.functions), node, mod.env.clock))
+    mod.functions.append(None)      # Filled in by generate_deferred()
+    if name == 'main':
+        mod.have_main = True
+
+def generate_deferred(model, mod, optimize, jobs):
+    count = len(mod.deferred)
+    if count < 2:
+        _start_worker(model, mod.deferred, mod.env.history, optimize)
+        try:
+            functions = [ generate_function(n) for n in range(count) ]
+        finally:
+            _start_worker(None, None, None, False)
+    else:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        # Forked workers get the model without it being pickled
+        if 'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
         else:
-            valtype = node.type
-        if mod.scope == 'global':
-            if valtype == 'float':
-                mod.module.append(f'(global ${node.name} (mut f64) (f64.const 0.0))')
-            else:
-                mod.module.append(f'(global ${node.name} (mut i32) (i32.const 0))')
-            if node.value:
-                mod.function.code.append(f'global.set ${node.name}')
-        elif mod.scope == 'local':
-            if valtype == 'float':
-                mod.function.locals.append(f'(local ${node.name} f64)')
-            else:
-                mod.function.locals.append(f'(local ${node.name} i32)')
-            if node.value:
-                mod.function.code.append(f'local.set ${node.name}')
-                
-        mod.define(node.name, (mod.scope, valtype))
-        return None
+            context = multiprocessing.get_context()
+        jobs = min(jobs, count)
+        pool = ProcessPoolExecutor(jobs, mp_context=context, initializer=_start_worker,
+                                   initargs=(model, mod.deferred, mod.env.history, optimize))
+        with pool:
+            functions = list(pool.map(generate_function, range(count),
+                                      chunksize=max(1, count // (jobs * 4))))
+    for (index, _, _), func in zip(mod.deferred, functions):
+        mod.functions[index] = func
 
-    elif isinstance(node, Assignment):
-        generate_lhs(node.location, node.value, mod)
-        return None
-    
-    elif isinstance(node, Name):
-        scope, valtype = mod.lookup(node.value)
-        if scope == 'global':
-            mod.function.code.append(f'global.get ${node.value}')
-        elif scope == 'local':
-            mod.function.code.append(f'local.get ${node.value}')
-        return valtype
-        
-    elif isinstance(node, Statements):
-        result = None
-        for stmt in node.statements:
-            if result:
-                mod.function.code.append('drop')
-            result = generate(stmt, mod)
-        return result
-
-    elif isinstance(node, IfStatement):
-        generate(node.test, mod)
-        mod.function.code.append('if')
-        with mod.new_scope():
-            generate(node.consequence, mod)
-        if node.alternative:
-            mod.function.code.append('else')
-            with mod.new_scope():
-                generate(node.alternative, mod)
-        mod.function.code.append('end')
-        return None
-    
-    elif isinstance(node, WhileStatement):
-        test_label = mod.new_label()
-        exit_label = mod.new_label()
-        mod.function.code.append(f'block ${exit_label}')
-        mod.function.code.append(f'loop ${test_label}')
-        generate(node.test, mod)
-        mod.function.code.append(f'i32.const 1')
-        mod.function.code.append(f'i32.xor')
-        mod.function.code.append(f'br_if ${exit_label}')
+# The work given to each worker process
+_model = None
+_deferred = None
+_history = None
+_optimize = False
+
+def _start_worker(model, deferred, history, optimize):
+    global _model, _deferred, _history, _optimize
+    _model, _deferred, _history, _optimize = model, deferred, history, optimize
+
+def generate_function(n):
+    '''
+    Generate the function _deferred[n] in a module of its own that sees
+    the definitions the function could see where it was declared.
+    '''
+    _, node, point = _deferred[n]
+    mod = WabbitWasmModule()
+    mod.env = LayeredScope(ScopeView(_history, point))
+    if isinstance(_model, Arena):
+        trampoline(generate_arena(_model, node, mod))
+    else:
+        trampoline(generate(node, mod))
+    func = mod.functions[0]
+    if _optimize:
+        from .peephole import optimize_function
+        optimize_function(func)
+    return func
+
+# Internal function for generating code on each node.  Each node class
+# has its own generating function, registered with @generates(cls) and
+# looked up by the node's type.  The functions for nodes with children
+# are generators that yield the generation of each child node and get
+# back its type.  They're run by trampoline() so that deeply nested
+# programs don't overflow the Python stack.
+
+_generators = { }
+
+def generates(cls):
+    def register(func):
+        _generators[cls] = func
+        return func
+    return register
+
+def generate(node, mod):
+    generator = _generators.get(type(node))
+    if generator is None:
+        raise RuntimeError(f"Can't generate {node}")
+    return generator(node, mod)
+
+@generates(Integer)
+def generate_Integer(node, mod):
+    # Out of range literals wrap, as they do in the interpreter
+    mod.function.code.append(('i32.const', wrap_i32(int(node.value))))
+    return 'int'
+
+@generates(Float)
+def generate_Float(node, mod):
+    mod.function.code.append(('f64.const', float(node.value)))
+    return 'float'
+
+@generates(Boolean)
+def generate_Boolean(node, mod):
+    mod.function.code.append(('i32.const', int(node.value == 'true')))
+    return 'bool'
+
+@generates(Character)
+def generate_Character(node, mod):
+    mod.function.code.append(('i32.const', ord(eval(node.value))))
+    return 'char'
+
+@generates(Name)
+def generate_Name(node, mod):
+    return emit_load(node.value, mod)
+
+@generates(PrintStatement)
+def generate_PrintStatement(node, mod):
+    valtype = yield generate(node.value, mod)
+    emit_print(valtype, mod)
+    return None
+
+@generates(BinOp)
+def generate_BinOp(node, mod):
+    ltype = yield generate(node.left, mod)
+    rtype = yield generate(node.right, mod)
+    return emit_binop(node.op, ltype, mod)
+
+@generates(UnaryOp)
+def generate_UnaryOp(node, mod):
+    pos = emit_operand_slot(node.op, mod)
+    operandtype = yield generate(node.operand, mod)
+    return emit_unaryop(node.op, operandtype, pos, mod)
+
+@generates(Grouping)
+def generate_Grouping(node, mod):
+    return (yield generate(node.expression, mod))
+
+@generates(ConstDeclaration)
+def generate_ConstDeclaration(node, mod):
+    valtype = yield generate(node.value, mod)
+    emit_declaration(node.name, valtype, True, mod)
+    return None
+
+@generates(VarDeclaration)
+def generate_VarDeclaration(node, mod):
+    if node.value:
+        valtype = yield generate(node.value, mod)
+    else:
+        valtype = node.type
+    emit_declaration(node.name, valtype, bool(node.value), mod)
+    return None
+
+@generates(Assignment)
+def generate_Assignment(node, mod):
+    yield generate_lhs(node.location, node.value, mod)
+    return None
+
+@generates(Statements)
+def generate_Statements(node, mod):
+    result = None
+    for stmt in node.statements:
+        if result:
+            mod.function.code.append(('drop', None))
+        result = yield generate(stmt, mod)
+    return result
+
+@generates(IfStatement)
+def generate_IfStatement(node, mod):
+    yield generate(node.test, mod)
+    mod.function.code.append(('if', None))
+    with mod.new_scope():
+        emit_discard((yield generate(node.consequence, mod)), mod)
+    if node.alternative:
+        mod.function.code.append(('else', None))
         with mod.new_scope():
-            mod.define('break', exit_label)
-            mod.define('continue', test_label)
-            generate(node.body, mod)
-            mod.function.code.append(f'br ${test_label}')
-            mod.function.code.append('end')
-        mod.function.code.append('end')
-        return None
+            emit_discard((yield generate(node.alternative, mod)), mod)
+    mod.function.code.append(('end', None))
+    return None
 
-    elif isinstance(node, BreakStatement):
-        mod.function.code.append(f'br ${mod.lookup("break")}')
-        return None
+@generates(WhileStatement)
+def generate_WhileStatement(node, mod):
+    with while_loop(mod) as exit_label:
+        yield generate(node.test, mod)
+        emit_loop_test(exit_label, mod)
+        emit_discard((yield generate(node.body, mod)), mod)
+    return None
+
+@generates(BreakStatement)
+def generate_BreakStatement(node, mod):
+    mod.function.code.append(('br', mod.lookup('break')))
+    return None
+
+@generates(ContinueStatement)
+def generate_ContinueStatement(node, mod):
+    mod.function.code.append(('br', mod.lookup('continue')))
+    return None
+
+@generates(CompoundExpression)
+def generate_CompoundExpression(node, mod):
+    with mod.new_scope():
+        return (yield generate(node.statements, mod))
+
+@generates(ExpressionAsStatement)
+def generate_ExpressionAsStatement(node, mod):
+    return (yield generate(node.expression, mod))
 
-    elif isinstance(node, ContinueStatement):
-        mod.function.code.append(f'br ${mod.lookup("continue")}')
+@generates(FunctionDeclaration)
+def generate_FunctionDeclaration(node, mod):
+    if mod.deferred is not None:
+        defer_function(node, node.name, node.return_type, mod)
         return None
+    with function_definition(node.name, node.parameters, node.return_type, mod):
+        emit_discard((yield generate(node.body, mod)), mod)
+    return None
 
-    elif isinstance(node, CompoundExpression):
-        with mod.new_scope():
-            return generate(node.statements, mod)
+@generates(FunctionApplication)
+def generate_FunctionApplication(node, mod):
+    argtype = None
+    for arg in  node.arguments:
+        argtype = yield generate(arg, mod)
+    return emit_call(node.func.value, argtype, mod)
+
+@generates(ReturnStatement)
+def generate_ReturnStatement(node, mod):
+    yield generate(node.value, mod)
+    mod.function.code.append(('return', None))
+    return None
+
+def generate_lhs(location, value, mod):
+    valtype = yield generate(value, mod)
+    if isinstance(location, Name):
+        emit_store(location.value, mod)
+    return None
+
+# Generate code for an arena (see arena.py) starting from the node with
+# handle h.  Produces exactly the same instructions as generate().  The
+# generating functions are kept in a list indexed by the node kind.
 
-    elif isinstance(node, ExpressionAsStatement):
-        return generate(node.expression, mod)
+_arena_generators = [ None ] * len(node_classes)
+
+def generates_arena(cls):
+    def register(func):
+        _arena_generators[node_classes.index(cls)] = func
+        return func
+    return register
+
+def generate_arena(arena, h, mod):
+    generator = _arena_generators[arena.kinds[h]]
+    if generator is None:
+        raise RuntimeError(f"Can't generate arena node {h}")
+    return generator(arena, h, mod)
+
+@generates_arena(Integer)
+def generate_arena_Integer(arena, h, mod):
+    mod.function.code.append(('i32.const', wrap_i32(int(arena.value(h)))))
+    return 'int'
+
+@generates_arena(Float)
+def generate_arena_Float(arena, h, mod):
+    mod.function.code.append(('f64.const', float(arena.value(h))))
+    return 'float'
+
+@generates_arena(Boolean)
+def generate_arena_Boolean(arena, h, mod):
+    mod.function.code.append(('i32.const', int(arena.value(h) == 'true')))
+    return 'bool'
+
+@generates_arena(Character)
+def generate_arena_Character(arena, h, mod):
+    mod.function.code.append(('i32.const', ord(eval(arena.value(h)))))
+    return 'char'
+
+@generates_arena(Name)
+def generate_arena_Name(arena, h, mod):
+    return emit_load(arena.value(h), mod)
+
+@generates_arena(PrintStatement)
+def generate_arena_PrintStatement(arena, h, mod):
+    valtype = yield generate_arena(arena, arena.a[h], mod)
+    emit_print(valtype, mod)
+    return None
 
-    elif isinstance(node, FunctionDeclaration):
-        oldfunc = mod.function
-        mod.function = WasmFunction(node.name, node.parameters, node.return_type)
-        mod.define(node.name, ('func', node.return_type))
+@generates_arena(BinOp)
+def generate_arena_BinOp(arena, h, mod):
+    ltype = yield generate_arena(arena, arena.b[h], mod)
+    rtype = yield generate_arena(arena, arena.c[h], mod)
+    return emit_binop(arena.value(h), ltype, mod)
+
+@generates_arena(UnaryOp)
+def generate_arena_UnaryOp(arena, h, mod):
+    pos = emit_operand_slot(arena.value(h), mod)
+    operandtype = yield generate_arena(arena, arena.b[h], mod)
+    return emit_unaryop(arena.value(h), operandtype, pos, mod)
+
+@generates_arena(Grouping)
+@generates_arena(ExpressionAsStatement)
+def generate_arena_Grouping(arena, h, mod):
+    return (yield generate_arena(arena, arena.a[h], mod))
+
+@generates_arena(ConstDeclaration)
+@generates_arena(VarDeclaration)
+def generate_arena_Declaration(arena, h, mod):
+    has_value = arena.c[h] != NONE
+    if has_value:
+        valtype = yield generate_arena(arena, arena.c[h], mod)
+    else:
+        valtype = arena.literals[arena.b[h]] if arena.b[h] != NONE else None
+    emit_declaration(arena.value(h), valtype, has_value, mod)
+    return None
+
+@generates_arena(Assignment)
+def generate_arena_Assignment(arena, h, mod):
+    yield generate_arena(arena, arena.b[h], mod)
+    location = arena.a[h]
+    if arena.kinds[location] == NAME:
+        emit_store(arena.value(location), mod)
+    return None
+
+@generates_arena(Statements)
+def generate_arena_Statements(arena, h, mod):
+    result = None
+    for stmt in arena.statements(h):
+        if result:
+            mod.function.code.append(('drop', None))
+        result = yield generate_arena(arena, stmt, mod)
+    return result
+
+@generates_arena(IfStatement)
+def generate_arena_IfStatement(arena, h, mod):
+    yield generate_arena(arena, arena.a[h], mod)
+    mod.function.code.append(('if', None))
+    with mod.new_scope():
+        emit_discard((yield generate_arena(arena, arena.b[h], mod)), mod)
+    if arena.c[h] != NONE:
+        mod.function.code.append(('else', None))
         with mod.new_scope():
-            mod.scope = 'local'
-            for parm in node.parameters:
-                mod.define(parm.name, ('local', parm.type))
-            generate(node.body, mod)
-        mod.module.append(str(mod.function))
-        mod.function = oldfunc
-        mod.scope = 'global'
-        if node.name == 'main':
-            mod.have_main = True
+            emit_discard((yield generate_arena(arena, arena.c[h], mod)), mod)
+    mod.function.code.append(('end', None))
+    return None
+
+@generates_arena(WhileStatement)
+def generate_arena_WhileStatement(arena, h, mod):
+    with while_loop(mod) as exit_label:
+        yield generate_arena(arena, arena.a[h], mod)
+        emit_loop_test(exit_label, mod)
+        emit_discard((yield generate_arena(arena, arena.b[h], mod)), mod)
+    return None
+
+@generates_arena(BreakStatement)
+def generate_arena_BreakStatement(arena, h, mod):
+    mod.function.code.append(('br', mod.lookup('break')))
+    return None
+
+@generates_arena(ContinueStatement)
+def generate_arena_ContinueStatement(arena, h, mod):
+    mod.function.code.append(('br', mod.lookup('continue')))
+    return None
+
+@generates_arena(CompoundExpression)
+def generate_arena_CompoundExpression(arena, h, mod):
+    with mod.new_scope():
+        return (yield generate_arena(arena, arena.a[h], mod))
+
+@generates_arena(FunctionDeclaration)
+def generate_arena_FunctionDeclaration(arena, h, mod):
+    if mod.deferred is not None:
+        defer_function(h, arena.value(h), arena.literals[arena.b[h]], mod)
         return None
+    parameters = [ Parameter(arena.value(p), arena.literals[arena.b[p]]) for p in arena.parameters(h) ]
+    with function_definition(arena.value(h), parameters, arena.literals[arena.b[h]], mod):
+        emit_discard((yield generate_arena(arena, arena.body(h), mod)), mod)
+    return None
 
-    elif isinstance(node, FunctionApplication):
-        for arg in  node.arguments:
-            argtype = generate(arg, mod)
-        if node.func.value in {'int','bool','char'}:
-            if argtype == 'float':
-                mod.function.code.append('i32.trunc_s/f64')
-            return node.func.value
-        if node.func.value in 'float':
-            if argtype in {'int','bool','char'}:
-                mod.function.code.append('f64.convert_s/i32')
-            return 'float'
-            
-        mod.function.code.append(f'call ${node.func.value}')
-        decl, rettype = mod.lookup(node.func.value)
-        return rettype
-    
-    elif isinstance(node, ReturnStatement):
-        generate(node.value, mod)
-        mod.function.code.append('return')
+@generates_arena(FunctionApplication)
+def generate_arena_FunctionApplication(arena, h, mod):
+    argtype = None
+    for arg in arena.arguments(h):
+        argtype = yield generate_arena(arena, arg, mod)
+    return emit_call(arena.value(arena.a[h]), argtype, mod)
+
+@generates_arena(ReturnStatement)
+def generate_arena_ReturnStatement(arena, h, mod):
+    yield generate_arena(arena, arena.a[h], mod)
+    mod.function.code.append(('return', None))
+    return None
+
+# Code emitters shared by generate() and generate_arena()
+
+_printers = {
+    'int': ('call', '_printi'),
+    'float': ('call', '_printf'),
+    'bool': ('call', '_printb'),
+    'char': ('call', '_printc'),
+    }
+
+def emit_print(valtype, mod):
+    if valtype in _printers:
+        mod.function.code.append(_printers[valtype])
+
+# op -> (instruction, result type).  A result type of None means the
+# result has the same type as the left operand.
+_float_binops = {
+    '+': ('f64.add', 'float'),
+    '-': ('f64.sub', 'float'),
+    '*': ('f64.mul', 'float'),
+    '/': ('f64.div', 'float'),
+    '<': ('f64.lt', 'bool'),
+    '>': ('f64.gt', 'bool'),
+    '<=': ('f64.le', 'bool'),
+    '>=': ('f64.ge', 'bool'),
+    '==': ('f64.eq', 'bool'),
+    '!=': ('f64.ne', 'bool'),
+    }
+
+_int_binops = {
+    '+': ('i32.add', None),
+    '-': ('i32.sub', None),
+    '*': ('i32.mul', None),
+    '/': ('i32.div_s', None),
+    '<': ('i32.lt_s', 'bool'),
+    '>': ('i32.gt_s', 'bool'),
+    '<=': ('i32.le_s', 'bool'),
+    '>=': ('i32.ge_s', 'bool'),
+    '==': ('i32.eq', 'bool'),
+    '!=': ('i32.ne', 'bool'),
+    '&&': ('i32.and', 'bool'),
+    '||': ('i32.or', 'bool'),
+    }
+
+def emit_binop(op, ltype, mod):
+    table = _float_binops if ltype == 'float' else _int_binops
+    if op not in table:
         return None
-    
-    else:
-        raise RuntimeError(f"Can't generate {node}")
+    instr, result = table[op]
+    mod.function.code.append((instr, None))
+    return result or ltype
 
-def generate_lhs(location, value, mod):
-    valtype = generate(value, mod)
-    if isinstance(location, Name):
-        scope, valtype = mod.lookup(location.value)
-        if scope == 'global':
-            mod.function.code.append(f'global.set ${location.value}')
-        elif scope == 'local':
-            mod.function.code.append(f'local.set ${location.value}')
-            
+def emit_operand_slot(op, mod):
+    '''
+    Unary minus is 0 - x, so the zero has to go before the operand's
+    code.  Its type isn't known until the operand has been generated, so
+    this leaves a slot for emit_unaryop() to fill in.  Returns the
+    position of the slot (None if op doesn't need one).
+    '''
+    if op == '-':
+        mod.function.code.append(('nop', None))
+        return len(mod.function.code) - 1
     return None
+
+def emit_unaryop(op, operandtype, pos, mod):
+    # pos is the slot from emit_operand_slot()
+    if op == '-':
+        if operandtype == 'float':
+            mod.function.code[pos] = ('f64.const', 0.0)
+            mod.function.code.append(('f64.sub', None))
+        else:
+            mod.function.code[pos] = ('i32.const', 0)
+            mod.function.code.append(('i32.sub', None))
+    elif op == '!':
+        mod.function.code.append(('i32.eqz', None))
+    return operandtype
+
+def emit_declaration(name, valtype, has_value, mod):
+    # Variables are bound to (scope, type, slot), where slot is the name
+    # of the global or local that holds the value
+    wtype = _typemap.get(valtype, 'i32')
+    if mod.scope == 'global':
+        # Globals aren't reused.  A function declared in a block can
+        # still use the block's variables after the block has ended.
+        slot = unique_name(name, mod.global_names)
+        mod.globals.append((slot, wtype))
+        if has_value:
+            mod.function.code.append(('global.set', slot))
+        elif 'break' in mod.env:
+            # Declared in a loop (the optimizer makes globals of the
+            # variables in inlined functions): start at zero every time round
+            mod.function.code.append((f'{wtype}.const', 0.0 if wtype == 'f64' else 0))
+            mod.function.code.append(('global.set', slot))
+    elif mod.scope == 'local':
+        slot, reused = mod.function.new_local(name, wtype)
+        mod.scope_slots[-1].append((slot, wtype))
+        if has_value:
+            mod.function.code.append(('local.set', slot))
+        elif reused or 'break' in mod.env:
+            # A new variable starts at zero, not with whatever was left
+            # in the slot (by another variable or the last time round a loop)
+            mod.function.code.append((f'{wtype}.const', 0.0 if wtype == 'f64' else 0))
+            mod.function.code.append(('local.set', slot))
+    mod.define(name, (mod.scope, valtype, slot))
+
+def emit_load(name, mod):
+    scope, valtype, slot = mod.lookup(name)
+    if scope == 'global':
+        mod.function.code.append(('global.get', slot))
+    elif scope == 'local':
+        mod.function.code.append(('local.get', slot))
+    return valtype
+
+def emit_store(name, mod):
+    scope, valtype, slot = mod.lookup(name)
+    if scope == 'global':
+        mod.function.code.append(('global.set', slot))
+    elif scope == 'local':
+        mod.function.code.append(('local.set', slot))
+
+@contextmanager
+def while_loop(mod):
+    '''
+    Emit the blocks around a while loop.  The body of the with statement
+    generates the test, calls emit_loop_test() and then generates the
+    loop body.
+    '''
+    test_label = mod.new_label()
+    exit_label = mod.new_label()
+    mod.function.code.append(('block', exit_label))
+    mod.function.code.append(('loop', test_label))
+    with mod.new_scope():
+        mod.define('break', exit_label)
+        mod.define('continue', test_label)
+        yield exit_label
+        mod.function.code.append(('br', test_label))
+        mod.function.code.append(('end', None))
+    mod.function.code.append(('end', None))
+
+def emit_discard(valtype, mod):
+    # A block that ends with an expression statement leaves its value on
+    # the stack, but if/loop/function blocks don't produce a value
+    if valtype:
+        mod.function.code.append(('drop', None))
+
+def emit_loop_test(exit_label, mod):
+    mod.function.code.append(('i32.eqz', None))
+    mod.function.code.append(('br_if', exit_label))
+
+@contextmanager
+def function_definition(name, parameters, return_type, mod):
+    oldfunc = mod.function
+    mod.function = WasmFunction(name, parameters, return_type)
+    mod.define(name, ('func', return_type))
+    with mod.new_scope():
+        mod.scope = 'local'
+        for parm in parameters:
+            mod.define(parm.name, ('local', parm.type, parm.name))
+        yield
+    mod.functions.append(mod.function)
+    mod.function = oldfunc
+    mod.scope = 'global'
+    if name == 'main':
+        mod.have_main = True
+
+def emit_call(funcname, argtype, mod):
+    # argtype is the type of the last argument (used by type conversions)
+    if funcname in {'int','bool','char'}:
+        if argtype == 'float':
+            mod.function.code.append(('i32.trunc_s/f64', None))
+        return funcname
+    if funcname in 'float':
+        if argtype in {'int','bool','char'}:
+            mod.function.code.append(('f64.convert_s/i32', None))
+        return 'float'
+        
+    mod.function.code.append(('call', funcname))
+    decl, rettype = mod.lookup(funcname)
+    return rettype
     
-def main(filename):
+def main(filename, binary=False, jobs=1):
     from .parse import parse_file
     from .typecheck import check_program
     model = parse_file(filename)
     if check_program(model):
-        mod = generate_program(model)
-        with open('out.wat', 'w') as file:
-            file.write(mod)
-        print("Wrote out.wat")
+        if binary:
+            with open('out.wasm', 'wb') as file:
+                file.write(generate_binary(model, jobs=jobs))
+            print("Wrote out.wasm")
+        else:
+            with open('out.wat', 'w') as file:
+                file.write(generate_program(model, jobs=jobs))
+            print("Wrote out.wat")
 
 if __name__ == '__main__':
     import sys
-    main(sys.argv[1])
+    usage = 'Usage: python3 -m wabbit.wasm [-binary] [-jN] filename'
+    binary = False
+    jobs = 1
+    args = [ ]
+    for arg in sys.argv[1:]:
+        if arg == '-binary':
+            binary = True
+        elif arg.startswith('-j') and arg[2:].isdigit() and int(arg[2:]) >= 1:
+            jobs = int(arg[2:])
+        else:
+            args.append(arg)
+    if len(args) != 1:
+        raise SystemExit(usage)
+    main(args[0], binary, jobs)
 
         
         
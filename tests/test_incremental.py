@@ -0,0 +1,86 @@
+# test_incremental.py
+#
+# A Document after a series of random edits has to be the same as a
+# Document made from scratch from the final text: the same tokens, lex
+# errors, model (with positions), diagnostics and syntax error.
+
+import random
+
+import pytest
+
+from compared_py_to_wasm.benchmark import generate
+from compared_py_to_wasm.incremental import Document, node_fields
+from compared_py_to_wasm.model import Node
+
+sample = '''/* A program with a bit of everything */
+const pi = 3.14159;
+var count int = 0;
+var c char = 'a';
+func square(x float) float {
+    return x * x;
+}
+while count < 3 {
+    if count == 1 {
+        print square(pi);   // area-ish
+    } else {
+        print c;
+    }
+    count = count + 1;
+}
+print { var t int = count * 2; t + 1; };
+'''
+
+sources = [ sample, generate('functions', 5, seed=1), generate('loops', 10, seed=2),
+            generate('nesting', 6, seed=3),
+            # Short ones with errors, so edits land next to them
+            "v = '0(", "print 'a; x = 1;\nprint $ 2;", "var s int = 1; /* never closed" ]
+
+# Bits of text to insert: whole statements, and pieces that break the
+# program (unterminated literals and comments, illegal characters ...)
+snippets = [ 'x', '1', ' ', '\n', ';', '{', '}', '/*', '*/', "'", "'0", '//', '$', '.5', '(', ')',
+             '+', '1.0', 'var y int = 2;\n', 'func g() int { return 1; }\n', 'print x;',
+             'if true { print 1; }', 'else { }', 'while false { }', 'x = 3;', '' ]
+
+def positions(model):
+    out = [ ]
+    stack = [ model ]
+    while stack:
+        node = stack.pop()
+        out.append((type(node).__name__, getattr(node, 'lineno', None), getattr(node, 'col', None)))
+        for name in node_fields(type(node)):
+            value = getattr(node, name, None)
+            if isinstance(value, Node):
+                stack.append(value)
+            elif isinstance(value, list):
+                stack.extend(item for item in value if isinstance(item, Node))
+    return out
+
+def state(doc):
+    tokens = doc.tokens
+    tokens.settle()
+    model = doc.model
+    return {
+        'tokens': (list(tokens.kinds), list(tokens.starts), list(tokens.ends), list(tokens.linenos)),
+        'lex_errors': sorted(doc.lex_errors),
+        'model': repr(model),
+        'positions': positions(model) if model is not None else None,
+        'diagnostics': doc.diagnostics(),
+        'syntax_error': doc.syntax_error,
+        }
+
+def test_unterminated_char_after_edit():
+    doc = Document("v = '0(")
+    doc.edit(4, 0, 'q')
+    assert doc.lex_errors == Document(doc.text).lex_errors != [ ]
+
+@pytest.mark.parametrize('seed', range(40))
+def test_random_edits(seed):
+    rng = random.Random(seed)
+    doc = Document(sources[seed % len(sources)])
+    for step in range(60):
+        size = len(doc.text)
+        offset = rng.randint(0, size)
+        removed = min(rng.choice([0, 0, 1, 2, 5]), size - offset)
+        inserted = rng.choice(snippets)
+        doc.edit(offset, removed, inserted)
+        assert state(doc) == state(Document(doc.text)), (step, offset, removed, inserted)
@@ -0,0 +1,157 @@
+# test_regressions.py
+#
+# Programs that the compiler once got wrong.  Each one is run with and
+# without optimization on the interpreter and the VM, and compiled to
+# wasm (run under node, if it's installed), and all of them have to
+# print the expected output.
+
+import io
+import os
+import shutil
+import subprocess
+import tempfile
+from contextlib import redirect_stdout
+
+import pytest
+
+from compared_py_to_wasm.compile import compile_source
+from compared_py_to_wasm.parse import parse_source
+from compared_py_to_wasm.typecheck import check_program
+from compared_py_to_wasm.transform import transform
+
+programs = {
+    # A function declared in a loop: nothing in its body can be hoisted
+    # in front of the loop (its parameters don't exist there)
+    'function_in_loop': ('''
+var i int = 0;
+while i < 3 {
+    func dbl(x int) int {
+        return x * 2 + i;
+    }
+    print dbl(i);
+    i = i + 1;
+}
+''', '0\n3\n6\n'),
+    'function_in_if_in_loop': ('''
+var i int = 0;
+while i < 3 {
+    if i > 0 {
+        func tri(q int) int {
+            return q * 3 + i;
+        }
+        print tri(i);
+    }
+    i = i + 1;
+}
+''', '4\n8\n'),
+    # Once inlined, the function's variables are globals, and one
+    # declared in the loop still has to start at zero every time round
+    'uninitialized_in_inlined_loop': ('''
+func g(n int) float {
+    var s float = 0.0;
+    var i int = 0;
+    while i < n {
+        var f float;
+        f = f + 1.5;
+        s = s + f;
+        i = i + 1;
+    }
+    return s;
+}
+print g(3);
+''', '4.5\n'),
+    # A bool made from an int can be any non-zero value, so ! and the
+    # loop test can't flip the low bit
+    'bool_from_int_in_loop': ('''
+var x int = 5;
+while bool(x) {
+    print x;
+    x = x - 5;
+}
+print 99;
+''', '5\n99\n'),
+    'not_bool_from_int': ('''
+print !bool(5);
+''', 'false\n'),
+    # Int literals out of the i32 range wrap on every backend
+    'wide_literal': ('''
+var x int = 5000000000;
+print x;
+''', '705032704\n'),
+    }
+
+def run_python(source, backend, optimize):
+    model = parse_source(source)
+    assert check_program(model)
+    if optimize:
+        model = transform(model)
+    out = io.StringIO()
+    with redirect_stdout(out):
+        if backend == 'interp':
+            from compared_py_to_wasm.interp import interpret_program
+            interpret_program(model)
+        else:
+            from compared_py_to_wasm.vm import compile_program, run
+            run(compile_program(model), out)
+    return out.getvalue()
+
+# Runs a wasm module, printing the way the Python backends do
+_node_runner = '''
+const fs = require('fs');
+let out = '';
+const env = {
+    _printi: x => out += x + '\\n',
+    _printf: x => out += (Number.isInteger(x) ? x.toFixed(1) : String(x)) + '\\n',
+    _printb: x => out += (x ? 'true' : 'false') + '\\n',
+    _printc: x => out += String.fromCharCode(x),
+};
+const module = new WebAssembly.Module(fs.readFileSync(process.argv[1]));
+new WebAssembly.Instance(module, { env }).exports._init();
+process.stdout.write(out);
+'''
+
+def run_wasm(source, optimize):
+    binary = compile_source(source, 'wasm', optimize)
+    assert binary is not None
+    if shutil.which('node') is None:
+        pytest.skip('node is not installed')
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'prog.wasm')
+        with open(filename, 'wb') as file:
+            file.write(binary)
+        result = subprocess.run(['node', '-e', _node_runner, filename],
+                                capture_output=True, text=True, check=True)
+    return result.stdout
+
+@pytest.mark.parametrize('name', programs)
+@pytest.mark.parametrize('optimize', [False, True])
+@pytest.mark.parametrize('backend', ['interp', 'vm'])
+def test_python_backends(name, optimize, backend):
+    source, expected = programs[name]
+    assert run_python(source, backend, optimize) == expected
+
+@pytest.mark.parametrize('name', programs)
+@pytest.mark.parametrize('optimize', [False, True])
+def test_wat(name, optimize):
+    source, _ = programs[name]
+    assert compile_source(source, 'wat', optimize) is not None
+
+def test_wat_wide_literal():
+    wat = compile_source(programs['wide_literal'][0], 'wat', False)
+    assert 'i32.const 705032704' in wat and '5000000000' not in wat
+
+@pytest.mark.parametrize('name', programs)
+@pytest.mark.parametrize('optimize', [False, True])
+def test_wasm(name, optimize):
+    source, expected = programs[name]
+    assert run_wasm(source, optimize) == expected
+
+# Every backend takes programs nested as deeply as the parser does
+deep = 3000
+
+@pytest.mark.parametrize('backend', ['interp', 'vm'])
+def test_deep_nesting(backend):
+    source = 'var x int = 1;\n' + 'if x < 5 {\n' * deep + 'print x;\n' + '}\n' * deep
+    assert run_python(source, backend, False) == '1\n'
+    source = 'var x int = 1;\nprint ' + ' + '.join(['x'] * deep) + ';\n'
+    assert run_python(source, backend, False) == f'{deep}\n'